@@ -0,0 +1,169 @@
+import re
+import argparse
+
+import parser_qasm
+import estimate
+
+# Positions of the wires each primitive writes, the others are only read
+# (controls), so operations sharing nothing but controls commute.
+targets = {'x': (0,), 'cx': (1,), 'ccx': (2,), 'swap': (0, 1), 'cswap': (1, 2)}
+
+
+def asap(ops, nwires):
+    """ As soon as possible layers of flattened operations
+
+    Returns (layers, pred, depth): the layer of each operation, the
+    operation it waits for on its longest path (None when it starts the
+    circuit) and the number of layers.
+    """
+    written = [0]*nwires
+    read = [0]*nwires
+    writer = [None]*nwires
+    reader = [None]*nwires
+    layers = []
+    pred = []
+    for i, (func, w) in enumerate(ops):
+        t = targets[func]
+        layer, p = 0, None
+        for k, wire in enumerate(w):
+            if written[wire] > layer:
+                layer, p = written[wire], writer[wire]
+            if k in t and read[wire] > layer:
+                layer, p = read[wire], reader[wire]
+        for k, wire in enumerate(w):
+            if k in t:
+                written[wire], writer[wire] = layer+1, i
+            elif read[wire] < layer+1:
+                read[wire], reader[wire] = layer+1, i
+        layers.append(layer)
+        pred.append(p)
+    return layers, pred, max(written + read)
+
+
+def alap(ops, nwires, depth):
+    """ As late as possible layers, for a circuit of the given depth """
+    written = [depth]*nwires
+    read = [depth]*nwires
+    layers = [0]*len(ops)
+    for i in range(len(ops)-1, -1, -1):
+        func, w = ops[i]
+        t = targets[func]
+        end = depth
+        for k, wire in enumerate(w):
+            end = min(end, written[wire], read[wire] if k in t else depth)
+        for k, wire in enumerate(w):
+            if k in t:
+                written[wire] = end-1
+            else:
+                read[wire] = min(read[wire], end-1)
+        layers[i] = end-1
+    return layers
+
+
+def critical_path(layers, pred, depth):
+    """ Operations of a longest path, in circuit order """
+    if depth == 0:
+        return []
+    i = layers.index(depth-1)
+    path = []
+    while i is not None:
+        path.append(i)
+        i = pred[i]
+    return path[::-1]
+
+
+def table_params(gates, name):
+    return next(params for n, params, _ in gates if n == name)
+
+
+def gate_depths(gates, names):
+    """ Depth of each named gate, flattened """
+    return {name: asap(parser_qasm.flatten(gates, name),
+                       len(table_params(gates, name)))[2] for name in names}
+
+
+def path_by_call(gates, name, path):
+    """ Splits a path through a flattened gate by the operation of its body
+    each step belongs to, as a list of (operation, steps) """
+    body = next(body for n, _, body in gates if n == name)
+    counts = estimate.count_gates([(n, [func for func, _ in b]) for n, _, b in gates])
+    owner = []
+    for k, (func, _) in enumerate(body):
+        owner.extend([k]*(1 if func in estimate.index else sum(counts[func])))
+    split = []
+    for i in path:
+        k = owner[i]
+        if split and split[-1][0] == k:
+            split[-1][1] += 1
+        else:
+            split.append([k, 1])
+    return [('{} {}'.format(body[k][0], ','.join(body[k][1])), steps) for k, steps in split]
+
+
+def layered_gate(gates, name):
+    """ QASM body lines of a flattened gate, ordered by ASAP layer, each
+    layer starting with a // layer i comment """
+    params = table_params(gates, name)
+    ops = parser_qasm.flatten(gates, name)
+    layers, _, depth = asap(ops, len(params))
+    by_layer = [[] for _ in range(depth)]
+    for i, layer in enumerate(layers):
+        by_layer[layer].append(i)
+    body = []
+    for layer, ops_in_layer in enumerate(by_layer):
+        body.append('  // layer {}'.format(layer))
+        body.extend('  {} {};'.format(ops[i][0], ','.join(params[w] for w in ops[i][1]))
+                    for i in ops_in_layer)
+    return body
+
+
+def replace_body(code, name, body):
+    """ Replaces the body of a gate in QASM code """
+    start = re.search(r'^gate {} .*\n\{{\n'.format(re.escape(name)), code, re.M).end()
+    end = code.index('\n}', start-1)
+    return code[:start] + '\n'.join(body) + code[end:]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Depth and critical path of '
+                                     'the gates of a QASM file')
+    parser.add_argument('qasm',help='QASM file generated by synth.py')
+    parser.add_argument('--gate',action='append',default=None,
+                        help='Gate to report the depth of, may be repeated. Defaults to every gate')
+    parser.add_argument('--path',default=None,help='Gate to show the critical path '
+                        'of. Defaults to the first cmodularmult gate')
+    parser.add_argument('--layered',default=None,help='Gate whose body is replaced by '
+                        'its flattened operations grouped into ASAP layers')
+    parser.add_argument('-o',default='layered.qasm',help='Output file of --layered')
+
+    args = parser.parse_args()
+
+    with open(args.qasm) as f:
+        code = f.read()
+    with open(args.qasm) as f:
+        _, gates, aliases = parser_qasm.read_gates(f)
+
+    names = [aliases.get(name, name) for name in args.gate or []] or [g[0] for g in gates]
+    depths = gate_depths(gates, names)
+    print('{:<40} {:>12}'.format('gate', 'depth'))
+    for name in names:
+        print('{:<40} {:>12}'.format(name, depths[name]))
+
+    path_gate = args.path or next((g[0] for g in gates if g[0].startswith('cmodularmult')), None)
+    if path_gate:
+        path_gate = aliases.get(path_gate, path_gate)
+        ops = parser_qasm.flatten(gates, path_gate)
+        nwires = len(table_params(gates, path_gate))
+        layers, pred, depth = asap(ops, nwires)
+        late = alap(ops, nwires, depth)
+        path = critical_path(layers, pred, depth)
+        print('')
+        print('critical path of {}: {} layers, {} of {} operations without slack'.format(
+                    path_gate, depth, sum(a == l for a, l in zip(layers, late)), len(ops)))
+        for call, steps in path_by_call(gates, path_gate, path):
+            print('  {:>8}  {}'.format(steps, call))
+
+    if args.layered:
+        name = aliases.get(args.layered, args.layered)
+        with open(args.o,'w') as f:
+            f.write(replace_body(code, name, layered_gate(gates, name)))
@@ -0,0 +1,179 @@
+import io
+import re
+import time
+import argparse
+from operator import itemgetter
+from collections import Counter
+
+import synth
+import parser_qasm
+
+primitives = parser_qasm.primitives
+index = {name: i for i, name in enumerate(primitives)}
+
+
+def count_gate(counts, calls):
+    """ Primitive counts of a gate from the counts of the gates it calls
+
+    calls is an iterable over the gate names of its operations and counts
+    maps each already counted gate to its list of counts (in `primitives`
+    order), so every gate is counted once and nothing is flattened.
+    """
+    total = [0]*len(primitives)
+    for callee, times in Counter(calls).items():
+        if callee in index:
+            total[index[callee]] += times
+        else:
+            for i, c in enumerate(counts[callee]):
+                total[i] += times*c
+    return total
+
+
+def count_gates(gates):
+    """ Counts of a list of (name, calls) given in declaration order """
+    counts = {}
+    for name, calls in gates:
+        counts[name] = count_gate(counts, calls)
+    return counts
+
+
+class CountingGate(synth.Gate):
+    """ Gate keeping only the names of the gates its operations call,
+    which is all counting needs
+
+    Its wires are not named, params is only the range of their indices.
+    """
+    def __init__(self, name, params):
+        self.name = name
+        self.regs = []
+        n = 0
+        for p in params:
+            if isinstance(p, tuple):
+                self.regs.append(list(range(n, n+p[1])))
+                n += p[1]
+            else:
+                self.regs.append(n)
+                n += 1
+        self.params = range(n)
+        self.called = []
+
+    def op(self, name, *args):
+        self.called.append(name)
+
+
+class CountingStream(synth.QasmStream):
+    """ Synthesizer stream counting each gate instead of writing it
+
+    Generators build CountingGates, dropped once counted, so estimating a
+    circuit takes about as much memory as streaming it and no wire list
+    is built. The main program still goes to self.f.
+    """
+    gate_class = CountingGate
+
+    def __init__(self):
+        synth.QasmStream.__init__(self, io.StringIO(), False)
+        self.table = []
+        self.counts = {}
+        self.elapsed = 0
+
+    def write(self, code):
+        pass
+
+    def write_gate(self, gate):
+        start = time.time()
+        self.table.append((gate.name, gate.params))
+        self.counts[gate.name] = count_gate(self.counts, gate.called)
+        self.elapsed += time.time() - start
+
+
+def main_statements(code):
+    """ Statements of the main program, which follows the last gate """
+    main = [line.strip() for line in code[code.rfind('\n}\n')+2:].split('\n')]
+    return [line for line in main if line and not line.startswith('//')]
+
+
+def count_program(code, counts):
+    """ Counts of the main program of code and its qubit registers """
+    qubits = {}
+    program = [0]*len(primitives)
+    for statement in main_statements(code):
+        tok = statement.split(' ')
+        reg = re.match(r'qreg (\w+)\[(\d+)\]', statement)
+        if reg:
+            qubits[reg.group(1)] = int(reg.group(2))
+        elif tok[0] in index:
+            program[index[tok[0]]] += 1
+        elif tok[0] in counts:
+            for i, c in enumerate(counts[tok[0]]):
+                program[i] += c
+    return program, qubits
+
+
+def estimate_qasm(code):
+    """ Gate table (name, params), counts, program counts and registers
+    of a QASM program read back from its text """
+    _, gates, _ = parser_qasm.read_gates(io.StringIO(code))
+    table = [(name, params) for name, params, _ in gates]
+    counts = count_gates([(name, map(itemgetter(0), body)) for name, _, body in gates])
+    return (table, counts) + count_program(code, counts)
+
+
+def estimate_synth(nb, A, N, obfuscate_setup, window=1, multiplier='doubling', coset=0,
+                   adder='cdkm'):
+    """ Same as estimate_qasm() from synth.py's IR, without rendering the
+    gates. Also returns the time spent counting. """
+    stream = CountingStream()
+    synth.Synthesizer(stream=stream, adder=adder).synth(nb,A,N,obfuscate_setup,window,multiplier,coset)
+    start = time.time()
+    result = (stream.table, stream.counts) + count_program(stream.f.getvalue(), stream.counts)
+    return result, stream.elapsed + time.time() - start
+
+
+def print_table(table, counts, program, qubits):
+    row = '{:<40} {:>7} {:>14} {:>14} {:>14} {:>14} {:>14} {:>14} {:>15}'
+    print(row.format('gate', 'qubits', *primitives, 'toffoli', 'total'))
+    for name, params in table:
+        c = counts[name]
+        print(row.format(name, len(params), *c, c[index['ccx']] + c[index['cswap']], sum(c)))
+    print('')
+    print('program: {} qubits ({})'.format(sum(qubits.values()),
+                    ', '.join('{}[{}]'.format(k, v) for k, v in qubits.items())))
+    for name, c in zip(primitives, program):
+        print('  {:<8} {}'.format(name, c))
+    print('  {:<8} {}'.format('toffoli', program[index['ccx']] + program[index['cswap']]))
+    print('  {:<8} {}'.format('total', sum(program)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Counts the primitive gates '
+                                     'of a circuit without flattening it')
+    parser.add_argument('qasm',nargs='?',default=None,help='QASM file (otherwise the circuit is synthesized)')
+    parser.add_argument('-nb',type=int,default=3,help='Number of bits in the registers')
+    parser.add_argument('-A',type=int,default=2,help='Base of exponentiation')
+    parser.add_argument('-N',type=int,default=3,help='All is mod N')
+    parser.add_argument('--obfuscate_setup',default=False,const=True,action='store_const',help='Gates setup is scrambled')
+    parser.add_argument('--window',type=int,default=1,help='Exponent bits per modular multiplication')
+    parser.add_argument('--multiplier',default='doubling',choices=synth.multipliers,help='Modular multiplier')
+    parser.add_argument('--coset',type=int,default=0,help='Padding qubits of the coset representation')
+    parser.add_argument('--adder',default='cdkm',choices=synth.adders,help='Adder backend')
+
+    args = parser.parse_args()
+
+    start = time.time()
+    if args.qasm:
+        with open(args.qasm) as f:
+            code = f.read()
+        result = estimate_qasm(code)
+        counting = time.time() - start
+    else:
+        result, counting = estimate_synth(args.nb,args.A,args.N,args.obfuscate_setup,args.window,
+                                                  args.multiplier,args.coset,args.adder)
+    elapsed = time.time() - start
+
+    print_table(*result)
+    print('')
+    if args.qasm:
+        print('read and counted in {:.1f} ms'.format(elapsed*1000))
+    else:
+        print('synthesized and counted in {:.1f} ms, {:.1f} ms of it counting'.format(
+                    elapsed*1000, counting*1000))
@@ -1,8 +1,16 @@
-import sys
-
-f = open(sys.argv[1])
+import argparse
+from array import array
 
 base_code = '''
+# Every wire carries a lane mask: bit k of a wire is its value in the k-th
+# input vector, so one call evaluates many inputs at once (bit-slicing).
+# Plain single-bit evaluation is the special case LANES = 1.
+LANES = 1
+
+def set_lanes(n):
+    global LANES
+    LANES = (1 << n) - 1
+
 def swap(a,b):
     return b,a
 
@@ -10,41 +18,461 @@ def cx(a,b):
     return a, a^b
 
 def ccx(a,b,c):
-    return a, b, c^(a and b)
+    return a, b, c^(a&b)
 
 def x_b(a):
-    return 1-a
+    return a^LANES
 
 def cswap(c,a,b):
-    if c:
-        return c,b,a
-    return c,a,b
+    t = (a^b)&c
+    return c,a^t,b^t
+'''
+
+buffer_base_code = '''
+# The whole machine state is one mutable buffer `st` (list, bytearray or
+# NumPy array) and every gate receives the wire indices `w` of its
+# parameters, in declaration order. Gates update `st` in place and return
+# nothing. With a list of ints each wire may also hold a bit-sliced lane
+# mask (see set_lanes), with a bytearray only LANES = 1 makes sense.
+LANES = 1
+
+def set_lanes(n):
+    global LANES
+    LANES = (1 << n) - 1
+'''
+
+flat_base_code = '''
+# Every function is a flattened gate: straight-line primitive operations
+# over the mutable state buffer `st`, indexed by the position of each
+# parameter in the gate declaration.
+LANES = 1
+
+def set_lanes(n):
+    global LANES
+    LANES = (1 << n) - 1
+'''
+
+opcodes_base_code = '''
+# OPCODES maps each flattened gate to a flat array of (op, a, b, c) quads
+# over the wire indices of the gate parameters. run(st, OPCODES[name])
+# applies one of them in place to the state buffer `st`.
+LANES = 1
+
+def set_lanes(n):
+    global LANES
+    LANES = (1 << n) - 1
+
+def run(st, code):
+    it = iter(code)
+    for op, a, b, c in zip(it, it, it, it):
+        if op == {x}:
+            st[a] ^= LANES
+        elif op == {cx}:
+            st[b] ^= st[a]
+        elif op == {ccx}:
+            st[c] ^= st[a] & st[b]
+        elif op == {swap}:
+            st[a], st[b] = st[b], st[a]
+        else:
+            t = (st[b]^st[c]) & st[a]
+            st[b] ^= t
+            st[c] ^= t
 '''
 
-code = []
+primitives = ('x', 'cx', 'ccx', 'swap', 'cswap')
+opcodes = {func: i for i, func in enumerate(primitives)}
+opcodes_base_code = opcodes_base_code.format(**opcodes)
+
 indentation = '    '
-for line in f:
-    if line.startswith("//"):
-        code.extend([line.replace("//","#")])
-    tok = line.strip().split(' ')
-    if tok[0] == 'gate':
-        _ = f.readline()
-        ret_vals = tok[2]
-        code.extend(['def ' + tok[1] + '(' + tok[2] + '):'])
-        l = f.readline().strip().split(' ')
-        if l[0]=='}':
-            code.extend([indentation+'return ' + ret_vals +'\n'])
-        while l[0] != '}':
-            func = l[0]
+
+# Every primitive is its own inverse. x c; op; x c equals op followed by
+# the operation below, for each (primitive, position of the control c).
+self_inverse = {func: func for func in primitives}
+negated_control = {
+    ('cx', 0): lambda w: ('x', (w[1],)),
+    ('ccx', 0): lambda w: ('cx', (w[1], w[2])),
+    ('ccx', 1): lambda w: ('cx', (w[0], w[2])),
+    ('cswap', 0): lambda w: ('swap', (w[1], w[2])),
+}
+
+
+def peephole_ops(ops, inverse=self_inverse, empty=()):
+    """ Simplifies the operations of one gate body
+
+    ops is a list of (func, wires) with wires a tuple. An operation
+    followed by its inverse (see inverse) on the same wires, with nothing
+    in between touching them, cancels out, and so do calls to the gates in
+    empty. x c; op; x c with c a control of op, and nothing after op
+    touching its wires, becomes op plus the cheaper operation in
+    negated_control (there are no negated controls among the primitives).
+    """
+    out = []
+    on_wire = {}
+    def push(name, wires):
+        if name in empty:
+            return
+        stacks = [on_wire.setdefault(w, []) for w in wires]
+        last = stacks[0][-1] if stacks[0] else None
+        if last is not None and all(s and s[-1] == last for s in stacks) \
+                and out[last] == (inverse.get(name), wires):
+            out[last] = None
+            for s in stacks:
+                s.pop()
+            return
+        if name == 'x' and last is not None:
+            op, w = out[last]
+            key = (op, w.index(wires[0]))
+            s = stacks[0]
+            # op must be the last operation on all its wires, since its
+            # correction is appended after anything already in out
+            if key in negated_control and len(s) > 1 and out[s[-2]] == ('x', wires) \
+                    and all(on_wire[v][-1] == last for v in w):
+                out[s[-2]] = None
+                del s[-2]
+                push(*negated_control[key](w))
+                return
+        for s in stacks:
+            s.append(len(out))
+        out.append((name, wires))
+    for name, wires in ops:
+        push(name, wires)
+    return [op for op in out if op is not None]
+
+
+# partial_eval() keeps the value of every wire it touches as a constant bit
+# XORed with a set of terms, each an unknown input wire or the AND of two
+# such values (written the same way, so identical terms cancel out). A wire
+# is known when no term is left, e.g. once a computation is undone.
+max_terms = 64
+
+
+def xor_values(e, f):
+    return e[0] ^ f[0], e[1] ^ f[1]
+
+
+def and_values(e, f):
+    if not e[1]:
+        return e if e[0] == 0 else f
+    if not f[1]:
+        return f if f[0] == 0 else e
+    if e == f:
+        return e
+    return 0, frozenset([tuple(sorted((e, f), key=hash))])
+
+
+def partial_eval(ops, known):
+    """ Propagates classically known wires through flattened operations
+
+    known maps the wires holding a known bit to it and is updated to the
+    wires known after ops. Operations whose outcome is known (or which
+    provably change nothing) are dropped and tracked in known instead, and
+    controls known to be 1 are removed (ccx becomes cx or x, cswap becomes
+    swap). Returns the residual (func, wires) operations, which leave the
+    same state as ops for every input agreeing with known: a known wire the
+    dropped x operations left out of date is flipped back before the
+    residual circuit uses it, and at the end.
+    """
+    out = []
+    stale = set()
+    value = {w: (b, frozenset()) for w, b in known.items()}
+    fresh = iter(range(-1, -2**62, -1))
+    def get(w):
+        return value.get(w) or (0, frozenset([w]))
+    def put(w, e):
+        value[w] = e if len(e[1]) <= max_terms else (0, frozenset([next(fresh)]))
+    def emit(func, wires):
+        for w in wires:
+            if w in stale:
+                stale.remove(w)
+                out.append(('x', (w,)))
+        out.append((func, tuple(wires)))
+    def flip(w):
+        put(w, xor_values(get(w), (1, frozenset())))
+        stale.symmetric_difference_update((w,))
+    for func, w in ops:
+        ncontrols = {'cx': 1, 'ccx': 2, 'cswap': 1}.get(func, 0)
+        controls, targets = list(w[:ncontrols]), list(w[ncontrols:])
+        control = (1, frozenset())
+        for c in controls:
+            control = and_values(control, get(c))
+        if control == (0, frozenset()):
+            continue
+        free = [c for c in controls if get(c)[1]]
+        if func in ('swap', 'cswap'):
+            a, b = targets
+            ea, eb = get(a), get(b)
+            d = and_values(control, xor_values(ea, eb))
+            if d == (0, frozenset()):
+                continue
+            if not (d[1] or ea[1] or eb[1]):
+                flip(a)
+                flip(b)
+                continue
+            emit('cswap' if free else 'swap', free + targets)
+            put(a, xor_values(ea, d))
+            put(b, xor_values(eb, d))
+        else:
+            t = targets[0]
+            if not (control[1] or get(t)[1]):
+                flip(t)
+                continue
+            emit(('x', 'cx', 'ccx')[len(free)], free + targets)
+            put(t, xor_values(get(t), control))
+    for w in sorted(stale):
+        out.append(('x', (w,)))
+    known.clear()
+    known.update((w, e[0]) for w, e in value.items() if not e[1])
+    return out
+
+
+def known_wires(params, assignments):
+    """ Positions of params and their bits from NAME=VALUE assignments,
+    NAME being a parameter or the prefix of NAME0, NAME1, ... (least
+    significant first). Names the gate does not have are ignored. """
+    position = {p: i for i, p in enumerate(params)}
+    known = {}
+    for assignment in assignments:
+        name, value = assignment.split('=')
+        value = int(value, 0)
+        if name in position:
+            known[position[name]] = value & 1
+            continue
+        i = 0
+        while '{}{}'.format(name, i) in position:
+            known[position['{}{}'.format(name, i)]] = value >> i & 1
+            i += 1
+    return known
+
+
+def read_gates(f):
+    """ Reads the comments and gate definitions of a QASM file
+
+    Returns (comments, gates, aliases), gates being a list of
+    (name, params, body) where body is a list of (func, args) pairs, and
+    aliases mapping the names of gates synth.py --dedup merged to the
+    gate kept in their place.
+    """
+    comments = []
+    gates = []
+    aliases = {}
+    for line in f:
+        if line.startswith("// alias "):
+            _, _, name, kept = line.split()
+            aliases[name] = kept
+        elif line.startswith("//"):
+            comments.append(line.rstrip('\n').replace("//","#",1))
+        tok = line.strip().split(' ')
+        if tok[0] == 'gate':
+            _ = f.readline()
+            body = []
+            l = f.readline().strip().split(' ')
+            while l[0] != '}':
+                if not l[0].startswith('//'):
+                    body.append((l[0], l[1][:-1].split(',')))
+                l = f.readline().strip().split(' ')
+            gates.append((tok[1], tok[2].split(','), body))
+    return comments, gates, aliases
+
+
+def emit_tuple(gates):
+    """ One positional argument per wire, every gate returns all its wires """
+    code = []
+    for name, params, body in gates:
+        ret_vals = ','.join(params)
+        code.append('def ' + name + '(' + ret_vals + '):')
+        for func, args in body:
             if func == 'x':
                 func = 'x_b'
-            args = l[1][:-1]
-            code.extend([indentation+args + '=' + func + '(' + args + ')'])
-            l = f.readline().strip().split(' ')
-            if l[0]=='}':
-                code.extend([indentation+'return ' + ret_vals +'\n'])
+            args = ','.join(args)
+            code.append(indentation + args + '=' + func + '(' + args + ')')
+        code.append(indentation + 'return ' + ret_vals + '\n')
+    return code + [base_code]
+
+
+def buffer_op(func, w):
+    """ Source lines applying a primitive to the wires st[w[0]], st[w[1]], ... """
+    if func == 'x':
+        return ['st[{}] ^= LANES'.format(*w)]
+    if func == 'cx':
+        return ['st[{1}] ^= st[{0}]'.format(*w)]
+    if func == 'ccx':
+        return ['st[{2}] ^= st[{0}] & st[{1}]'.format(*w)]
+    if func == 'swap':
+        return ['st[{0}],st[{1}] = st[{1}],st[{0}]'.format(*w)]
+    return ['t = (st[{1}]^st[{2}]) & st[{0}]'.format(*w),
+            'st[{1}] ^= t'.format(*w),
+            'st[{2}] ^= t'.format(*w)]
+
+
+def emit_buffer(gates):
+    """ Gates take the state buffer and a sequence of wire indices
+
+    The sequence must be hashable (a tuple or a range): the index tuples a
+    gate passes to the gates it calls are built once per sequence it gets
+    and kept in a dict, so nested calls allocate nothing.
+    """
+    code = []
+    for name, params, body in gates:
+        wire = {p: 'w[{}]'.format(i) for i, p in enumerate(params)}
+        calls = [func for func, _ in body if func not in opcodes]
+        if calls:
+            code.append('_args_' + name + ' = {}')
+        code.append('def ' + name + '(st,w):')
+        if calls:
+            args = ['(' + ','.join(wire[arg] for arg in a) + (',)' if len(a) == 1 else ')')
+                    for func, a in body if func not in opcodes]
+            code.append(indentation + 'a = _args_' + name + '.get(w)')
+            code.append(indentation + 'if a is None:')
+            code.append(indentation*2 + 'a = _args_' + name + '[w] = (' + ','.join(args) + ',)')
+        k = 0
+        for func, args in body:
+            if func in opcodes:
+                code.extend(indentation + l for l in buffer_op(func, [wire[arg] for arg in args]))
+            else:
+                code.append(indentation + func + '(st,a[{}])'.format(k))
+                k += 1
+        if not body:
+            code.append(indentation + 'pass')
+        code.append('')
+    return code + [buffer_base_code]
+
+
+def roots(gates):
+    """ Names of the gates no other gate calls """
+    called = {func for _, _, body in gates for func, _ in body}
+    return [name for name, _, _ in gates if name not in called]
+
+
+def flatten(gates, name):
+    """ Expands a gate into primitive operations
+
+    Returns a list of (func, wires) with func in `primitives` and wires the
+    positions of the parameters of `name` each operation acts upon.
+    """
+    table = {g[0]: g for g in gates}
+    ops = []
+    def expand(name, wires):
+        _, params, body = table[name]
+        index = dict(zip(params, wires))
+        for func, args in body:
+            w = [index[arg] for arg in args]
+            if func in opcodes:
+                ops.append((func, w))
+            else:
+                expand(func, w)
+    expand(name, range(len(table[name][1])))
+    return ops
+
+
+def flat_ops(gates, name, optimize=False, known=()):
+    """ flatten(), followed by partial_eval() with the NAME=VALUE
+    assignments in known (see known_wires()) and peephole_ops() with
+    optimize """
+    ops = flatten(gates, name)
+    if known:
+        params = next(params for g, params, _ in gates if g == name)
+        ops = partial_eval(ops, known_wires(params, known))
+    if optimize:
+        ops = peephole_ops([(func, tuple(w)) for func, w in ops])
+    return ops
+
+
+def flat_sizes(gates):
+    """ Number of operations of every gate once flattened, counted from
+    those of the gates it calls (gates in declaration order) """
+    sizes = {}
+    for name, _, body in gates:
+        sizes[name] = sum(1 if func in opcodes else sizes[func] for func, _ in body)
+    return sizes
+
+
+def emit_flat(gates, names=None, optimize=False, known=(), sizes=None):
+    """ One straight-line function over the state buffer per selected gate
+
+    sizes, when given, gets the number of operations of each function.
+    """
+    code = []
+    for name in names or roots(gates):
+        ops = flat_ops(gates, name, optimize, known)
+        if sizes is not None:
+            sizes[name] = len(ops)
+        code.append('def ' + name + '(st):')
+        for func, w in ops:
+            code.extend(indentation + l for l in buffer_op(func, w))
+        if not ops:
+            code.append(indentation + 'pass')
+        code.append('')
+    return code + [flat_base_code]
+
+
+def to_opcodes(ops):
+    """ Packs flattened operations into an array of (op, a, b, c) quads """
+    code = array('i')
+    for func, w in ops:
+        code.extend([opcodes[func]] + list(w) + [0]*(3-len(w)))
+    return code
+
+
+def emit_opcodes(gates, names=None, optimize=False, known=(), sizes=None):
+    """ Flattened gates as opcode arrays, see run() in the generated code
+    and emit_flat() for sizes """
+    code = ['from array import array', '', 'OPCODES = {}']
+    for name in names or roots(gates):
+        ops = flat_ops(gates, name, optimize, known)
+        if sizes is not None:
+            sizes[name] = len(ops)
+        code.append("OPCODES['{}'] = array('i', {})".format(name, list(to_opcodes(ops))))
+    return code + [opcodes_base_code]
+
+
+targets = {
+    'tuple': (emit_tuple, 'classical_code.py'),
+    'buffer': (emit_buffer, 'classical_buffer.py'),
+    'flat': (emit_flat, 'classical_flat.py'),
+    'opcodes': (emit_opcodes, 'classical_opcodes.py'),
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('qasm',help='QASM file generated by synth.py')
+    parser.add_argument('--target',default='tuple',choices=sorted(targets),
+                        help='Calling convention of the generated functions')
+    parser.add_argument('-o',default=None,help='Output file')
+    parser.add_argument('--gate',action='append',default=None,
+                        help='Gate to flatten (flat and opcodes targets), '
+                             'may be repeated. Defaults to the gates no other gate calls')
+    parser.add_argument('--optimize',default=False,const=True,action='store_const',
+                        help='Cancels inverse operations and negated controls once flattened '
+                             '(flat and opcodes targets)')
+    parser.add_argument('--known',action='append',default=[],metavar='NAME=VALUE',
+                        help='Parameter (or NAME0, NAME1, ... register) known to hold VALUE, '
+                             'constants are propagated through the flattened gates '
+                             '(flat and opcodes targets), may be repeated')
+
+    args = parser.parse_args()
+
+    emit, output = targets[args.target]
+    with open(args.qasm) as f:
+        comments, gates, aliases = read_gates(f)
+
+    if args.target in ('flat', 'opcodes'):
+        names = [aliases.get(name, name) for name in args.gate or []]
+        sizes = {}
+        code = emit(gates, names, args.optimize, args.known, sizes)
+        emitted = names or roots(gates)
+        if args.optimize or args.known:
+            before = flat_sizes(gates)
+            for name in emitted:
+                print('{}: {} -> {} operations'.format(name, before[name], sizes[name]))
+    else:
+        code = emit(gates)
+        emitted = [name for name, _, _ in gates]
 
-with open('classical_code.py','w') as f:
-    code =  '\n'.join(code) + base_code
-    f.write(code)
+    alias_format = "OPCODES['{}'] = OPCODES['{}']" if args.target == 'opcodes' else '{} = {}'
+    code += [alias_format.format(name, kept)
+             for name, kept in aliases.items() if kept in emitted]
 
+    with open(args.o or output,'w') as f:
+        code = '\n'.join(comments + [''] + code)
+        f.write(code)
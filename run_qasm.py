@@ -1,35 +1,100 @@
 import sys
-import qiskit as qi
-import matplotlib.pyplot as plt
-from qiskit.tools.visualization import circuit_drawer
-from qiskit import Aer
+import json
 import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
-#from qiskit import QuantumProgram
-#qp = QuantumProgram()
+# qiskit, matplotlib and simulate.py are imported only by the functions
+# needing them, so a run only pays for what it uses.
 
-prog =  qi.load_qasm_file(sys.argv[1])
-#circuit_drawer(prog).show()
 
-backend = Aer.get_backend('qasm_simulator')
+def aer_backend():
+    """ Aer's qasm simulator, or None when qiskit is not installed """
+    try:
+        from qiskit import Aer
+    except ImportError:
+        return None
+    return Aer.get_backend('qasm_simulator')
 
-# Job is async
-job = qi.execute(prog, backend, shots=1)
 
-#The block below is not necessary
-#It is just way to make sure things are still running
-init_status = job.status()
-i=0
-while True:
-    time.sleep(10)
-    print(job.status(), i)
-    i=i+1
-    if init_status != job.status():
-        break
+def run_aer(backend, path, shots):
+    import qiskit as qi
+    prog = qi.load_qasm_file(path)
+    # Job is async, result() blocks until it completes (or crashes)
+    job = qi.execute(prog, backend, shots=shots)
+    return job.result().get_counts(prog)
 
 
-#This call blocks waiting for the job completion
-#But it will always have completed (or crashed)
-result = job.result()
+def run_builtin(path, shots, seed):
+    import simulate
+    counts, _ = simulate.simulate(simulate.read_qasm(path), shots, seed)
+    return dict(counts)
 
-print(result.get_counts(prog))
+
+def timed(func, *args):
+    start = time.time()
+    return func(*args), time.time() - start
+
+
+def draw(path):
+    import qiskit as qi
+    import matplotlib.pyplot as plt
+    from qiskit.tools.visualization import circuit_drawer
+    circuit_drawer(qi.load_qasm_file(path))
+    plt.show()
+
+
+def run_all(paths, shots=1, seed=None, workers=None, builtin=False):
+    """ Runs every QASM file concurrently and yields one result dict per
+    file as soon as it finishes
+
+    Circuits go to Aer when qiskit is installed (its jobs are waited on
+    from a thread pool) and otherwise, or with builtin, to simulate.py in
+    a process pool.
+    """
+    backend = None if builtin else aer_backend()
+    if backend is None:
+        executor = ProcessPoolExecutor(workers)
+        name = 'simulate'
+        submit = lambda path: executor.submit(timed, run_builtin, path, shots, seed)
+    else:
+        executor = ThreadPoolExecutor(workers or len(paths))
+        name = 'aer'
+        submit = lambda path: executor.submit(timed, run_aer, backend, path, shots)
+    with executor:
+        futures = {submit(path): path for path in paths}
+        for future in as_completed(futures):
+            result = {'file': futures[future], 'backend': name}
+            try:
+                result['counts'], result['seconds'] = future.result()
+            except Exception as e:
+                result['error'] = '{}: {}'.format(type(e).__name__, e)
+            yield result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs QASM circuits and prints one JSON line '
+                                     'per circuit as it finishes')
+    parser.add_argument('qasm',nargs='+',help='QASM files')
+    parser.add_argument('--shots',type=int,default=1,help='Runs of each circuit')
+    parser.add_argument('--seed',type=int,default=None,help='Seed of the built-in simulator')
+    parser.add_argument('--jobs',type=int,default=None,help='Circuits run at once')
+    parser.add_argument('--builtin',default=False,const=True,action='store_const',
+                        help='Use simulate.py even when qiskit is installed')
+    parser.add_argument('--draw',default=False,const=True,action='store_const',
+                        help='Draw each circuit with qiskit first')
+
+    args = parser.parse_args()
+
+    if args.draw:
+        try:
+            for path in args.qasm:
+                draw(path)
+        except ImportError as e:
+            print("--draw needs qiskit and matplotlib ({})".format(e))
+            sys.exit(-1)
+    failed = False
+    for result in run_all(args.qasm, args.shots, args.seed, args.jobs, args.builtin):
+        print(json.dumps(result), flush=True)
+        failed = failed or 'error' in result
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,614 @@
+import io
+import re
+import ast
+import copy
+import gzip
+import math
+import cmath
+import time
+import random
+import argparse
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import parser_qasm
+import estimate
+
+# [if(creg==value)] name[(params)] args
+statement_re = re.compile(r'(?:if\((\w+)==(\d+)\)\s*)?(\w+)(?:\(([^)]*)\))?\s*(.*)')
+element_re = re.compile(r'(\w+)(?:\[(\d+)\])?$')
+
+angle_ops = {ast.Add: float.__add__, ast.Sub: float.__sub__, ast.Mult: float.__mul__,
+             ast.Div: float.__truediv__, ast.Pow: float.__pow__}
+
+
+def angle(text):
+    """ Value of a gate parameter like pi/2^k, made of numbers, pi, + - * / ^ **
+
+    The text comes from the QASM file, so it is not given to eval()
+    """
+    def value(node):
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return float(node.value)
+        if isinstance(node, ast.Name) and node.id == 'pi':
+            return math.pi
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+            return -value(node.operand) if isinstance(node.op, ast.USub) else value(node.operand)
+        if isinstance(node, ast.BinOp) and type(node.op) in angle_ops:
+            return angle_ops[type(node.op)](value(node.left), value(node.right))
+        raise ValueError('unsupported angle: {}'.format(text))
+    # QASM writes powers as ^, which Python parses as xor
+    return value(ast.parse(text.replace('^', '**').strip(), mode='eval').body)
+
+
+def compile_gates(gates, aliases=()):
+    """ Namespace of the bit-sliced functions of parser_qasm.emit_tuple() """
+    ns = {}
+    exec(compile('\n'.join(parser_qasm.emit_tuple(gates)), '<gates>', 'exec'), ns)
+    for name, kept in dict(aliases).items():
+        ns[name] = ns[kept]
+    return ns
+
+
+class Simulator:
+    """ Runs the main program of a circuit
+
+    Parses the statements and keeps the registers, subclasses hold the
+    quantum state: they apply gates and primitives (permute()), h and u1,
+    and give the outcome probabilities of measurements.
+    """
+    def __init__(self, rng=None):
+        self.rng = rng or random.Random()
+        self.qregs = {}
+        self.cregs = {}
+        self.nqubits = 0
+        self.peak = 1
+        self.operations = 0
+
+    def qubits(self, arg):
+        """ Qubits of a register, or of one of its elements """
+        reg, i = element_re.match(arg.strip()).groups()
+        return self.qregs[reg] if i is None else [self.qregs[reg][int(i)]]
+
+    def clbits(self, arg):
+        reg, i = element_re.match(arg.strip()).groups()
+        return [(reg, j) for j in (range(len(self.cregs[reg])) if i is None else [int(i)])]
+
+    def run(self, statements):
+        """ Executes the statements and returns the classical registers """
+        for statement in statements:
+            self.execute(statement.rstrip(';').strip())
+        self.flush()
+        return self.cregs
+
+    def execute(self, statement):
+        if statement.startswith('measure'):
+            qubits, clbits = statement[len('measure'):].split('->')
+            self.measure(self.qubits(qubits), self.clbits(clbits))
+            return
+        creg, value, name, params, args = statement_re.match(statement).groups()
+        if name in ('qreg', 'creg'):
+            reg, size = re.match(r'(\w+)\[(\d+)\]', args).groups()
+            if name == 'qreg':
+                self.qregs[reg] = list(range(self.nqubits, self.nqubits+int(size)))
+                self.nqubits += int(size)
+            else:
+                self.cregs[reg] = [0]*int(size)
+            return
+        if creg is not None and self.creg_value(creg) != int(value):
+            return
+        args = [self.qubits(arg) for arg in args.split(',')]
+        if self.is_gate(name):
+            self.permute(name, [q for qubits in args for q in qubits])
+            return
+        # primitives applied to whole registers act on each element
+        for i in range(max(len(qubits) for qubits in args)):
+            qubits = [q[i] if len(q) > 1 else q[0] for q in args]
+            if name == 'h':
+                self.hadamard(*qubits)
+            elif name == 'u1':
+                self.phase(angle(params), *qubits)
+            elif name in parser_qasm.primitives:
+                self.permute(name, qubits)
+            else:
+                raise ValueError('unsupported operation: {}'.format(statement))
+
+    def __getstate__(self):
+        """ Pickled without the program nor the rng, see attach() """
+        return {k: v for k, v in vars(self).items() if k not in ('rng', self.program_attr)}
+
+    def attach(self, program, rng):
+        """ Gives a copied or unpickled simulator its program and rng """
+        setattr(self, self.program_attr, program)
+        self.rng = rng
+
+    def creg_value(self, creg):
+        return sum(b << i for i, b in enumerate(self.cregs[creg]))
+
+    def measure(self, qubits, clbits):
+        """ Samples the qubits and collapses the state on the outcome """
+        self.flush()
+        probs = self.probabilities(qubits)
+        r = self.rng.random()*sum(probs.values())
+        for bits, p in sorted(probs.items()):
+            r -= p
+            if r < 0:
+                break
+        self.collapse(qubits, bits, p)
+        for (reg, j), b in zip(clbits, bits):
+            self.cregs[reg][j] = b
+
+    def flush(self):
+        """ Applies the operations a subclass may have queued """
+        pass
+
+
+class SparseSimulator(Simulator):
+    """ Keeps only the basis states with a nonzero amplitude
+
+    The state maps every such basis index to its amplitude, qubit i being
+    bit i of the index. Primitives and gates (which are made of them) only
+    permute the indices, so they run on the bit-sliced gate functions of ns
+    with one lane per basis state. Only h splits states, so memory follows
+    the superposition `h yv` builds, about 2**nb states, instead of the
+    2**qubits amplitudes of a dense statevector.
+    """
+    program_attr = 'ns'
+
+    def __init__(self, ns, rng=None):
+        Simulator.__init__(self, rng)
+        self.ns = ns
+        self.state = {0: 1}
+
+    @staticmethod
+    def prepare(gates, aliases):
+        return compile_gates(gates, aliases)
+
+    def is_gate(self, name):
+        return name in self.ns
+
+    def permute(self, func, qubits):
+        """ Applies a classical gate to every basis state at once """
+        keys = list(self.state)
+        self.ns['set_lanes'](len(keys))
+        lanes = [int(''.join('1' if key >> q & 1 else '0' for key in reversed(keys)), 2)
+                 for q in qubits]
+        out = self.ns['x_b' if func == 'x' else func](*lanes)
+        if not isinstance(out, tuple):
+            out = (out,)
+        clear = ~sum(1 << q for q in qubits)
+        new_keys = [key & clear for key in keys]
+        for q, lane in zip(qubits, out):
+            for k, b in enumerate(reversed(format(lane, 'b'))):
+                if b == '1':
+                    new_keys[k] |= 1 << q
+        self.state = dict(zip(new_keys, self.state.values()))
+
+    def hadamard(self, q):
+        bit = 1 << q
+        amp = math.sqrt(0.5)
+        state = defaultdict(complex)
+        for key, a in self.state.items():
+            state[key & ~bit] += a*amp
+            state[key | bit] += -a*amp if key & bit else a*amp
+        self.state = {key: a for key, a in state.items() if abs(a) > 1e-12}
+        self.peak = max(self.peak, len(self.state))
+
+    def phase(self, angle, q):
+        bit = 1 << q
+        rotation = cmath.exp(1j*angle)
+        self.state = {key: a*rotation if key & bit else a for key, a in self.state.items()}
+
+    def probabilities(self, qubits):
+        probs = defaultdict(float)
+        for key, a in self.state.items():
+            probs[tuple(key >> q & 1 for q in qubits)] += abs(a)**2
+        return probs
+
+    def collapse(self, qubits, bits, p):
+        norm = math.sqrt(p)
+        self.state = {key: a/norm for key, a in self.state.items()
+                      if tuple(key >> q & 1 for q in qubits) == bits}
+
+
+class DenseSimulator(Simulator):
+    """ Exact statevector of every qubit, for small circuits
+
+    Primitives and gates (flattened) are classical permutations of the
+    basis states, so a run of them is composed first: self.planes holds,
+    for every qubit they touched, the packed bits of its value after the
+    run for each of the 2**nqubits basis states, and every primitive is
+    one or two bitwise operations on those arrays (a swap only exchanges
+    them). The statevector is permuted once, by a single scatter, when h,
+    u1 or a measurement needs it, and those act on strided views of it.
+    """
+    program_attr = 'gates'
+
+    def __init__(self, gates, rng=None):
+        Simulator.__init__(self, rng)
+        self.gates = gates
+        self.flat = {}
+        self.psi = None
+        self.identity = {}
+        self.planes = {}
+        self.batches = 0
+        self.elapsed = 0
+
+    @staticmethod
+    def prepare(gates, aliases):
+        table = {name: (name, params, body) for name, params, body in gates}
+        for name, kept in aliases.items():
+            table[name] = table[kept]
+        return table
+
+    def is_gate(self, name):
+        return name in self.gates
+
+    def state(self):
+        """ The statevector, allocated on first use """
+        if self.psi is None:
+            self.psi = np.zeros(2**self.nqubits, dtype=complex)
+            self.psi[0] = 1
+            self.peak = self.psi.size
+        return self.psi
+
+    def identity_plane(self, q):
+        """ Packed bits of qubit q in every basis state """
+        if q not in self.identity:
+            if q < 3 or self.nqubits < 3:
+                bits = np.arange(2**self.nqubits) >> q & 1
+                self.identity[q] = np.packbits(bits.astype(np.uint8), bitorder='little')
+            else:
+                # runs of 2**(q-3) bytes of zeros then ones
+                run = np.repeat(np.array([0, 255], dtype=np.uint8), 2**(q-3))
+                self.identity[q] = np.tile(run, 2**(self.nqubits-q-1))
+        return self.identity[q]
+
+    def plane(self, q):
+        """ Packed bits of qubit q for every basis state after the run """
+        if q in self.planes:
+            return self.planes[q]
+        return self.identity_plane(q)
+
+    def target(self, q):
+        """ plane(q), copied first if the run did not change it yet """
+        if q not in self.planes:
+            self.planes[q] = self.plane(q).copy()
+        return self.planes[q]
+
+    def permute(self, func, qubits):
+        if func not in parser_qasm.primitives:
+            if func not in self.flat:
+                self.flat[func] = parser_qasm.flatten(list(self.gates.values()),
+                                                      self.gates[func][0])
+            for op, wires in self.flat[func]:
+                self.permute(op, [qubits[w] for w in wires])
+            return
+        start = time.time()
+        self.state()
+        if func == 'swap':
+            a, b = qubits
+            self.planes[a], self.planes[b] = self.target(b), self.target(a)
+        elif func == 'cswap':
+            c, a, b = qubits
+            t = np.bitwise_xor(self.plane(a), self.plane(b))
+            np.bitwise_and(t, self.plane(c), out=t)
+            np.bitwise_xor(self.target(a), t, out=self.planes[a])
+            np.bitwise_xor(self.target(b), t, out=self.planes[b])
+        elif func == 'x':
+            np.invert(self.target(qubits[0]), out=self.planes[qubits[0]])
+        elif func == 'cx':
+            c, t = qubits
+            np.bitwise_xor(self.target(t), self.plane(c), out=self.planes[t])
+        else:
+            a, b, t = qubits
+            np.bitwise_xor(self.target(t), np.bitwise_and(self.plane(a), self.plane(b)),
+                           out=self.planes[t])
+        self.operations += 1
+        self.elapsed += time.time() - start
+
+    def flush(self):
+        """ Moves every amplitude to the basis state the run sends it to """
+        if not self.planes:
+            return
+        start = time.time()
+        size = self.psi.size
+        dest = np.arange(size, dtype=np.int64)
+        shifted = np.empty(size, dtype=np.int64)
+        for q, plane in self.planes.items():
+            moved = np.unpackbits(np.bitwise_xor(plane, self.identity_plane(q)),
+                                  count=size, bitorder='little')
+            np.left_shift(moved, q, out=shifted, dtype=np.int64)
+            np.bitwise_xor(dest, shifted, out=dest)
+        self.planes = {}
+        psi = np.empty_like(self.psi)
+        psi[dest] = self.psi
+        self.psi = psi
+        self.batches += 1
+        self.elapsed += time.time() - start
+
+    def qubit_view(self, q):
+        """ The state with axis 1 being the value of qubit q """
+        self.flush()
+        return self.state().reshape(-1, 2, 2**q)
+
+    def hadamard(self, q):
+        start = time.time()
+        psi = self.qubit_view(q)
+        zero = psi[:, 0].copy()
+        one = psi[:, 1]
+        psi[:, 0] += one
+        np.subtract(zero, one, out=one)
+        psi *= math.sqrt(0.5)
+        self.operations += 1
+        self.elapsed += time.time() - start
+
+    def phase(self, angle, q):
+        start = time.time()
+        self.qubit_view(q)[:, 1] *= cmath.exp(1j*angle)
+        self.operations += 1
+        self.elapsed += time.time() - start
+
+    def blocked(self, qubits):
+        """ The state reshaped into one axis per qubit of qubits and one per
+        run of qubits between them, and a function giving the index of the
+        strided view where those qubits hold the local state s """
+        shape = []
+        axes = {}
+        top = self.nqubits
+        for q in sorted(qubits, reverse=True):
+            shape.append(2**(top-q-1))
+            axes[q] = len(shape)
+            shape.append(2)
+            top = q
+        shape.append(2**top)
+        psi = self.state().reshape(shape)
+        def index(s):
+            i = [slice(None)]*len(shape)
+            for k, q in enumerate(qubits):
+                i[axes[q]] = s >> k & 1
+            return tuple(i)
+        return psi, index
+
+    def probabilities(self, qubits):
+        psi, index = self.blocked(qubits)
+        probs = {}
+        for s in range(2**len(qubits)):
+            p = float(np.vdot(psi[index(s)], psi[index(s)]).real)
+            if p > 1e-15:
+                probs[tuple(s >> k & 1 for k in range(len(qubits)))] = p
+        return probs
+
+    def collapse(self, qubits, bits, p):
+        psi, index = self.blocked(qubits)
+        s = sum(b << k for k, b in enumerate(bits))
+        kept = psi[index(s)].copy()
+        psi[...] = 0
+        psi[index(s)] = kept/math.sqrt(p)
+
+
+class PartialEvaluator(Simulator):
+    """ Rewrites the main program for the qubits' classically known values
+
+    Every qubit starts known at 0. Gates and primitives are flattened and
+    go through parser_qasm.partial_eval(), h makes its qubits unknown, and
+    the other statements (u1, measurements and conditional operations,
+    which may not run) are kept as they are. residual() gives the
+    resulting program: each run of residual primitives becomes a new gate
+    (partial0, partial1, ...) called on the qubits it acts upon, so the
+    simulators still run it in one call.
+    """
+    program_attr = 'gates'
+
+    def __init__(self, gates):
+        Simulator.__init__(self)
+        self.gates = gates
+        self.known = {}
+        self.ops = []
+        self.statements = []
+        self.residual_gates = []
+
+    def is_gate(self, name):
+        return name in self.gates
+
+    def residual(self, statements):
+        """ Gates (as in parser_qasm.read_gates()) and main statements """
+        self.run(statements)
+        return self.residual_gates, self.statements
+
+    def execute(self, statement):
+        creg, _, name, _, args = statement_re.match(statement).groups()
+        if name == 'qreg':
+            first = self.nqubits
+            Simulator.execute(self, statement)
+            self.known.update((q, 0) for q in range(first, self.nqubits))
+        elif name == 'creg':
+            Simulator.execute(self, statement)
+        elif creg is None and name not in ('h', 'u1', 'measure'):
+            Simulator.execute(self, statement)
+            return
+        self.flush()
+        if name in ('h',) or creg is not None and name != 'u1':
+            for arg in args.split(','):
+                for q in self.qubits(arg):
+                    self.known.pop(q, None)
+        self.statements.append(statement + ';')
+
+    def permute(self, func, qubits):
+        if func in parser_qasm.primitives:
+            self.ops.append((func, qubits))
+            return
+        for op, wires in parser_qasm.flatten(list(self.gates.values()), self.gates[func][0]):
+            self.ops.append((op, [qubits[w] for w in wires]))
+
+    def flush(self):
+        ops = parser_qasm.partial_eval(self.ops, self.known)
+        self.ops = []
+        if not ops:
+            return
+        element = {q: '{}[{}]'.format(reg, i) for reg, qubits in self.qregs.items()
+                   for i, q in enumerate(qubits)}
+        qubits = sorted({w for _, wires in ops for w in wires})
+        name = 'partial{}'.format(len(self.residual_gates))
+        self.residual_gates.append((name, ['q{}'.format(q) for q in qubits],
+                                    [(func, ['q{}'.format(w) for w in wires])
+                                     for func, wires in ops]))
+        self.statements.append('{} {};'.format(name, ','.join(element[q] for q in qubits)))
+
+
+backends = {'sparse': SparseSimulator, 'dense': DenseSimulator}
+
+
+def counts_key(cregs):
+    """ Classical registers as in qiskit's get_counts(): last declared
+    first, most significant bit first """
+    return ' '.join(''.join(str(b) for b in reversed(bits))
+                    for bits in reversed(list(cregs.values())))
+
+
+def read_qasm(path):
+    with (gzip.open(path, 'rt') if path.endswith('.gz') else open(path)) as f:
+        return f.read()
+
+
+def read_program(code, partial=False):
+    """ Gates, aliases and main statements of a QASM program, rewritten by
+    PartialEvaluator with partial """
+    _, gates, aliases = parser_qasm.read_gates(io.StringIO(code))
+    statements = estimate.main_statements(code)
+    if partial:
+        evaluator = PartialEvaluator(DenseSimulator.prepare(gates, aliases))
+        (gates, statements), aliases = evaluator.residual(statements), {}
+    return gates, aliases, statements
+
+
+def load(code, backend, partial=False):
+    """ Program of a backend and main statements of a QASM program, see
+    read_program() """
+    gates, aliases, statements = read_program(code, partial)
+    return backends[backend].prepare(gates, aliases), statements
+
+
+def called_gates(gates, aliases, statements):
+    """ The gates and aliases statements use, directly or not """
+    table = {name: body for name, _, body in gates}
+    used = set()
+    pending = [statement_re.match(statement.rstrip(';').strip()).group(3)
+               for statement in statements]
+    while pending:
+        name = pending.pop()
+        if name in used or aliases.get(name, name) not in table:
+            continue
+        used.add(name)
+        name = aliases.get(name, name)
+        used.add(name)
+        pending.extend(func for func, _ in table[name])
+    return ([gate for gate in gates if gate[0] in used],
+            {name: kept for name, kept in aliases.items() if name in used})
+
+
+def simulate(code, shots=1, seed=None, backend='sparse', partial=False):
+    """ Counts of the outcomes of shots runs of a QASM program, keyed as
+    in counts_key(), and the simulator of the last run """
+    cls = backends[backend]
+    program, statements = load(code, backend, partial)
+    rng = random.Random(seed)
+    counts = Counter()
+    for _ in range(shots):
+        simulator = cls(program, rng)
+        counts[counts_key(simulator.run(statements))] += 1
+    return counts, simulator
+
+
+sample_shared = {}
+
+def sample_init(backend, gates, aliases, simulator, statements):
+    """ Shares the state before the measurements, and the program of the
+    gates statements, the measurements and what follows them, call """
+    sample_shared.update(program=backends[backend].prepare(gates, aliases),
+                         simulator=simulator, statements=statements)
+
+def sample_job(job):
+    """ Counts of shots measurement trajectories from the shared state """
+    seed, shots = job
+    rng = random.Random(seed)
+    counts = Counter()
+    for _ in range(shots):
+        simulator = copy.deepcopy(sample_shared['simulator'])
+        simulator.attach(sample_shared['program'], rng)
+        counts[counts_key(simulator.run(sample_shared['statements']))] += 1
+    return counts
+
+
+def sample(code, shots, seed=None, backend='sparse', workers=None, chunk=64, partial=False):
+    """ Same as simulate(), but everything before the first measurement
+    runs only once: the measurements and what follows them (the
+    semiclassical inverse QFT) are drawn from that state in a process pool.
+
+    Shots go in chunks of chunk, each seeded from seed and its index, so the
+    counts only depend on seed, not on the number of workers. Returns the
+    counts and the simulator holding the shared state.
+    """
+    cls = backends[backend]
+    gates, aliases, statements = read_program(code, partial)
+    first = next((i for i, statement in enumerate(statements)
+                  if statement.startswith('measure')), len(statements))
+    shared = cls(cls.prepare(gates, aliases), None)
+    shared.run(statements[:first])
+    tail = statements[first:]
+    jobs = [(None if seed is None else '{}-{}'.format(seed, i), min(chunk, shots-start))
+            for i, start in enumerate(range(0, shots, chunk))]
+    counts = Counter()
+    # workers only get the gates of the tail, usually none
+    with ProcessPoolExecutor(workers, initializer=sample_init,
+                             initargs=(backend,) + called_gates(gates, aliases, tail)
+                                      + (shared, tail)) as executor:
+        for job_counts in executor.map(sample_job, jobs):
+            counts.update(job_counts)
+    return counts, shared
+
+
+def print_histogram(counts, width=50):
+    if not counts:
+        print('no shots')
+        return
+    top = max(counts.values())
+    for key, count in counts.most_common():
+        print('{}  {:>8}  {}'.format(key, count, '#'*max(1, count*width//top)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulates a circuit without qiskit')
+    parser.add_argument('qasm',help='QASM file generated by synth.py (may be gzipped)')
+    parser.add_argument('--shots',type=int,default=1,help='Number of runs')
+    parser.add_argument('--seed',type=int,default=None,help='Seed of the measurements')
+    parser.add_argument('--backend',default='sparse',choices=sorted(backends),
+                        help='sparse: nonzero basis states only, dense: exact statevector '
+                             '(small circuits)')
+    parser.add_argument('--sample',default=False,const=True,action='store_const',
+                        help='Run up to the first measurement once and sample the shots from there '
+                             'in a process pool')
+    parser.add_argument('--workers',type=int,default=None,help='Worker processes of --sample')
+    parser.add_argument('--partial',default=False,const=True,action='store_const',
+                        help='Propagate the classically known qubits through the main program '
+                             'first and run the residual primitives')
+
+    args = parser.parse_args()
+
+    start = time.time()
+    if args.sample:
+        counts, simulator = sample(read_qasm(args.qasm), args.shots, args.seed, args.backend,
+                                   args.workers, partial=args.partial)
+        print_histogram(counts)
+    else:
+        counts, simulator = simulate(read_qasm(args.qasm), args.shots, args.seed, args.backend,
+                                     args.partial)
+        print(dict(counts))
+    print('at most {} amplitudes, simulated in {:.1f} s'.format(simulator.peak,
+                                                               time.time() - start))
+    if args.backend == 'dense':
+        print('{} operations in {} permutation batches, {:.0f} gates/s'.format(
+                    simulator.operations, simulator.batches,
+                    simulator.operations/max(simulator.elapsed, 1e-9)))
@@ -1,16 +1,109 @@
+import os
+import re
 import sys
+import gzip
+import copy
+import pickle
+import hashlib
+import functools
 import argparse
+import threading
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 
-qasm_code = ["""
+import parser_qasm
+
+qasm_header = """
 include "qelib1.inc";
-"""]
+"""
+
+active = threading.local()
 
+with open(__file__, 'rb') as f:
+    SYNTH_VERSION = hashlib.sha256(f.read()).hexdigest()[:16]
 
-gates_declared = set()
 
 
 
+class Gate:
+    """ Gate definition
+
+    params is a list of wire names or (register, size) pairs, the latter
+    expanding to register0 ... register{size-1}. Operations are stored as
+    (gate name, wires) with wires being indices into self.params, and
+    QASM text is only produced by qasm() (and kept, so a gate must not be
+    changed once rendered).
+    """
+    def __init__(self, name, params):
+        self.name = name
+        self.params = []
+        self.regs = []
+        for p in params:
+            if isinstance(p, tuple):
+                reg, n = p
+                start = len(self.params)
+                self.regs.append(list(range(start, start+n)))
+                self.params.extend('{}{}'.format(reg, i) for i in range(n))
+            else:
+                self.regs.append(len(self.params))
+                self.params.append(p)
+        self.ops = []
+        self.src = None
+
+    def op(self, name, *args):
+        """ Appends an operation, args are wire indices or lists of them """
+        wires = []
+        for arg in args:
+            if isinstance(arg, list):
+                wires.extend(arg)
+            else:
+                wires.append(arg)
+        self.ops.append((name, tuple(wires)))
+
+    def qasm(self):
+        if self.src is not None:
+            return self.src
+        params = self.params
+        src = ['gate {} {}'.format(self.name, ','.join(params)), '{']
+        param = params.__getitem__
+        for name, wires in self.ops:
+            src.append('  ' + name + ' ' + ','.join(map(param, wires)) + ';')
+        src.append('}')
+        self.src = src
+        return src
+
+    @classmethod
+    def from_rendered(cls, name, params, src):
+        """ Gate loaded rendered from a GateCache, its ops are only parsed
+        from src if a pass needs them """
+        gate = cls.__new__(cls)
+        gate.name = name
+        gate.params = params
+        gate.src = src
+        return gate
+
+    def __getattr__(self, attr):
+        if attr != 'ops' or self.__dict__.get('src') is None:
+            raise AttributeError(attr)
+        index = {p: i for i, p in enumerate(self.params)}
+        self.ops = []
+        for line in self.src[2:-1]:
+            name, args = line.split()
+            self.ops.append((name, tuple(index[a] for a in args[:-1].split(','))))
+        return self.ops
+
+    def calls(self):
+        """ Names of the gates used by this one """
+        return {name for name, _ in self.ops}
+
+    def with_ops(self, ops):
+        """ Copy of this gate with another list of operations """
+        gate = copy.copy(self)
+        gate.ops = ops
+        gate.src = None
+        return gate
+
 
 class declare:
     class AlreadyDeclared(Exception):
@@ -24,27 +117,300 @@ class declare:
 
     def __init__(self, name, params):
         self.name = name
-        self.src = [
-            'gate {name} {params}'.format(name=name, params=params),
-            '{'
-        ]
+        self.params = params
 
     def __enter__(self):
-        self.already_declared = self.name in gates_declared
+        self.synthesizer = current()
+        traces = self.synthesizer.traces
+        if traces:
+            traces.append([])
+        self.already_declared = self.name in self.synthesizer.gates_declared
         if self.already_declared:
             return self.Bomb(self.AlreadyDeclared)
-        gates_declared.add(self.name)
-        return self.src
+        self.synthesizer.gates_declared.add(self.name)
+        self.gate = self.synthesizer.gate_class(self.name, self.params)
+        return self.gate
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        traces = self.synthesizer.traces
+        if traces:
+            inner = traces.pop()
+            traces[-1].append(('gate', self.name, inner))
         if self.already_declared or exc_type == self.AlreadyDeclared:
             return True
-        self.src.append('}')
-        qasm_code.extend(self.src)
-
-
-def arg_list(name, n):
-    return ','.join('{}{}'.format(name, i) for i in range(n))
+        self.synthesizer.add_gate(self.gate)
+
+
+class GateCache:
+    """ Size bounded LRU cache of synthesized gates on disk
+
+    A @cached generator stores, in one file under its name and arguments,
+    the trace of its call (see cached()) and the QASM text of the gates it
+    declared with their parameters, so a hit neither runs the generator
+    nor renders its gates again. Keys include SYNTH_VERSION so editing
+    synth.py invalidates the whole cache. Least recently used files are
+    evicted once the cache grows past max_bytes.
+    """
+    def __init__(self, path=None, max_bytes=2**30):
+        if path is None:
+            path = os.path.join(os.environ.get('XDG_CACHE_HOME',
+                                               os.path.expanduser('~/.cache')),
+                                'bletchley_synth')
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def file(self, kind, key):
+        digest = hashlib.sha256(repr((SYNTH_VERSION, kind, key)).encode()).hexdigest()
+        return os.path.join(self.path, digest + '.pickle')
+
+    def load(self, kind, key):
+        """ Stored value, or None when missing or unreadable """
+        path = self.file(kind, key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path)
+        except Exception:
+            return None
+        return value
+
+    def store(self, kind, key, value):
+        path = self.file(kind, key)
+        # other processes may be reading the same cache
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def evict(self):
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.pickle'):
+                st = entry.stat()
+                files.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+cached_generators = {}
+
+def cached(generator):
+    """ Serves generator(*args) from the running synthesizer's GateCache
+
+    A run records its trace: the gates it declares (or finds declared) and
+    the @cached generators it calls, in order, each gate with what was
+    called while building it. A cache hit replays the trace, declaring
+    only the missing gates, so gates come out in the same order as without
+    the cache whatever was declared before. Without a cache a generator
+    still runs once per synthesizer and arguments, later calls would only
+    find its gates declared.
+    """
+    @functools.wraps(generator)
+    def wrapper(*args):
+        synthesizer = current()
+        cache = synthesizer.cache
+        key = (generator.__name__, args, synthesizer.adder)
+        if synthesizer.traces:
+            synthesizer.traces[-1].append(('call', key))
+        if key in synthesizer.generated:
+            return
+        synthesizer.generated.add(key)
+        if cache is None:
+            return generator(*args)
+
+        stored = cache.load('generator', key)
+        if stored is not None:
+            replay(synthesizer, *stored)
+            return
+
+        synthesizer.traces.append([])
+        try:
+            generator(*args)
+        finally:
+            trace = synthesizer.traces.pop()
+        table = {gate.name: gate for gate in synthesizer.gates}
+        rendered = {name: (table[name].params, table[name].qasm())
+                    for name in traced_gates(trace)}
+        cache.store('generator', key, (trace, rendered))
+    cached_generators[generator.__name__] = wrapper
+    return wrapper
+
+
+def traced_gates(trace):
+    """ Names of the gates of a trace, not those of the generators it calls """
+    for event in trace:
+        if event[0] == 'gate':
+            yield from traced_gates(event[2])
+            yield event[1]
+
+
+def replay(synthesizer, trace, rendered):
+    """ Declares the rendered gates of a cached generator trace as running
+    it would """
+    def run(trace):
+        for event in trace:
+            if event[0] == 'call':
+                name, args, _ = event[1]
+                cached_generators[name](*args)
+            elif event[1] not in synthesizer.gates_declared:
+                synthesizer.gates_declared.add(event[1])
+                run(event[2])
+                synthesizer.add_gate(Gate.from_rendered(event[1], *rendered[event[1]]))
+    # replayed calls are not part of the trace of an enclosing run
+    traces, synthesizer.traces = synthesizer.traces, []
+    try:
+        run(trace)
+    finally:
+        synthesizer.traces = traces
+
+
+def used_gates(table, names):
+    """ Names of the gates in table that names use, directly or not """
+    used = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name in used or name not in table:
+            continue
+        used.add(name)
+        pending.extend(table[name].calls())
+    return used
+
+
+def prune_gates(gates, main_code):
+    """ Drops the gates the main program never uses, even indirectly
+
+    Returns the kept gates and the dropped ones.
+    """
+    table = {gate.name: gate for gate in gates}
+    used = used_gates(table, identifier.findall(main_code))
+    kept = [gate for gate in gates if gate.name in used]
+    dropped = [gate for gate in gates if gate.name not in used]
+    return kept, dropped
+
+
+def dedup_gates(gates):
+    """ Merges structurally identical gates
+
+    Two gates are identical when they have as many parameters and the same
+    operations on the same parameter positions, once the gates they call
+    are merged (so gates must come in declaration order). Returns the
+    remaining gates and a dict mapping every dropped name to the kept one.
+    """
+    aliases = {}
+    seen = {}
+    kept = []
+    for gate in gates:
+        ops = [(aliases.get(name, name), wires) for name, wires in gate.ops]
+        key = (len(gate.params), tuple(ops))
+        if key in seen:
+            aliases[gate.name] = seen[key]
+            continue
+        seen[key] = gate.name
+        if ops != gate.ops:
+            gate = gate.with_ops(ops)
+        kept.append(gate)
+    return kept, aliases
+
+
+def inverse_gates(gates):
+    """ Maps every gate whose inverse is in gates (or a primitive) to it
+
+    The inverse of a gate has the reversed operations, each replaced by its
+    inverse, on the same parameter positions (gates in declaration order).
+    """
+    inverse = dict(parser_qasm.self_inverse)
+    bodies = {}
+    for gate in gates:
+        bodies.setdefault((len(gate.params), tuple(gate.ops)), gate.name)
+    for gate in gates:
+        if all(name in inverse for name, _ in gate.ops):
+            ops = tuple((inverse[name], wires) for name, wires in reversed(gate.ops))
+            if (len(gate.params), ops) in bodies:
+                inverse[gate.name] = bodies[len(gate.params), ops]
+    return inverse
+
+
+def peephole_gates(gates):
+    """ Runs parser_qasm.peephole_ops() over every gate body, in declaration order
+
+    Calls to gates left empty are dropped from the gates using them.
+    Returns the new gates and the number of operations removed.
+    """
+    inverse = inverse_gates(gates)
+    empty = set()
+    kept = []
+    removed = 0
+    for gate in gates:
+        ops = parser_qasm.peephole_ops(gate.ops, inverse, empty)
+        if not ops:
+            empty.add(gate.name)
+        if ops != gate.ops:
+            removed += len(gate.ops) - len(ops)
+            gate = gate.with_ops(ops)
+        kept.append(gate)
+    return kept, removed
+
+
+def relabel_gates(gates):
+    """ Absorbs uncontrolled swaps into a relabeling of the wires
+
+    Swaps are not emitted, the operations after them just use the wires
+    the values moved to. The same goes for calls to gates leaving their
+    wires permuted: a gate whose body ends permuted becomes name_v, which
+    leaves them so, and name, which calls name_v and swaps the wires back,
+    so a fixed layout is only restored where a gate is called from the
+    outside (main program, tests). Gates must be in declaration order.
+    """
+    moved = {}
+    kept = []
+    for gate in gates:
+        n = len(gate.params)
+        where = list(range(n))
+        ops = []
+        for name, wires in gate.ops:
+            phys = tuple(where[w] for w in wires)
+            if name == 'swap':
+                a, b = wires
+                where[a], where[b] = where[b], where[a]
+                continue
+            if name in moved:
+                name, perm = moved[name]
+                to = {p: phys[perm[i]] for i, p in enumerate(phys)}
+                where = [to.get(p, p) for p in where]
+            if name is not None:
+                ops.append((name, phys))
+
+        if where == list(range(n)):
+            kept.append(gate.with_ops(ops) if ops != gate.ops else gate)
+            continue
+
+        restore = []
+        held = {p: w for w, p in enumerate(where)}
+        perm = list(where)
+        for w in range(n):
+            p = where[w]
+            if p != w:
+                restore.append(('swap', (w, p)))
+                other = held[w]
+                where[other], held[p] = p, other
+                where[w], held[w] = w, w
+
+        virtual = gate.with_ops(ops)
+        virtual.name = gate.name + '_v'
+        moved[gate.name] = (virtual.name if ops else None, perm)
+        kept.append(virtual)
+        kept.append(gate.with_ops(([(virtual.name, tuple(range(n)))] if ops else [])
+                                  + restore))
+    return kept
 
 
 def arg_vec(name, n):
@@ -52,377 +418,457 @@ def arg_vec(name, n):
 
 
 def maj():
-    with declare('maj', 'c,b,a') as src:
-        src.extend([
-            '  cx a,b;',
-            '  cx a,c;',
-            '  ccx b,c,a;',
-        ])
+    with declare('maj', ['c', 'b', 'a']) as gate:
+        c, b, a = gate.regs
+        gate.op('cx', a, b)
+        gate.op('cx', a, c)
+        gate.op('ccx', b, c, a)
 
 
 def ums():
-    with declare('ums', 'c,s,a') as src:
-        src.extend([
-            '  ccx s,c,a;',
-            '  cx a,c;',
-            '  cx c,s;',
-        ])
+    with declare('ums', ['c', 's', 'a']) as gate:
+        c, s, a = gate.regs
+        gate.op('ccx', s, c, a)
+        gate.op('cx', a, c)
+        gate.op('cx', c, s)
 
 
 def umj():
-    with declare('umj', 'c,b,a') as src:
-        src.extend([
-            '  ccx b,c,a;',
-            '  cx a,c;',
-            '  cx a,b;',
-        ])
+    with declare('umj', ['c', 'b', 'a']) as gate:
+        c, b, a = gate.regs
+        gate.op('ccx', b, c, a)
+        gate.op('cx', a, c)
+        gate.op('cx', a, b)
 
 def cuj():
-    with declare('cuj', 'c,b,a,x') as src:
-        src.extend([
-            '  ccx b,c,a;',
-            '  cx a,c;',
-            '  ccx x,a,b;',
-        ])
+    with declare('cuj', ['c', 'b', 'a', 'x']) as gate:
+        c, b, a, x = gate.regs
+        gate.op('ccx', b, c, a)
+        gate.op('cx', a, c)
+        gate.op('ccx', x, a, b)
 
 
 def cmj():
-    with declare('cmj', 'c,b,a,x') as src:
-        src.extend([
-            '  ccx x,a,b;',
-            '  cx a,c;',
-            '  ccx b,c,a;',
-        ])
+    with declare('cmj', ['c', 'b', 'a', 'x']) as gate:
+        c, b, a, x = gate.regs
+        gate.op('ccx', x, a, b)
+        gate.op('cx', a, c)
+        gate.op('ccx', b, c, a)
 
 
 def cus():
-    with declare('cus', 'c,s,a,x') as src:
-        src.extend([
-            '  ccx s,c,a;',
-            '  cx a,c;',
-            '  ccx x,c,s;',
-        ])
-
-
-
-
+    with declare('cus', ['c', 's', 'a', 'x']) as gate:
+        c, s, a, x = gate.regs
+        gate.op('ccx', s, c, a)
+        gate.op('cx', a, c)
+        gate.op('ccx', x, c, s)
+
+
+
+
+
+
+adders = ('cdkm', 'lookahead')
+
+def adder_scratch(n):
+    """ Zero ancillas the adders of width up to n need (none for cdkm) """
+    if current().adder == 'cdkm':
+        return 0
+    return n + lookahead_tree_size(n)
+
+
+def lookahead_tree_size(k):
+    """ Ancillas of lookahead_carries() for k carries """
+    size = 0
+    d = 1
+    while 2*d <= k:
+        size += len(range(4*d-1, k, 2*d))
+        d *= 2
+    return size
+
+
+def lookahead_carries(a, b, cin, c, tree, k):
+    """ Operations leaving a^b in b and in c[i] the carry out of bit i of
+    a + b + cin, for i < k, in O(log k) depth
+
+    Generates go to c and are combined by a Brent-Kung prefix tree, the
+    propagates of its blocks being computed into tree and cleared again.
+    """
+    ops = [('ccx', [a[i], b[i], c[i]]) for i in range(k)]
+    ops += [('cx', [a[i], b[i]]) for i in range(len(a))]
+    if k:
+        ops.append(('ccx', [b[0], cin, c[0]]))
+    prop = {(i, i): b[i] for i in range(k)}
+    props = []
+    free = iter(tree)
+    d = 1
+    while 2*d <= k:
+        for i in range(2*d-1, k, 2*d):
+            ops.append(('ccx', [prop[i-d+1, i], c[i-d], c[i]]))
+            if i-2*d+1 > 0:
+                prop[i-2*d+1, i] = next(free)
+                props.append(('ccx', [prop[i-2*d+1, i-d], prop[i-d+1, i], prop[i-2*d+1, i]]))
+                ops.append(props[-1])
+        d *= 2
+    while d > 1:
+        d //= 2
+        for i in range(3*d-1, k, 2*d):
+            ops.append(('ccx', [prop[i-d+1, i], c[i-d], c[i]]))
+    return ops + props[::-1]
+
+
+def lookahead_restore(gate, a, b, carries, x=None):
+    """ Clears the carries once b holds the sum (when x is on)
+
+    The carries of a + b + cin are those of a + ~sum + cin, so they are
+    uncomputed by running lookahead_carries() backwards on ~sum.
+    """
+    for i in range(len(b)):
+        if x is None:
+            gate.op('x', b[i])
+            gate.op('cx', a[i], b[i])
+        else:
+            gate.op('cx', x, b[i])
+            gate.op('ccx', x, a[i], b[i])
+    for op in reversed(carries):
+        gate.op(*op)
+    for i in range(len(b)):
+        if x is None:
+            gate.op('x', b[i])
+        else:
+            gate.op('cx', x, b[i])
 
 
+def lookahead_add(n):
+    with declare('add{}'.format(n),
+                 [('b',n), 'cin', ('a',n), ('cla',adder_scratch(n))]) as gate:
+        b, cin, a, cla = gate.regs
+        carries = lookahead_carries(a, b, cin, cla[:n], cla[n:], n-1)
+        for op in carries:
+            gate.op(*op)
+        for i in range(1, n):
+            gate.op('cx', cla[i-1], b[i])
+        gate.op('cx', cin, b[0])
+        lookahead_restore(gate, a, b, carries)
+
+
+def lookahead_addc(n):
+    with declare('addc{}'.format(n),
+                 ['cout', ('b',n), 'cin', ('a',n), ('cla',adder_scratch(n))]) as gate:
+        cout, b, cin, a, cla = gate.regs
+        carries = lookahead_carries(a, b, cin, cla[:n], cla[n:], n-1)
+        for op in carries:
+            gate.op(*op)
+        # same cout as the CDKM adder, whose a[n-2] ends as c ^ a[n-1]
+        gate.op('cx', cla[n-2], cout)
+        gate.op('cx', a[n-1], cout)
+        for i in range(1, n):
+            gate.op('cx', cla[i-1], b[i])
+        gate.op('cx', cin, b[0])
+        lookahead_restore(gate, a, b, carries)
+
+
+def lookahead_cmb(n, controlled):
+    """ cmb, or ccmb which compares a + (b if x else a^b) + cin like cmj """
+    params = ['cout', ('b',n), 'cin', ('a',n)] + (['x'] if controlled else [])
+    with declare(('ccmb{}' if controlled else 'cmb{}').format(n),
+                 params + [('cla',adder_scratch(n))]) as gate:
+        cout, b, cin, a = gate.regs[:4]
+        cla = gate.regs[-1]
+        carries = lookahead_carries(a, b, cin, cla[:n], cla[n:], n)
+        flip = []
+        if controlled:
+            x = gate.regs[4]
+            flip = [('x', [x])] + [('ccx', [x, a[i], b[i]]) for i in range(n)] + [('x', [x])]
+        for op in flip + carries:
+            gate.op(*op)
+        gate.op('cx', cla[n-1], cout)
+        for op in carries[::-1] + flip:
+            gate.op(*op)
+
+
+def lookahead_cadd(n, carry_out):
+    """ cadd, or caddc (whose cout is the one of caddc's CDKM version,
+    which compares like ccmb) """
+    params = [('b',n), 'cin', ('a',n), 'x']
+    with declare(('caddc{}' if carry_out else 'cadd{}').format(n),
+                 (['cout'] if carry_out else []) + params + [('cla',adder_scratch(n))]) as gate:
+        b, cin, a, x, cla = gate.regs[-5:]
+        if carry_out:
+            cout = gate.regs[0]
+            flip = [('x', [x])] + [('ccx', [x, a[i], b[i]]) for i in range(n)] + [('x', [x])]
+            carries = lookahead_carries(a, b, cin, cla[:n], cla[n:], n-1)
+            for op in flip + carries:
+                gate.op(*op)
+            gate.op('cx', cla[n-2], cout)
+            gate.op('cx', a[n-1], cout)
+            for op in carries[::-1] + flip:
+                gate.op(*op)
+        carries = lookahead_carries(a, b, cin, cla[:n], cla[n:], n-1)
+        for op in carries:
+            gate.op(*op)
+        for i in range(1, n):
+            gate.op('ccx', x, cla[i-1], b[i])
+        gate.op('ccx', x, cin, b[0])
+        lookahead_restore(gate, a, b, carries, x)
+
+
+@cached
 def add(n):
     """ CDKM adder without carry output """
+    if current().adder == 'lookahead':
+        return lookahead_add(n)
     maj()
     ums()
-    with declare('add{}'.format(n),
-                 '{b},cin,{a}'.format(b=arg_list('b',n),
-                                      a=arg_list('a',n))) as src:
+    with declare('add{}'.format(n), [('b',n), 'cin', ('a',n)]) as gate:
+        b, cin, a = gate.regs
         for i in range(n):
-            cin = 'cin' if i == 0 else 'a{}'.format(i - 1)
-            src.append('  maj {},b{},a{};'.format(cin, i, i))
+            c = cin if i == 0 else a[i-1]
+            gate.op('maj', c, b[i], a[i])
         for i in range(n-1, -1, -1):
-            cin = 'cin' if i == 0 else 'a{}'.format(i - 1)
-            src.append('  ums {},b{},a{};'.format(cin, i, i))
+            c = cin if i == 0 else a[i-1]
+            gate.op('ums', c, b[i], a[i])
 
 
 
+@cached
 def addc(n):
     """ CDKM adder with carry output """
+    if current().adder == 'lookahead':
+        return lookahead_addc(n)
     maj()
     ums()
     with declare('addc{}'.format(n),
-                 'cout,{b},cin,{a}'.format(b=arg_list('b',n),
-                                           a=arg_list('a',n))) as src:
+                 ['cout', ('b',n), 'cin', ('a',n)]) as gate:
+        cout, b, cin, a = gate.regs
         for i in range(n):
-            cin = 'cin' if i == 0 else 'a{}'.format(i - 1)
-            src.append('  maj {},b{},a{};'.format(cin, i, i))
-        src.append('  cx a{},cout;'.format(n-2))
+            c = cin if i == 0 else a[i-1]
+            gate.op('maj', c, b[i], a[i])
+        gate.op('cx', a[n-2], cout)
         for i in range(n-1, -1, -1):
-            cin = 'cin' if i == 0 else 'a{}'.format(i - 1)
-            src.append('  ums {},b{},a{};'.format(cin, i, i))
+            c = cin if i == 0 else a[i-1]
+            gate.op('ums', c, b[i], a[i])
 
 
+@cached
 def cmb(n):
+    if current().adder == 'lookahead':
+        return lookahead_cmb(n, False)
     maj()
     umj()
     """ Comparator base block (just like addc but only changes cout) """
     with declare('cmb{}'.format(n),
-                 'cout,{b},cin,{a}'.format(b=arg_list('b',n),
-                                           a=arg_list('a',n))) as src:
+                 ['cout', ('b',n), 'cin', ('a',n)]) as gate:
+        cout, b, cin, a = gate.regs
         for i in range(n):
-            cin = 'cin' if i == 0 else 'a{}'.format(i - 1)
-            src.append('  maj {},b{},a{};'.format(cin, i, i))
-        src.append('  cx a{},cout;'.format(n-1))
+            c = cin if i == 0 else a[i-1]
+            gate.op('maj', c, b[i], a[i])
+        gate.op('cx', a[n-1], cout)
         for i in range(n-1, -1, -1):
-            cin = 'cin' if i == 0 else 'a{}'.format(i - 1)
-            src.append('  umj {},b{},a{};'.format(cin, i, i))
+            c = cin if i == 0 else a[i-1]
+            gate.op('umj', c, b[i], a[i])
 
+@cached
 def ccmb(n):
+    if current().adder == 'lookahead':
+        return lookahead_cmb(n, True)
     cmj()
     cuj()
     """ Comparator base block (just like addc but only changes cout) """
     with declare('ccmb{}'.format(n),
-                 'cout,{b},cin,{a},x'.format(b=arg_list('b',n),
-                                           a=arg_list('a',n))) as src:
+                 ['cout', ('b',n), 'cin', ('a',n), 'x']) as gate:
+        cout, b, cin, a, x = gate.regs
         for i in range(n):
-            cin = 'cin' if i == 0 else 'a{}'.format(i - 1)
-            src.append('  cmj {},b{},a{},x;'.format(cin, i, i))
-        src.append('  cx a{},cout;'.format(n-1))
+            c = cin if i == 0 else a[i-1]
+            gate.op('cmj', c, b[i], a[i], x)
+        gate.op('cx', a[n-1], cout)
         for i in range(n-1, -1, -1):
-            cin = 'cin' if i == 0 else 'a{}'.format(i - 1)
-            src.append('  cuj {},b{},a{},x;'.format(cin, i, i))
+            c = cin if i == 0 else a[i-1]
+            gate.op('cuj', c, b[i], a[i], x)
 
+@cached
 def cadd(n):
     """ Controlled CDKM adder without carry output """
+    if current().adder == 'lookahead':
+        return lookahead_cadd(n, False)
     cmj()
     cus()
     with declare('cadd{}'.format(n),
-                 '{b},cin,{a},x'.format(b=arg_list('b',n),
-                                        a=arg_list('a',n))) as src:
+                 [('b',n), 'cin', ('a',n), 'x']) as gate:
+        b, cin, a, x = gate.regs
         for i in range(n):
-            cin = 'cin' if i == 0 else 'a{}'.format(i - 1)
-            src.append('  cmj {},b{},a{},x;'.format(cin, i, i))
+            c = cin if i == 0 else a[i-1]
+            gate.op('cmj', c, b[i], a[i], x)
         for i in range(n-1, -1, -1):
-            cin = 'cin' if i == 0 else 'a{}'.format(i - 1)
-            src.append('  cus {},b{},a{},x;'.format(cin, i, i))
+            c = cin if i == 0 else a[i-1]
+            gate.op('cus', c, b[i], a[i], x)
 
 
+@cached
 def caddc(n):
     """ Controlled CDKM adder with carry output """
+    if current().adder == 'lookahead':
+        return lookahead_cadd(n, True)
     cmj()
     cus()
     with declare('caddc{}'.format(n),
-                 'cout,{b},cin,{a},x'.format(b=arg_list('b',n),
-                                             a=arg_list('a',n))) as src:
+                 ['cout', ('b',n), 'cin', ('a',n), 'x']) as gate:
+        cout, b, cin, a, x = gate.regs
         for i in range(n):
-            cin = 'cin' if i == 0 else 'a{}'.format(i - 1)
-            src.append('  cmj {},b{},a{},x;'.format(cin, i, i))
-        src.append('  cx a{},cout;'.format(n-2))
+            c = cin if i == 0 else a[i-1]
+            gate.op('cmj', c, b[i], a[i], x)
+        gate.op('cx', a[n-2], cout)
         for i in range(n-1, -1, -1):
-            cin = 'cin' if i == 0 else 'a{}'.format(i - 1)
-            src.append('  cus {},b{},a{},x;'.format(cin, i, i))
+            c = cin if i == 0 else a[i-1]
+            gate.op('cus', c, b[i], a[i], x)
 
 
+@cached
 def increment(n):
     """ Increment """
     add(n)
-    with declare('increment{}'.format(n),
-                 '{b},{s}'.format(b=arg_list('b',n),
-                                  s=arg_list('s',n+1))) as src:
-        src.append('  x s0;')
-        src.append('  add{n} {b},s{n},{s};'.format(n=n,
-                                                   b=arg_list('b',n),
-                                                   s=arg_list('s',n)))
-        src.append('  x s0;')
+    with declare('increment{}'.format(n), [('b',n), ('s',n+1), ('cla',adder_scratch(n))]) as gate:
+        b, s, cla = gate.regs
+        gate.op('x', s[0])
+        gate.op('add{}'.format(n), b, s[n], s[:n], cla)
+        gate.op('x', s[0])
 
 
+@cached
 def decrement(n):
     """ Decrement """
     add(n)
-    with declare('decrement{}'.format(n),
-                 '{b},{s}'.format(b=arg_list('b',n),
-                                  s=arg_list('s',n+1))) as src:
+    with declare('decrement{}'.format(n), [('b',n), ('s',n+1), ('cla',adder_scratch(n))]) as gate:
+        b, s, cla = gate.regs
         for i in range(n):
-            src.append('  x s{};'.format(i))
-        src.append('  add{n} {b},s{n},{s};'.format(n=n,
-                                                   b=arg_list('b',n),
-                                                   s=arg_list('s',n)))
+            gate.op('x', s[i])
+        gate.op('add{}'.format(n), b, s[n], s[:n], cla)
         for i in range(n-1, -1, -1):
-            src.append('  x s{};'.format(i))
+            gate.op('x', s[i])
 
 
+@cached
 def sub(n):
     """ CDKM Subtractor """
     increment(n)
     add(n)
     decrement(n)
-    with declare('sub{}'.format(n),
-                 '{b},{a},{s}'.format(b=arg_list('b',n),
-                                      a=arg_list('a',n),
-                                      s=arg_list('s',n+1))) as src:
+    with declare('sub{}'.format(n), [('b',n), ('a',n), ('s',n+1), ('cla',adder_scratch(n))]) as gate:
+        b, a, s, cla = gate.regs
         for i in range(n):
-            src.append('  x a{};'.format(i))
-        src.append('  increment{n} {a},{s};'.format(n=n,
-                                                    a=arg_list('a',n),
-                                                    s=arg_list('s',n+1)))
-        src.append('  add{n} {b},s{n},{a};'.format(n=n,
-                                                   b=arg_list('b',n),
-                                                   a=arg_list('a',n)))
-        src.append('  decrement{n} {a},{s};'.format(n=n,
-                                                    a=arg_list('a',n),
-                                                    s=arg_list('s',n+1)))
+            gate.op('x', a[i])
+        gate.op('increment{}'.format(n), a, s, cla)
+        gate.op('add{}'.format(n), b, s[n], a, cla)
+        gate.op('decrement{}'.format(n), a, s, cla)
         for i in range(n-1, -1, -1):
-            src.append('  x a{};'.format(i))
+            gate.op('x', a[i])
 
 
+@cached
 def csub(n):
     """ Controlled CDKM Subtractor """
     increment(n)
     cadd(n)
     decrement(n)
     with declare('csub{}'.format(n),
-                 '{b},{a},{s},x'.format(b=arg_list('b',n),
-                                        a=arg_list('a',n),
-                                        s=arg_list('s',n+1))) as src:
+                 [('b',n), ('a',n), ('s',n+1), 'x', ('cla',adder_scratch(n))]) as gate:
+        b, a, s, x, cla = gate.regs
         for i in range(n):
-            src.append('  x a{};'.format(i))
-        src.append('  increment{n} {a},{s};'.format(n=n,
-                                                    a=arg_list('a',n),
-                                                    s=arg_list('s',n+1)))
-        src.append('  cadd{n} {b},s{n},{a},x;'.format(n=n,
-                                                      b=arg_list('b',n),
-                                                      a=arg_list('a',n)))
-        src.append('  decrement{n} {a},{s};'.format(n=n,
-                                                    a=arg_list('a',n),
-                                                    s=arg_list('s',n+1)))
+            gate.op('x', a[i])
+        gate.op('increment{}'.format(n), a, s, cla)
+        gate.op('cadd{}'.format(n), b, s[n], a, x, cla)
+        gate.op('decrement{}'.format(n), a, s, cla)
         for i in range(n-1, -1, -1):
-            src.append('  x a{};'.format(i))
+            gate.op('x', a[i])
 
 
+@cached
 def cmpge(n):
-    """ Check if a >= b """
-    increment(n)
+    """ Check if a >= b
+
+    b + ~a overflows exactly when b > a, so a single carry chain (cmb)
+    gives the comparison. s is only used for its zero s[n].
+    """
     cmb(n)
-    decrement(n)
     with declare('cmpge{}'.format(n),
-                 '{b},{a},cout,{s}'.format(b=arg_list('b',n),
-                                           a=arg_list('a',n),
-                                           s=arg_list('s',n+1))) as src:
-        src.append('  increment{n} {a},{s};'.format(n=n,
-                                                    a=arg_list('a',n),
-                                                    s=arg_list('s',n+1)))
+                 [('b',n), ('a',n), 'cout', ('s',n+1), ('cla',adder_scratch(n))]) as gate:
+        b, a, cout, s, cla = gate.regs
         for i in range(n):
-            src.append('  x a{};'.format(i))
-        src.append('  increment{n} {a},{s};'.format(n=n,
-                                                    a=arg_list('a',n),
-                                                    s=arg_list('s',n+1)))
-        src.append('  cmb{n} cout,{b},s{n},{a};'.format(n=n,
-                                                        a=arg_list('a',n),
-                                                        b=arg_list('b',n)))
-        src.append('  decrement{n} {a},{s};'.format(n=n,
-                                                    a=arg_list('a',n),
-                                                    s=arg_list('s',n+1)))
+            gate.op('x', a[i])
+        gate.op('cmb{}'.format(n), cout, b, s[n], a, cla)
         for i in range(n-1, -1, -1):
-            src.append('  x a{};'.format(i))
-        src.append('  decrement{n} {a},{s};'.format(n=n,
-                                                    a=arg_list('a',n),
-                                                    s=arg_list('s',n+1)))
-        src.append('  x cout;')
+            gate.op('x', a[i])
+        gate.op('x', cout)
 
+@cached
 def ccmpge(n):
-    """ Check if a >= b """
-    increment(n)
+    """ Check if a >= b (see cmpge) """
     ccmb(n)
-    decrement(n)
     with declare('ccmpge{}'.format(n),
-                 '{b},{a},cout,{s},x'.format(b=arg_list('b',n),
-                                           a=arg_list('a',n),
-                                           s=arg_list('s',n+1))) as src:
-        src.append('  increment{n} {a},{s};'.format(n=n,
-                                                    a=arg_list('a',n),
-                                                    s=arg_list('s',n+1)))
+                 [('b',n), ('a',n), 'cout', ('s',n+1), 'x', ('cla',adder_scratch(n))]) as gate:
+        b, a, cout, s, x, cla = gate.regs
         for i in range(n):
-            src.append('  x a{};'.format(i))
-        src.append('  increment{n} {a},{s};'.format(n=n,
-                                                    a=arg_list('a',n),
-                                                    s=arg_list('s',n+1)))
-        src.append('  ccmb{n} cout,{b},s{n},{a},x;'.format(n=n,
-                                                        a=arg_list('a',n),
-                                                        b=arg_list('b',n)))
-        src.append('  decrement{n} {a},{s};'.format(n=n,
-                                                    a=arg_list('a',n),
-                                                    s=arg_list('s',n+1)))
+            gate.op('x', a[i])
+        gate.op('ccmb{}'.format(n), cout, b, s[n], a, x, cla)
         for i in range(n-1, -1, -1):
-            src.append('  x a{};'.format(i))
-        src.append('  decrement{n} {a},{s};'.format(n=n,
-                                                    a=arg_list('a',n),
-                                                    s=arg_list('s',n+1)))
-        src.append('  x cout;')
+            gate.op('x', a[i])
+        gate.op('x', cout)
 
+@cached
 def ccmpg(n):
-    """ Check if a >= b """
-    increment(n)
+    """ Check if a > b, i.e. b + ~a + 1 does not overflow (see cmpge) """
     ccmb(n)
-    decrement(n)
     with declare('ccmpg{}'.format(n),
-                 '{b},{a},cout,{s},x'.format(b=arg_list('b',n),
-                                           a=arg_list('a',n),
-                                           s=arg_list('s',n+1))) as src:
+                 [('b',n), ('a',n), 'cout', ('s',n+1), 'x', ('cla',adder_scratch(n))]) as gate:
+        b, a, cout, s, x, cla = gate.regs
+        gate.op('x', s[n])
         for i in range(n):
-            src.append('  x a{};'.format(i))
-        src.append('  increment{n} {a},{s};'.format(n=n,
-                                                    a=arg_list('a',n),
-                                                    s=arg_list('s',n+1)))
-        src.append('  ccmb{n} cout,{b},s{n},{a},x;'.format(n=n,
-                                                        a=arg_list('a',n),
-                                                        b=arg_list('b',n)))
-        src.append('  decrement{n} {a},{s};'.format(n=n,
-                                                    a=arg_list('a',n),
-                                                    s=arg_list('s',n+1)))
+            gate.op('x', a[i])
+        gate.op('ccmb{}'.format(n), cout, b, s[n], a, x, cla)
         for i in range(n-1, -1, -1):
-            src.append('  x a{};'.format(i))
-        src.append('  x cout;')
+            gate.op('x', a[i])
+        gate.op('x', s[n])
+        gate.op('x', cout)
 
 
+@cached
 def crmod(n):
     """ Restricted a mod b """
     ccmpge(n)
     csub(n)
     with declare('crmod{}'.format(n),
-                 '{b},{a},g,{s},x'.format(b=arg_list('b',n),
-                                          a=arg_list('a',n),
-                                          s=arg_list('s',n+1))) as src:
-        src.append('  ccmpge{n} {b},{a},g,{s},x;'.format(n=n,
-                                                      a=arg_list('a',n),
-                                                      b=arg_list('b',n),
-                                                      s=arg_list('s',n+1)))
-        src.append('  csub{n} {a},{b},{s},g;'.format(n=n,
-                                                     a=arg_list('a',n),
-                                                     b=arg_list('b',n),
-                                                     s=arg_list('s',n+1)))
+                 [('b',n), ('a',n), 'g', ('s',n+1), 'x', ('cla',adder_scratch(n))]) as gate:
+        b, a, g, s, x, cla = gate.regs
+        gate.op('ccmpge{}'.format(n), b, a, g, s, x, cla)
+        gate.op('csub{}'.format(n), a, b, s, g, cla)
 
+@cached
 def rmod(n):
     """ Restricted a mod b """
     cmpge(n)
     csub(n)
     with declare('rmod{}'.format(n),
-                 '{b},{a},g,{s}'.format(b=arg_list('b',n),
-                                          a=arg_list('a',n),
-                                          s=arg_list('s',n+1))) as src:
-        src.append('  cmpge{n} {b},{a},g,{s};'.format(n=n,
-                                                      a=arg_list('a',n),
-                                                      b=arg_list('b',n),
-                                                      s=arg_list('s',n+1)))
-        src.append('  csub{n} {a},{b},{s},g;'.format(n=n,
-                                                     a=arg_list('a',n),
-                                                     b=arg_list('b',n),
-                                                     s=arg_list('s',n+1)))
+                 [('b',n), ('a',n), 'g', ('s',n+1), ('cla',adder_scratch(n))]) as gate:
+        b, a, g, s, cla = gate.regs
+        gate.op('cmpge{}'.format(n), b, a, g, s, cla)
+        gate.op('csub{}'.format(n), a, b, s, g, cla)
 
 
+@cached
 def addmod(nb):
     """ b = b + a mod n """
     add(nb)
     rmod(nb)
     cmb(nb)
     with declare('addmod{}'.format(nb),
-                 '{b},{a},{n},{s}'.format(b=arg_list('b',nb),
-                                          a=arg_list('a',nb),
-                                          n=arg_list('n',nb),
-                                          s=arg_list('s',nb+2))) as src:
-        src.append('  add{nb} {b},s{nb},{a};'.format(nb=nb,
-                                                     b=arg_list('b',nb),
-                                                     a=arg_list('a',nb)))
-        src.append('  rmod{nb} {n},{b},s{nb1},{s};'.format(nb=nb,
-                                                           nb1=nb+1,
-                                                           n=arg_list('n',nb),
-                                                           b=arg_list('b',nb),
-                                                           s=arg_list('s',
-                                                                      nb+1)))
-        src.append('  cmb{nb} s{nb1},{b},s{nb},{a};'.format(nb=nb,
-                                                            nb1=nb+1,
-                                                            a=arg_list('a',nb),
-                                                            b=arg_list('b',
-                                                                       nb)))
+                 [('b',nb), ('a',nb), ('n',nb), ('s',nb+2), ('cla',adder_scratch(nb))]) as gate:
+        b, a, n, s, cla = gate.regs
+        gate.op('add{}'.format(nb), b, s[nb], a, cla)
+        gate.op('rmod{}'.format(nb), n, b, s[nb+1], s[:nb+1], cla)
+        gate.op('cmb{}'.format(nb), s[nb+1], b, s[nb], a, cla)
 
 
+@cached
 def caddmod(nb):
     """ Controlled b = b + a mod n """
     cadd(nb)
@@ -430,192 +876,157 @@ def caddmod(nb):
     cmb(nb)
     ccmpg(nb)
     with declare('caddmod{}'.format(nb),
-                 '{b},{a},{n},{s},x'.format(b=arg_list('b',nb),
-                                            a=arg_list('a',nb),
-                                            n=arg_list('n',nb),
-                                            s=arg_list('s',nb+2))) as src:
-        src.append('  cadd{nb} {b},s{nb},{a},x;'.format(nb=nb,
-                                                        b=arg_list('b',nb),
-                                                        a=arg_list('a',nb)))
-        src.append('  crmod{nb} {n},{b},s{nb1},{s},x;'.format(nb=nb,
-                                                           nb1=nb+1,
-                                                           n=arg_list('n',nb),
-                                                           b=arg_list('b',nb),
-                                                           s=arg_list('s',
-                                                                      nb+1)))
-        src.append('  ccmpg{nb} {b},{a},s{nb1},{s},x;'.format(nb=nb, 
-                                                            nb1=nb+1,
-                                                        s=arg_list('s',nb+1),
-                                                        a=arg_list('a',nb),
-                                                        b=arg_list('b',nb),
-                                                        ))
+                 [('b',nb), ('a',nb), ('n',nb), ('s',nb+2), 'x', ('cla',adder_scratch(nb))]) as gate:
+        b, a, n, s, x, cla = gate.regs
+        gate.op('cadd{}'.format(nb), b, s[nb], a, x, cla)
+        gate.op('crmod{}'.format(nb), n, b, s[nb+1], s[:nb+1], x, cla)
+        gate.op('ccmpg{}'.format(nb), b, a, s[nb+1], s[:nb+1], x, cla)
 
 
+@cached
 def double(n):
     """ a = 2*a  (only works for a[n-1] = |0>) """
-    with declare('double{}'.format(n),
-                 '{a}'.format(a=arg_list('a',n))) as src:
+    with declare('double{}'.format(n), [('a',n)]) as gate:
+        a, = gate.regs
         for i in range(n-1):
-            src.append('  swap a{},a{};'.format(i, n-1))
+            gate.op('swap', a[i], a[n-1])
 
 
+@cached
 def doublemod(nb):
     """ a = 2*a mod n  (only works for a[n-1] = |0>) """
     double(nb)
     rmod(nb)
     with declare('doublemod{}'.format(nb),
-                 '{a},{n},g,{s}'.format(a=arg_list('a',nb),
-                                          n=arg_list('n',nb),
-                                          s=arg_list('s',nb+1))) as src:
-        src.append('  double{nb} {a};'.format(nb=nb,
-                                              a=arg_list('a',nb)))
-        src.append('  rmod{nb} {n},{a},g,{s};'.format(nb=nb,
-                                                      a=arg_list('a',nb),
-                                                      n=arg_list('n',nb),
-                                                      s=arg_list('s',nb+1)))
+                 [('a',nb), ('n',nb), 'g', ('s',nb+1), ('cla',adder_scratch(nb))]) as gate:
+        a, n, g, s, cla = gate.regs
+        gate.op('double{}'.format(nb), a)
+        gate.op('rmod{}'.format(nb), n, a, g, s, cla)
 
 
+@cached
 def multbstage(nb):
     """ Basic modular multiplication module stage """
     doublemod(nb)
     caddmod(nb)
     with declare('multbstage{}'.format(nb),
-                 '{s},{a},{n},{z},g,x'.format(s=arg_list('s',nb),
-                                              a=arg_list('a',nb),
-                                              n=arg_list('n',nb),
-                                              z=arg_list('z',nb+2))) as src:
-        src.append('  caddmod{nb} {s},{a},{n},{z},x;'.format(nb=nb,
-                                                             s=arg_list('s',
-                                                                        nb),
-                                                             a=arg_list('a',
-                                                                        nb),
-                                                             n=arg_list('n',
-                                                                        nb),
-                                                             z=arg_list('z',
-                                                                        nb+2)))
-        src.append('  doublemod{nb} {a},{n},g,{z};'.format(nb=nb,
-                                                           a=arg_list('a',nb),
-                                                           n=arg_list('n',nb),
-                                                           z=arg_list('z',
-                                                                      nb+1)))
+                 [('s',nb), ('a',nb), ('n',nb), ('z',nb+2), 'g', 'x', ('cla',adder_scratch(nb))]) as gate:
+        s, a, n, z, g, x, cla = gate.regs
+        gate.op('caddmod{}'.format(nb), s, a, n, z, x, cla)
+        gate.op('doublemod{}'.format(nb), a, n, g, z[:nb+1], cla)
 
 
 
+@cached
 def multbchain(nb):
     """ Chains basic modular multiplication stages """ 
     multbstage(nb)
     with declare('multbchain{}'.format(nb),
-                 '{s},{a},{n},{z},ad,{g},{x}'.format(s=arg_list('s',nb),
-                                                  a=arg_list('a',nb),
-                                                  n=arg_list('n',nb),
-                                                  z=arg_list('z',nb+1),
-                                                  g=arg_list('g',nb),
-                                                  x=arg_list('x',nb))) as src:
+                 [('s',nb), ('a',nb), ('n',nb), ('z',nb+1), 'ad',
+                  ('g',nb), ('x',nb), ('cla',adder_scratch(nb))]) as gate:
+        s, a, n, z, ad, g, x, cla = gate.regs
         for i in range(nb):
-            src.append( '  multbstage{nb} {s},{a},{n},{z},ad,g{i},x{i};'.format(
-                                                              nb=nb,
-                                                              s=arg_list('s',nb),
-                                                              a=arg_list('a',nb),
-                                                              n=arg_list('n',nb),
-                                                              z=arg_list('z',nb+1),
-                                                              i=i))
+            gate.op('multbstage{}'.format(nb), s, a, n, z, ad, g[i], x[i], cla)
 
 
 
+@cached
 def specificmultbchain(nb,A,N):
     multbstage(nb)
     with declare('specificmultbchain{nb}_{A}_{N}'.format(nb=nb,A=A,N=N),
-                 '{s},{a},{n},{z},ad,md,{x}'.format(s=arg_list('s',nb),
-                                                     a=arg_list('a',nb),
-                                                     n=arg_list('n',nb),
-                                                     z=arg_list('z',nb+1),
-                                                     x=arg_list('x',nb))) as src:
+                 [('s',nb), ('a',nb), ('n',nb), ('z',nb+1), 'ad', 'md',
+                  ('x',nb), ('cla',adder_scratch(nb))]) as gate:
+        s, a, n, z, ad, md, x, cla = gate.regs
+        stage = 'multbstage{}'.format(nb)
+        # A*2**i mod N, doubled along i
+        A_i = A%N
         for i in range(nb):
-            src.append('  multbstage{nb} {s},{a},{n},{z},ad,md,x{i};'.format(
-                                                              nb=nb,
-                                                              s=arg_list('s',nb),
-                                                              a=arg_list('a',nb),
-                                                              n=arg_list('n',nb),
-                                                              z=arg_list('z',nb+1),
-                                                              i=i))
-            if 2*((A*2**i)%N)>=N:
-                src.append('  x md;')
+            gate.op(stage, s, a, n, z, ad, md, x[i], cla)
+            if 2*A_i>=N:
+                gate.op('x', md)
+            A_i = (2*A_i)%N
 
+@cached
 def cspecificmultbchain(nb,A,N):
     multbstage(nb)
     with declare('cspecificmultbchain{nb}_{A}_{N}'.format(nb=nb,A=A,N=N),
-                 '{s},{a},{n},{z},ad,md,{x},y'.format(s=arg_list('s',nb),
-                                                     a=arg_list('a',nb),
-                                                     n=arg_list('n',nb),
-                                                     z=arg_list('z',nb+1),
-                                                     x=arg_list('x',nb))) as src:
+                 [('s',nb), ('a',nb), ('n',nb), ('z',nb+1), 'ad', 'md',
+                  ('x',nb), 'y', ('cla',adder_scratch(nb))]) as gate:
+        s, a, n, z, ad, md, x, y, cla = gate.regs
+        stage = 'multbstage{}'.format(nb)
+        # A*2**i and 2**i mod N, doubled along i
+        A_i, one_i = A%N, 1%N
         for i in range(nb):
-            src.append('  multbstage{nb} {s},{a},{n},{z},ad,md,x{i};'.format(
-                                                              nb=nb,
-                                                              s=arg_list('s',nb),
-                                                              a=arg_list('a',nb),
-                                                              n=arg_list('n',nb),
-                                                              z=arg_list('z',nb+1),
-                                                              i=i))
-            if 2*((A*2**i)%N)>=N:
-                src.append('  cx y,md;')
+            gate.op(stage, s, a, n, z, ad, md, x[i], cla)
+            if 2*A_i>=N:
+                gate.op('cx', y, md)
 
             #if control is off, must reverse ancilla with A=1
-            if 2*((2**i)%N)>=N:
-                src.append('  x y;')
-                src.append('  cx y,md;')
-                src.append('  x y;')
+            if 2*one_i>=N:
+                gate.op('x', y)
+                gate.op('cx', y, md)
+                gate.op('x', y)
+            A_i, one_i = (2*A_i)%N, (2*one_i)%N
 
+@cached
 def tomodularinv(nb,A,N):
     A_inv = modular_inverse(A,N)
     mult_A = (A*2**nb)%N
     with declare('toAmodularinv{nb}_{A}_{N}'.format(nb=nb,A=A,N=N),
-                '{a}'.format(a=arg_list('a',nb))) as src:
+                 [('a',nb)]) as gate:
+        a, = gate.regs
         for i in range(nb):
             mask=2**i
             if ((A_inv & mask) ^ (mult_A & mask)):
-                src.append('  x a{};'.format(i))
+                gate.op('x', a[i])
 
+@cached
 def ctomodularinv(nb,A,N):
     A_inv = modular_inverse(A,N)
     mult_A = (A*2**nb)%N
     pow_2 = (2**nb)%N
     with declare('ctoAmodularinv{nb}_{A}_{N}'.format(nb=nb,A=A,N=N),
-                '{a},y'.format(a=arg_list('a',nb))) as src:
+                 [('a',nb), 'y']) as gate:
+        a, y = gate.regs
         for i in range(nb):
             mask=2**i
             if ((A_inv & mask) ^ (mult_A & mask)):
-                src.append('  cx y,a{};'.format(i))
+                gate.op('cx', y, a[i])
             if ((pow_2 & mask) ^ (1 & mask)):
-                src.append('  x y;'.format(i))
-                src.append('  cx y,a{};'.format(i))
-                src.append('  x y;'.format(i))
+                gate.op('x', y)
+                gate.op('cx', y, a[i])
+                gate.op('x', y)
 
+@cached
 def backtoA(nb,A,N):
     A_inv = modular_inverse(A,N)
     mult_A_inv = (A_inv * 2**nb) % N
     with declare('backtoA{nb}_{A}_{N}'.format(nb=nb,A=A,N=N),
-                '{a}'.format(a=arg_list('a',nb))) as src:
+                 [('a',nb)]) as gate:
+        a, = gate.regs
         for i in range(nb):
             mask=2**i
             if ((mult_A_inv & mask) ^ (A & mask)):
-                src.append('  x a{};'.format(i))
+                gate.op('x', a[i])
 
+@cached
 def cbacktoA(nb,A,N):
     A_inv = modular_inverse(A,N)
     mult_A_inv = (A_inv * 2**nb) % N
     pow_2 = (2**nb) % N
     with declare('cbacktoA{nb}_{A}_{N}'.format(nb=nb,A=A,N=N),
-                '{a},y'.format(a=arg_list('a',nb))) as src:
+                 [('a',nb), 'y']) as gate:
+        a, y = gate.regs
         for i in range(nb):
             mask=2**i
             if ((mult_A_inv & mask) ^ (A & mask)):
-                src.append('  cx y,a{};'.format(i))
+                gate.op('cx', y, a[i])
             if ((pow_2 & mask) ^ (1 & mask)):
-                src.append('  x y;'.format(i))
-                src.append('  cx y,a{};'.format(i))
-                src.append('  x y;'.format(i))
+                gate.op('x', y)
+                gate.op('cx', y, a[i])
+                gate.op('x', y)
 
+@cached
 def modularmult(nb,A,N):
     A_inv = modular_inverse(A,N)
 
@@ -628,61 +1039,39 @@ def modularmult(nb,A,N):
     sub(nb)
 
     with declare('modularmult{nb}_{A}_{N}'.format(nb=nb,A=A,N=N),
-                 '{s},{a},{n},{z},ad,md,{x}'.format(s=arg_list('s',nb),
-                                                     a=arg_list('a',nb),
-                                                     n=arg_list('n',nb),
-                                                     z=arg_list('z',nb+1),
-                                                     x=arg_list('x',nb))) as src:
-        src.append('  specificmultbchain{nb}_{A}_{N} {s},{a},{n},{z},ad,md,{x};'.format(nb=nb,
-                                                     A=A,
-                                                     N=N,
-                                                     s=arg_list('s',nb),
-                                                     a=arg_list('a',nb),
-                                                     n=arg_list('n',nb),
-                                                     z=arg_list('z',nb+1),
-                                                     x=arg_list('x',nb)))
-        src.append('  toAmodularinv{nb}_{A}_{N} {a};'.format(nb=nb,
-                                                            A=A,
-                                                            N=N,
-                                                            a=arg_list('a',nb)))
+                 [('s',nb), ('a',nb), ('n',nb), ('z',nb+1), 'ad', 'md',
+                  ('x',nb), ('cla',adder_scratch(nb))]) as gate:
+        s, a, n, z, ad, md, x, cla = gate.regs
+        gate.op('specificmultbchain{nb}_{A}_{N}'.format(nb=nb,A=A,N=N),
+                s, a, n, z, ad, md, x, cla)
+        gate.op('toAmodularinv{nb}_{A}_{N}'.format(nb=nb,A=A,N=N), a)
         for i in range(nb):
-            src.append('  swap x{i},s{i};'.format(i=i))
+            gate.op('swap', x[i], s[i])
 
-        src.append('  sub{nb} {n},{s},{z};'.format(nb=nb,
-                                                   n=arg_list('n',nb),
-                                                   s=arg_list('s',nb),
-                                                   z=arg_list('z',nb+1)))
+        gate.op('sub{}'.format(nb), n, s, z, cla)
 
-        src.append('  add{nb} {s},z{nb},{n};'.format(nb=nb,
-                                                      n=arg_list('n',nb),
-                                                      s=arg_list('s',nb)))
+        gate.op('add{}'.format(nb), s, z[nb], n, cla)
 
         for i in range(nb):
-            src.append('  swap n{i},s{i};'.format(i=i))
-
-        src.append('  specificmultbchain{nb}_{A_inv}_{N} {s},{a},{n},{z},ad,md,{x};'.format(nb=nb,
-                                                     A_inv=A_inv,
-                                                     N=N,
-                                                     s=arg_list('s',nb),
-                                                     a=arg_list('a',nb),
-                                                     n=arg_list('n',nb),
-                                                     z=arg_list('z',nb+1),
-                                                     x=arg_list('x',nb)))
-        src.append('  backtoA{nb}_{A}_{N} {a};'.format(nb=nb,
-                                                       A=A,
-                                                       N=N,
-                                                       a=arg_list('a',nb)))
+            gate.op('swap', n[i], s[i])
+
+        gate.op('specificmultbchain{nb}_{A_inv}_{N}'.format(nb=nb,A_inv=A_inv,N=N),
+                s, a, n, z, ad, md, x, cla)
+        gate.op('backtoA{nb}_{A}_{N}'.format(nb=nb,A=A,N=N), a)
 
 
+@cached
 def squareA(nb,A,N):
     with declare('squareA{nb}_{A}_{N}'.format(nb=nb,A=A,N=N),
-                 '{a}'.format(a=arg_list('a',nb))) as src:
+                 [('a',nb)]) as gate:
+        a, = gate.regs
         A_sqr = (A*A)%N
         for i in range(nb):
             mask=2**i
             if ((A_sqr & mask) ^ (A & mask)):
-                src.append('  x a{};'.format(i))
+                gate.op('x', a[i])
 
+@cached
 def cmodularmult(nb,A,N):
     A_inv = modular_inverse(A,N)
 
@@ -694,64 +1083,39 @@ def cmodularmult(nb,A,N):
 
     sub(nb)
     with declare('cmodularmult{nb}_{A}_{N}'.format(nb=nb,A=A,N=N),
-                 '{s},{a},{n},{z},ad,md,{x},{o},y'.format(s=arg_list('s',nb),
-                                                     a=arg_list('a',nb),
-                                                     n=arg_list('n',nb),
-                                                     z=arg_list('z',nb+1),
-                                                     x=arg_list('x',nb),
-                                                     o=arg_list('o',nb))) as src:
+                 [('s',nb), ('a',nb), ('n',nb), ('z',nb+1), 'ad', 'md',
+                  ('x',nb), ('o',nb), 'y', ('cla',adder_scratch(nb))]) as gate:
+        s, a, n, z, ad, md, x, o, y, cla = gate.regs
 
         #Fredkin gate
-        src.append('  x y;')
+        gate.op('x', y)
         for i in range(nb):
-            src.append('  cswap y,o{i},a{i};'.format(i=i))
-        src.append('  x y;')
-
-        src.append('  cspecificmultbchain{nb}_{A}_{N} {s},{a},{n},{z},ad,md,{x},y;'.format(nb=nb,
-                                                     A=A,
-                                                     N=N,
-                                                     s=arg_list('s',nb),
-                                                     a=arg_list('a',nb),
-                                                     n=arg_list('n',nb),
-                                                     z=arg_list('z',nb+1),
-                                                     x=arg_list('x',nb)))
-        src.append('  ctoAmodularinv{nb}_{A}_{N} {a},y;'.format(nb=nb,
-                                                            A=A,
-                                                            N=N,
-                                                            a=arg_list('a',nb)))
+            gate.op('cswap', y, o[i], a[i])
+        gate.op('x', y)
+
+        gate.op('cspecificmultbchain{nb}_{A}_{N}'.format(nb=nb,A=A,N=N),
+                s, a, n, z, ad, md, x, y, cla)
+        gate.op('ctoAmodularinv{nb}_{A}_{N}'.format(nb=nb,A=A,N=N), a, y)
         for i in range(nb):
-            src.append('  swap x{i},s{i};'.format(i=i))
+            gate.op('swap', x[i], s[i])
 
-        src.append('  sub{nb} {n},{s},{z};'.format(nb=nb,
-                                                   n=arg_list('n',nb),
-                                                   s=arg_list('s',nb),
-                                                   z=arg_list('z',nb+1)))
+        gate.op('sub{}'.format(nb), n, s, z, cla)
 
-        src.append('  add{nb} {s},z{nb},{n};'.format(nb=nb,
-                                                      n=arg_list('n',nb),
-                                                      s=arg_list('s',nb)))
+        gate.op('add{}'.format(nb), s, z[nb], n, cla)
 
         for i in range(nb):
-            src.append('  swap n{i},s{i};'.format(i=i))
-
-        src.append('  cspecificmultbchain{nb}_{A_inv}_{N} {s},{a},{n},{z},ad,md,{x},y;'.format(nb=nb,
-                                                     A_inv=A_inv,
-                                                     N=N,
-                                                     s=arg_list('s',nb),
-                                                     a=arg_list('a',nb),
-                                                     n=arg_list('n',nb),
-                                                     z=arg_list('z',nb+1),
-                                                     x=arg_list('x',nb)))
-        src.append('  cbacktoA{nb}_{A}_{N} {a},y;'.format(nb=nb,
-                                                       A=A,
-                                                       N=N,
-                                                       a=arg_list('a',nb)))
+            gate.op('swap', n[i], s[i])
+
+        gate.op('cspecificmultbchain{nb}_{A_inv}_{N}'.format(nb=nb,A_inv=A_inv,N=N),
+                s, a, n, z, ad, md, x, y, cla)
+        gate.op('cbacktoA{nb}_{A}_{N}'.format(nb=nb,A=A,N=N), a, y)
         #Fredkin gate
-        src.append('  x y;')
+        gate.op('x', y)
         for i in range(nb):
-            src.append('  cswap y,o{i},a{i};'.format(i=i))
-        src.append('  x y;')
+            gate.op('cswap', y, o[i], a[i])
+        gate.op('x', y)
 
+@cached
 def modularexp(nb,A,N):
     '''
     This expects the following initial parameters
@@ -763,200 +1127,685 @@ def modularexp(nb,A,N):
     o = 1
     '''
     with declare('modularexp{nb}_{A}_{N}'.format(nb=nb,A=A,N=N),
-                 '{s},{a},{n},{z},ad,md,{x},{o},{y}'.format(s=arg_list('s',nb),
-                                                     a=arg_list('a',nb),
-                                                     n=arg_list('n',nb),
-                                                     z=arg_list('z',nb+1),
-                                                     x=arg_list('x',nb),
-                                                     o=arg_list('o',nb),
-                                                     y=arg_list('y',nb))) as src:
+                 [('s',nb), ('a',nb), ('n',nb), ('z',nb+1), 'ad', 'md',
+                  ('x',nb), ('o',nb), ('y',nb), ('cla',adder_scratch(nb))]) as gate:
+        s, a, n, z, ad, md, x, o, y, cla = gate.regs
         for i in range(nb):
             cmodularmult(nb,A,N)
-            src.append('  cmodularmult{nb}_{A}_{N} {s},{a},{n},{z},ad,md,{x},{o},y{i};'.format(
-                                                                             nb=nb,
-                                                                             A=A,
-                                                                             N=N,
-                                                                             s=arg_list('s',nb),
-                                                                             a=arg_list('a',nb),
-                                                                             n=arg_list('n',nb),
-                                                                             z=arg_list('z',nb+1),
-                                                                             x=arg_list('x',nb),
-                                                                             o=arg_list('o',nb),
-                                                                             i=i))
+            gate.op('cmodularmult{nb}_{A}_{N}'.format(nb=nb,A=A,N=N),
+                    s, a, n, z, ad, md, x, o, y[i], cla)
             squareA(nb,A,N)
-            src.append('  squareA{nb}_{A}_{N} {a};'.format(nb=nb,
-                                                          A=A,
-                                                          N=N,
-                                                          a=arg_list('a',nb)))
+            gate.op('squareA{nb}_{A}_{N}'.format(nb=nb,A=A,N=N), a)
             A = (A*A)%N
 
 
-def obfuscate(nb,A_in,N):
-    obfuscate_step=[]
-    np.random.seed(41)
-    vars_dict={'a': 0, 'su':0, 'one': 0, 'num_init': 0}
+def decode_steps(w, e):
+    steps = [('x', e[0])]
+    for b in range(len(w)):
+        for j in range(2**b):
+            steps.append(('ccx', w[b], e[j], e[j+2**b]))
+            steps.append(('cx', e[j+2**b], e[j]))
+    return steps
+
+@cached
+def decode(k):
+    """ e = one-hot(w)  (only works for e = 0) """
+    with declare('decode{}'.format(k), [('w',k), ('e',2**k)]) as gate:
+        for step in decode_steps(*gate.regs):
+            gate.op(*step)
+
+@cached
+def undecode(k):
+    """ Inverse of decode """
+    with declare('undecode{}'.format(k), [('w',k), ('e',2**k)]) as gate:
+        for step in decode_steps(*gate.regs)[::-1]:
+            gate.op(*step)
+
+
+def xor_table(gate, e, reg, table):
+    """ reg ^= table[j] for the j selected by the one-hot register e """
+    for j, value in enumerate(table):
+        for b in range(len(reg)):
+            if (value >> b) & 1:
+                gate.op('cx', e[j], reg[b])
+
+@cached
+def wspecificmultbchain(nb,k,A,N):
+    """ specificmultbchain by A**j, j being selected by the one-hot e """
+    multbstage(nb)
+    table = [pow(A,j,N) for j in range(2**k)]
+    with declare('wspecificmultbchain{nb}_{k}_{A}_{N}'.format(nb=nb,k=k,A=A,N=N),
+                 [('s',nb), ('a',nb), ('n',nb), ('z',nb+1), 'ad', 'md',
+                  ('x',nb), ('e',2**k), ('cla',adder_scratch(nb))]) as gate:
+        s, a, n, z, ad, md, x, e, cla = gate.regs
+        stage = 'multbstage{}'.format(nb)
+        for i in range(nb):
+            gate.op(stage, s, a, n, z, ad, md, x[i], cla)
+            for j, T in enumerate(table):
+                if 2*T>=N:
+                    gate.op('cx', e[j], md)
+            # table[j] = A**j*2**i mod N
+            table = [(2*T)%N for T in table]
+
+@cached
+def wmodularmult(nb,k,A,N):
+    """ x = A**w * x mod N, for the k bit window w
+
+    Same as modularmult, with the constants looked up from classically
+    computed tables through the one-hot decoding of w into e.
+    """
+    A_inv = modular_inverse(A,N)
+    table = [pow(A,j,N) for j in range(2**k)]
+    table_inv = [modular_inverse(T,N) for T in table]
 
-    # don't mess with the highest bits. We want all to be < N
-    for i in range(nb-3):
-        if np.random.randint(0,2):
-            obfuscate_step.append("  x a[{}];".format(i))
-            vars_dict['a']=vars_dict['a'] ^ (2**i)
-
-        if np.random.randint(0,2):
-            obfuscate_step.append("  x su[{}];".format(i))
-            vars_dict['su']=vars_dict['su'] ^ (2**i)
-
-        if np.random.randint(0,2):
-            obfuscate_step.append("  x one[{}];".format(i))
-            vars_dict['one']=vars_dict['one'] ^ (2**i)
-
-        if np.random.randint(0,2):
-            obfuscate_step.append("  x num_init[{}];".format(i))
-            vars_dict['num_init']=vars_dict['num_init'] ^ (2**i)
-
-    #print("After first random flips")
-    #for k,v in vars_dict.items():
-    #    print(k,v)
-    #print("")
-
-    r_vars = list(vars_dict.keys())
-    for i in range(10):
-        if np.random.randint(0,2):
-            np.random.shuffle(r_vars)
-            if vars_dict[r_vars[1]]!=0:
-                obfuscate_step.append('  x ancilla_mult[0];')
-                obfuscate_step.append(
-                        '  caddmod{nb} {v1},{v2},{n},{s},ancilla_adder[0],ancilla_mult[0];'.format(nb=nb,
-                                                                        v1=arg_vec(r_vars[0],nb),
-                                                                        v2=arg_vec(r_vars[1],nb),
-                                                                        n=arg_vec('n',nb),
-                                                                        s=arg_vec('scratch',nb+1),
-                                                                        ))
-                obfuscate_step.append('  x ancilla_mult[0];')
-                vars_dict[r_vars[0]] = (vars_dict[r_vars[0]] + vars_dict[r_vars[1]])%N
-                #print(r_vars[0] + "=("+r_vars[0]+"+"+r_vars[1]+")%N="+str(vars_dict[r_vars[0]]))
-
-        if np.random.randint(0,2):
-            np.random.shuffle(r_vars)
-            obfuscate_step.append(
-                    '  doublemod{nb} {v1},{n},ancilla_mult[0],{s};'.format(nb=nb,
-                                                                       v1=arg_vec(r_vars[0],nb),
-                                                                       n=arg_vec('n',nb),
-                                                                       s=arg_vec('scratch',nb+1),
-                                                                       ))
-            if 2*vars_dict[r_vars[0]] >= N:
-                obfuscate_step.append('  x ancilla_mult[0];')
-            vars_dict[r_vars[0]] = (2*vars_dict[r_vars[0]])%N
-            #print(r_vars[0] + "=(2*"+r_vars[0]+")%N="+str(vars_dict[r_vars[0]]))
-
-        if np.random.randint(0,2):
-            np.random.shuffle(r_vars)
-            obfuscate_step.append('  cmpge{nb} {v2},{v1},ancilla_adder[0],{s};'.format(nb=nb,
-                                                                v1=arg_vec(r_vars[0],nb),
-                                                                v2=arg_vec(r_vars[1],nb),
-                                                                s=arg_vec('scratch',nb+1)))
-            if vars_dict[r_vars[0]]>=vars_dict[r_vars[1]]:
-                obfuscate_step.append('  x ancilla_adder[0];')
-
-        if np.random.randint(0,2):
-            np.random.shuffle(r_vars)
-            var1=vars_dict[r_vars[0]]
-            var2=vars_dict[r_vars[1]]
-            if var1!=0 and var2!=0:
-                common = gcd(var1,var2)
-                if common==1:
-                    modularmult(nb,var1,N)
-                    obfuscate_step.append('  modularmult{nb}_{A}_{N} {y},{v1},{n},{s},ancilla_adder[0],ancilla_mult[0],{v2};'.format(nb=nb,
-                                                                        v1=arg_vec(r_vars[0],nb),
-                                                                        A=vars_dict[r_vars[0]],
-                                                                        v2=arg_vec(r_vars[1],nb),
-                                                                        s=arg_vec('scratch',nb+1),
-                                                                        y=arg_vec('y',nb),
-                                                                        n=arg_vec('n',nb),
-                                                                        N=N,
-                                                                        ))
-                    #for k,v in vars_dict.items():
-                    #    print(k,v)
-                    #print(r_vars[1]+"="+r_vars[1]+"*"+r_vars[0]+"%N={}".format((vars_dict[r_vars[0]]*vars_dict[r_vars[1]])%N))
-                    vars_dict[r_vars[1]] = (vars_dict[r_vars[1]] * vars_dict[r_vars[0]])%N
-
-
-    #print("\nAfter full scramble")
-    #for k,v in vars_dict.items():
-    #    print(k,v)
+    decode(k)
+    undecode(k)
+    wspecificmultbchain(nb,k,A,N)
+    wspecificmultbchain(nb,k,A_inv,N)
+    sub(nb)
 
-    for i in range(nb):
-        mask = 2**i
-        if (vars_dict['a'] & mask) ^ (A_in & mask):
-            obfuscate_step.append('  x a[{}];'.format(i))
-            vars_dict['a']=vars_dict['a'] ^ (2**i)
+    with declare('wmodularmult{nb}_{k}_{A}_{N}'.format(nb=nb,k=k,A=A,N=N),
+                 [('s',nb), ('a',nb), ('n',nb), ('z',nb+1), 'ad', 'md',
+                  ('x',nb), ('w',k), ('e',2**k), ('cla',adder_scratch(nb))]) as gate:
+        s, a, n, z, ad, md, x, w, e, cla = gate.regs
+        gate.op('decode{}'.format(k), w, e)
+        xor_table(gate, e, a, [T ^ A for T in table])
 
-        if (vars_dict['su'] & mask) ^ (0 & mask):
-            obfuscate_step.append('  x su[{}];'.format(i))
-            vars_dict['su']=vars_dict['su'] ^ (2**i)
+        gate.op('wspecificmultbchain{nb}_{k}_{A}_{N}'.format(nb=nb,k=k,A=A,N=N),
+                s, a, n, z, ad, md, x, e, cla)
+        xor_table(gate, e, a, [Ti ^ ((T*2**nb)%N) for T, Ti in zip(table, table_inv)])
+        for i in range(nb):
+            gate.op('swap', x[i], s[i])
 
-        if (vars_dict['one'] & mask) ^ (1 & mask):
-            obfuscate_step.append('  x one[{}];'.format(i))
-            vars_dict['one']=vars_dict['one'] ^ (2**i)
+        gate.op('sub{}'.format(nb), n, s, z, cla)
 
-        if (vars_dict['num_init'] & mask) ^ (1 & mask):
-            obfuscate_step.append('  x num_init[{}];'.format(i))
-            vars_dict['num_init']=vars_dict['num_init'] ^ (2**i)
+        gate.op('add{}'.format(nb), s, z[nb], n, cla)
 
-    #print("\nFixed variables")
-    #for k,v in vars_dict.items():
-    #    print(k,v)
-    #print("")
+        for i in range(nb):
+            gate.op('swap', n[i], s[i])
+
+        gate.op('wspecificmultbchain{nb}_{k}_{A}_{N}'.format(nb=nb,k=k,A=A_inv,N=N),
+                s, a, n, z, ad, md, x, e, cla)
+        xor_table(gate, e, a, [((Ti*2**nb)%N) ^ A for Ti in table_inv])
+        gate.op('undecode{}'.format(k), w, e)
+
+@cached
+def wmodularexp(nb,k,A,N):
+    """ modularexp taking k exponent bits at a time, e are 2**k ancillas """
+    with declare('wmodularexp{nb}_{k}_{A}_{N}'.format(nb=nb,k=k,A=A,N=N),
+                 [('s',nb), ('a',nb), ('n',nb), ('z',nb+1), 'ad', 'md',
+                  ('x',nb), ('y',nb), ('e',2**k), ('cla',adder_scratch(nb))]) as gate:
+        s, a, n, z, ad, md, x, y, e, cla = gate.regs
+        for i in range(0, nb, k):
+            kk = min(k, nb-i)
+            wmodularmult(nb,kk,A,N)
+            gate.op('wmodularmult{nb}_{k}_{A}_{N}'.format(nb=nb,k=kk,A=A,N=N),
+                    s, a, n, z, ad, md, x, y[i:i+kk], e[:2**kk], cla)
+            for _ in range(kk):
+                squareA(nb,A,N)
+                gate.op('squareA{nb}_{A}_{N}'.format(nb=nb,A=A,N=N), a)
+                A = (A*A)%N
+
+
+def inverse(generator, *args):
+    """ Declares inv_NAME, running backwards, for every gate NAME that
+    generator(*args) declares (dependencies included) """
+    scratch = Synthesizer(adder=current().adder)
+    with scratch.activated():
+        generator(*args)
+    for g in scratch.gates:
+        with declare('inv_' + g.name, g.params) as gate:
+            for name, wires in reversed(g.ops):
+                if name not in parser_qasm.primitives:
+                    name = 'inv_' + name
+                gate.op(name, *wires)
+
+
+def xor_const(gate, reg, value, y=None):
+    """ reg ^= value, controlled by y if given """
+    for b in range(len(reg)):
+        if (value >> b) & 1:
+            if y is None:
+                gate.op('x', reg[b])
+            else:
+                gate.op('cx', y, reg[b])
+
+
+def montgomery_rotation(nb):
+    """ Where bit k of the result of montredc is, as an index into its t """
+    return [(k+nb) % (nb+2) for k in range(nb+2)]
+
+@cached
+def montredc(nb):
+    """ t = a*x/2**nb mod n  (Montgomery, only works for n odd, a < n and
+    everything else 0)
+
+    Each step adds x[i]*a, then n if the sum is odd (keeping that bit in
+    q[i]) and halves it, which is only a relabeling of t since its lowest
+    bit is then 0: the result ends rotated, see montgomery_rotation(). The
+    final comparison with n is left in g and h is scratch.
+    """
+    cadd(nb+2)
+    rmod(nb+1)
+    with declare('montredc{}'.format(nb),
+                 [('t',nb+2), ('a',nb), ('n',nb), ('x',nb), ('q',nb), 'g',
+                  ('h',nb+3), ('cla',adder_scratch(nb+2))]) as gate:
+        t, a, n, x, q, g, h, cla = gate.regs
+        for i in range(nb):
+            gate.op('cadd{}'.format(nb+2), t, h[2], a, h[:2], x[i], cla)
+            gate.op('cx', t[0], q[i])
+            gate.op('cadd{}'.format(nb+2), t, h[2], n, h[:2], q[i], cla)
+            t = t[1:] + t[:1]
+        gate.op('rmod{}'.format(nb+1), n, h[0], t[:nb+1], g, h[1:], cla[:adder_scratch(nb+1)])
+
+@cached
+def montmult(nb):
+    """ r ^= a*x/2**nb mod n, with m = 0 as ancillas (n odd, a < n) """
+    montredc(nb)
+    inverse(montredc, nb)
+    with declare('montmult{}'.format(nb),
+                 [('r',nb), ('a',nb), ('n',nb), ('x',nb), ('m',3*nb+6), ('cla',adder_scratch(nb+2))]) as gate:
+        r, a, n, x, m, cla = gate.regs
+        t = m[:nb+2]
+        rotation = montgomery_rotation(nb)
+        gate.op('montredc{}'.format(nb), t, a, n, x, m[nb+2:], cla)
+        for k in range(nb):
+            gate.op('cx', t[rotation[k]], r[k])
+        gate.op('inv_montredc{}'.format(nb), t, a, n, x, m[nb+2:], cla)
+
+@cached
+def mmodularmult(nb,A,N):
+    """ modularmult through montmult, the 2**nb factor going into the
+    constants loaded in a. m are 2*nb+3 more ancillas """
+    A_inv = modular_inverse(A,N)
+    R = 2**nb
+    montmult(nb)
+    with declare('mmodularmult{nb}_{A}_{N}'.format(nb=nb,A=A,N=N),
+                 [('s',nb), ('a',nb), ('n',nb), ('z',nb+1), 'ad', 'md',
+                  ('x',nb), ('m',2*nb+3), ('cla',adder_scratch(nb+2))]) as gate:
+        s, a, n, z, ad, md, x, m, cla = gate.regs
+        ancillas = z + [ad, md] + m
+        xor_const(gate, a, A ^ (A*R)%N)
+        gate.op('montmult{}'.format(nb), s, a, n, x, ancillas, cla)
+        for i in range(nb):
+            gate.op('swap', x[i], s[i])
+        xor_const(gate, a, (A*R)%N ^ (A_inv*R)%N)
+        gate.op('montmult{}'.format(nb), s, a, n, x, ancillas, cla)
+        xor_const(gate, a, (A_inv*R)%N ^ A)
+
+@cached
+def cmmodularmult(nb,A,N):
+    """ cmodularmult through montmult, see mmodularmult """
+    A_inv = modular_inverse(A,N)
+    R = 2**nb
+    montmult(nb)
+    with declare('cmmodularmult{nb}_{A}_{N}'.format(nb=nb,A=A,N=N),
+                 [('s',nb), ('a',nb), ('n',nb), ('z',nb+1), 'ad', 'md',
+                  ('x',nb), ('o',nb), 'y', ('m',2*nb+3), ('cla',adder_scratch(nb+2))]) as gate:
+        s, a, n, z, ad, md, x, o, y, m, cla = gate.regs
+        ancillas = z + [ad, md] + m
+
+        #Fredkin gate, a = 1 when y is off
+        gate.op('x', y)
+        for i in range(nb):
+            gate.op('cswap', y, o[i], a[i])
+        gate.op('x', y)
+
+        xor_const(gate, a, A ^ (A*R)%N, y)
+        gate.op('x', y)
+        xor_const(gate, a, 1 ^ R%N, y)
+        gate.op('x', y)
+        gate.op('montmult{}'.format(nb), s, a, n, x, ancillas, cla)
+        for i in range(nb):
+            gate.op('swap', x[i], s[i])
+        # when y is off a = R stays, x/R*R = x
+        xor_const(gate, a, (A*R)%N ^ (A_inv*R)%N, y)
+        gate.op('montmult{}'.format(nb), s, a, n, x, ancillas, cla)
+        xor_const(gate, a, (A_inv*R)%N ^ A, y)
+        gate.op('x', y)
+        xor_const(gate, a, R%N ^ 1, y)
+        gate.op('x', y)
 
-    #print("Expected: a={} s=0 one=1 num_init=1".format(A_in))
+        #Fredkin gate
+        gate.op('x', y)
+        for i in range(nb):
+            gate.op('cswap', y, o[i], a[i])
+        gate.op('x', y)
+
+@cached
+def mmodularexp(nb,A,N):
+    """ modularexp through cmmodularmult """
+    with declare('mmodularexp{nb}_{A}_{N}'.format(nb=nb,A=A,N=N),
+                 [('s',nb), ('a',nb), ('n',nb), ('z',nb+1), 'ad', 'md',
+                  ('x',nb), ('o',nb), ('y',nb), ('m',2*nb+3), ('cla',adder_scratch(nb+2))]) as gate:
+        s, a, n, z, ad, md, x, o, y, m, cla = gate.regs
+        for i in range(nb):
+            cmmodularmult(nb,A,N)
+            gate.op('cmmodularmult{nb}_{A}_{N}'.format(nb=nb,A=A,N=N),
+                    s, a, n, z, ad, md, x, o, y[i], m, cla)
+            squareA(nb,A,N)
+            gate.op('squareA{nb}_{A}_{N}'.format(nb=nb,A=A,N=N), a)
+            A = (A*A)%N
 
-    obfuscate_code = '\n'.join(obfuscate_step)
 
-    with declare('obfuscate','{a},{s},{n},{o},{x},{y},{sc},ad,am'.format(a=arg_list('a',nb),
-                                                                         s=arg_list('su',nb),
-                                                                         n=arg_list('n',nb),
-                                                                         o=arg_list('o',nb),
-                                                                         x=arg_list('x',nb),
-                                                                         y=arg_list('y',nb),
-                                                                         sc=arg_list('sc',nb+1),
-                                                                         )) as src:
+@cached
+def wmmodularmult(nb,k,A,N):
+    """ wmodularmult through montmult, see mmodularmult """
+    R = 2**nb
+    table = [(pow(A,j,N)*R)%N for j in range(2**k)]
+    table_inv = [(modular_inverse(pow(A,j,N),N)*R)%N for j in range(2**k)]
+
+    decode(k)
+    undecode(k)
+    montmult(nb)
+    with declare('wmmodularmult{nb}_{k}_{A}_{N}'.format(nb=nb,k=k,A=A,N=N),
+                 [('s',nb), ('a',nb), ('n',nb), ('z',nb+1), 'ad', 'md',
+                  ('x',nb), ('w',k), ('e',2**k), ('m',2*nb+3), ('cla',adder_scratch(nb+2))]) as gate:
+        s, a, n, z, ad, md, x, w, e, m, cla = gate.regs
+        ancillas = z + [ad, md] + m
+        gate.op('decode{}'.format(k), w, e)
+        xor_table(gate, e, a, [T ^ A for T in table])
+        gate.op('montmult{}'.format(nb), s, a, n, x, ancillas, cla)
+        for i in range(nb):
+            gate.op('swap', x[i], s[i])
+        xor_table(gate, e, a, [T ^ Ti for T, Ti in zip(table, table_inv)])
+        gate.op('montmult{}'.format(nb), s, a, n, x, ancillas, cla)
+        xor_table(gate, e, a, [Ti ^ A for Ti in table_inv])
+        gate.op('undecode{}'.format(k), w, e)
+
+@cached
+def wmmodularexp(nb,k,A,N):
+    """ wmodularexp through wmmodularmult """
+    with declare('wmmodularexp{nb}_{k}_{A}_{N}'.format(nb=nb,k=k,A=A,N=N),
+                 [('s',nb), ('a',nb), ('n',nb), ('z',nb+1), 'ad', 'md',
+                  ('x',nb), ('y',nb), ('e',2**k), ('m',2*nb+3), ('cla',adder_scratch(nb+2))]) as gate:
+        s, a, n, z, ad, md, x, y, e, m, cla = gate.regs
+        for i in range(0, nb, k):
+            kk = min(k, nb-i)
+            wmmodularmult(nb,kk,A,N)
+            gate.op('wmmodularmult{nb}_{k}_{A}_{N}'.format(nb=nb,k=kk,A=A,N=N),
+                    s, a, n, z, ad, md, x, y[i:i+kk], e[:2**kk], m, cla)
+            for _ in range(kk):
+                squareA(nb,A,N)
+                gate.op('squareA{nb}_{A}_{N}'.format(nb=nb,A=A,N=N), a)
+                A = (A*A)%N
+
+
+def coset_additions(nb,m):
+    """ Controlled additions of cosetmodularexp (nb+m per cosetmultbchain) """
+    return 2*nb*(nb+m)
+
+def min_coset_padding(nb):
+    """ Smallest m with more than coset_additions(nb,m) cosets
+
+    Each addition deviates from the coset representation with probability
+    about 2**-m, and classically a representative below N stays below
+    2**(nb+m) through every addition, so the results are exact mod N.
+    """
+    m = 1
+    while 2**m <= coset_additions(nb,m):
+        m += 1
+    return m
+
+def coset_padding(nb,m,j,n,zeros):
+    """ n*2**j as a register of nb+m wires, padded with m zero wires """
+    return zeros[:j] + n + zeros[j:m]
+
+@cached
+def cosetinit(nb,m):
+    """ r = r + k*n, q = 0  (with q = k and r < n on input)
+
+    Preceded by h on q this gives the coset representation of r, the
+    uniform superposition of r + k*n over k < 2**m. h is scratch.
+    """
+    cadd(nb+m)
+    cmpge(nb+m)
+    with declare('cosetinit{}_{}'.format(nb,m),
+                 [('r',nb+m), ('n',nb), ('q',m), ('h',nb+2*m+1), ('cla',adder_scratch(nb+m))]) as gate:
+        r, n, q, h, cla = gate.regs
+        for j in range(m):
+            padded = coset_padding(nb,m,j,n,h[:m])
+            gate.op('cadd{}'.format(nb+m), r, h[m], padded, q[j], cla)
+            gate.op('cmpge{}'.format(nb+m), padded, r, q[j], h[m:], cla)
+
+@cached
+def cosetmultbchain(nb,m,A,B,N):
+    """ s = s + B*x mod n in coset representation (a = A on input)
+
+    The constants B*2**i mod N are loaded into a and added with plain
+    controlled adders: there is no comparison, s only stays congruent mod N.
+    """
+    cadd(nb+m)
+    with declare('cosetmultbchain{nb}_{m}_{A}_{B}_{N}'.format(nb=nb,m=m,A=A,B=B,N=N),
+                 [('s',nb+m), ('a',nb), ('z',m+1), ('x',nb+m), ('cla',adder_scratch(nb+m))]) as gate:
+        s, a, z, x, cla = gate.regs
+        loaded = A
+        for i in range(nb+m):
+            xor_const(gate, a, loaded ^ (B*2**i)%N)
+            loaded = (B*2**i)%N
+            gate.op('cadd{}'.format(nb+m), s, z[0], a, z[1:], x[i], cla)
+        xor_const(gate, a, loaded ^ A)
+
+@cached
+def ccosetmultbchain(nb,m,A,B,C,N):
+    """ cosetmultbchain adding B*x when y is on and C*x when it is off """
+    cadd(nb+m)
+    with declare('ccosetmultbchain{nb}_{m}_{A}_{B}_{C}_{N}'.format(nb=nb,m=m,A=A,B=B,C=C,N=N),
+                 [('s',nb+m), ('a',nb), ('z',m+1), ('x',nb+m), 'y', ('cla',adder_scratch(nb+m))]) as gate:
+        s, a, z, x, y, cla = gate.regs
+        loaded_on, loaded_off = A, A
+        for i in range(nb+m):
+            xor_const(gate, a, loaded_on ^ (B*2**i)%N, y)
+            gate.op('x', y)
+            xor_const(gate, a, loaded_off ^ (C*2**i)%N, y)
+            gate.op('x', y)
+            loaded_on, loaded_off = (B*2**i)%N, (C*2**i)%N
+            gate.op('cadd{}'.format(nb+m), s, z[0], a, z[1:], x[i], cla)
+        xor_const(gate, a, loaded_on ^ A, y)
+        gate.op('x', y)
+        xor_const(gate, a, loaded_off ^ A, y)
+        gate.op('x', y)
+
+@cached
+def cosetmodularmult(nb,m,A,N):
+    """ modularmult on registers s and x in coset representation (s is
+    only cleared up to a multiple of N) """
+    A_inv = modular_inverse(A,N)
+    cosetmultbchain(nb,m,A,A,N)
+    cosetmultbchain(nb,m,A,(-A_inv)%N,N)
+    with declare('cosetmodularmult{nb}_{m}_{A}_{N}'.format(nb=nb,m=m,A=A,N=N),
+                 [('s',nb+m), ('a',nb), ('z',m+1), ('x',nb+m), ('cla',adder_scratch(nb+m))]) as gate:
+        s, a, z, x, cla = gate.regs
+        gate.op('cosetmultbchain{nb}_{m}_{A}_{B}_{N}'.format(nb=nb,m=m,A=A,B=A,N=N),
+                s, a, z, x, cla)
+        for i in range(nb+m):
+            gate.op('swap', x[i], s[i])
+        gate.op('cosetmultbchain{nb}_{m}_{A}_{B}_{N}'.format(nb=nb,m=m,A=A,B=(-A_inv)%N,N=N),
+                s, a, z, x, cla)
+
+@cached
+def ccosetmodularmult(nb,m,A,N):
+    """ cmodularmult through ccosetmultbchain, see cosetmodularmult """
+    A_inv = modular_inverse(A,N)
+    ccosetmultbchain(nb,m,A,A,1,N)
+    ccosetmultbchain(nb,m,A,(-A_inv)%N,N-1,N)
+    with declare('ccosetmodularmult{nb}_{m}_{A}_{N}'.format(nb=nb,m=m,A=A,N=N),
+                 [('s',nb+m), ('a',nb), ('z',m+1), ('x',nb+m), 'y', ('cla',adder_scratch(nb+m))]) as gate:
+        s, a, z, x, y, cla = gate.regs
+        gate.op('ccosetmultbchain{nb}_{m}_{A}_{B}_{C}_{N}'.format(nb=nb,m=m,A=A,B=A,C=1,N=N),
+                s, a, z, x, y, cla)
+        for i in range(nb+m):
+            gate.op('swap', x[i], s[i])
+        gate.op('ccosetmultbchain{nb}_{m}_{A}_{B}_{C}_{N}'.format(nb=nb,m=m,A=A,B=(-A_inv)%N,
+                                                                 C=N-1,N=N),
+                s, a, z, x, y, cla)
+
+@cached
+def cosetmodularexp(nb,m,A,N):
+    """ modularexp through ccosetmodularmult """
+    with declare('cosetmodularexp{nb}_{m}_{A}_{N}'.format(nb=nb,m=m,A=A,N=N),
+                 [('s',nb+m), ('a',nb), ('z',m+1), ('x',nb+m), ('y',nb), ('cla',adder_scratch(nb+m))]) as gate:
+        s, a, z, x, y, cla = gate.regs
+        for i in range(nb):
+            ccosetmodularmult(nb,m,A,N)
+            gate.op('ccosetmodularmult{nb}_{m}_{A}_{N}'.format(nb=nb,m=m,A=A,N=N),
+                    s, a, z, x, y[i], cla)
+            squareA(nb,A,N)
+            gate.op('squareA{nb}_{A}_{N}'.format(nb=nb,A=A,N=N), a)
+            A = (A*A)%N
+
+
+def obfuscate(nb,A_in,N):
+    rng = np.random.RandomState(41)
+    vars_dict={'a': 0, 'su':0, 'one': 0, 'num_init': 0}
+
+    with declare('obfuscate',
+                 [('a',nb), ('su',nb), ('n',nb), ('o',nb), ('x',nb), ('y',nb),
+                  ('sc',nb+1), 'ad', 'am', ('cla',adder_scratch(nb))]) as gate:
+        a, su, n, o, x, y, sc, ad, am, cla = gate.regs
+        regs = {'a': a, 'su': su, 'one': o, 'num_init': x}
+
+        # don't mess with the highest bits. We want all to be < N
+        for i in range(nb-3):
+            if rng.randint(0,2):
+                gate.op('x', a[i])
+                vars_dict['a']=vars_dict['a'] ^ (2**i)
+
+            if rng.randint(0,2):
+                gate.op('x', su[i])
+                vars_dict['su']=vars_dict['su'] ^ (2**i)
+
+            if rng.randint(0,2):
+                gate.op('x', o[i])
+                vars_dict['one']=vars_dict['one'] ^ (2**i)
+
+            if rng.randint(0,2):
+                gate.op('x', x[i])
+                vars_dict['num_init']=vars_dict['num_init'] ^ (2**i)
+
+        #print("After first random flips")
+        #for k,v in vars_dict.items():
+        #    print(k,v)
+        #print("")
+
+        r_vars = list(vars_dict.keys())
+        for i in range(10):
+            if rng.randint(0,2):
+                rng.shuffle(r_vars)
+                if vars_dict[r_vars[1]]!=0:
+                    gate.op('x', am)
+                    gate.op('caddmod{}'.format(nb),
+                            regs[r_vars[0]], regs[r_vars[1]], n, sc, ad, am, cla)
+                    gate.op('x', am)
+                    vars_dict[r_vars[0]] = (vars_dict[r_vars[0]] + vars_dict[r_vars[1]])%N
+                    #print(r_vars[0] + "=("+r_vars[0]+"+"+r_vars[1]+")%N="+str(vars_dict[r_vars[0]]))
+
+            if rng.randint(0,2):
+                rng.shuffle(r_vars)
+                gate.op('doublemod{}'.format(nb), regs[r_vars[0]], n, am, sc, cla)
+                if 2*vars_dict[r_vars[0]] >= N:
+                    gate.op('x', am)
+                vars_dict[r_vars[0]] = (2*vars_dict[r_vars[0]])%N
+                #print(r_vars[0] + "=(2*"+r_vars[0]+")%N="+str(vars_dict[r_vars[0]]))
+
+            if rng.randint(0,2):
+                rng.shuffle(r_vars)
+                gate.op('cmpge{}'.format(nb), regs[r_vars[1]], regs[r_vars[0]], ad, sc, cla)
+                if vars_dict[r_vars[0]]>=vars_dict[r_vars[1]]:
+                    gate.op('x', ad)
+
+            if rng.randint(0,2):
+                rng.shuffle(r_vars)
+                var1=vars_dict[r_vars[0]]
+                var2=vars_dict[r_vars[1]]
+                if var1!=0 and var2!=0:
+                    common = gcd(var1,var2)
+                    if common==1:
+                        modularmult(nb,var1,N)
+                        gate.op('modularmult{nb}_{A}_{N}'.format(nb=nb,A=var1,N=N),
+                                y, regs[r_vars[0]], n, sc, ad, am, regs[r_vars[1]], cla)
+                        #for k,v in vars_dict.items():
+                        #    print(k,v)
+                        #print(r_vars[1]+"="+r_vars[1]+"*"+r_vars[0]+"%N={}".format((vars_dict[r_vars[0]]*vars_dict[r_vars[1]])%N))
+                        vars_dict[r_vars[1]] = (vars_dict[r_vars[1]] * vars_dict[r_vars[0]])%N
+
+
+        #print("\nAfter full scramble")
+        #for k,v in vars_dict.items():
+        #    print(k,v)
+
+        for i in range(nb):
+            mask = 2**i
+            if (vars_dict['a'] & mask) ^ (A_in & mask):
+                gate.op('x', a[i])
+                vars_dict['a']=vars_dict['a'] ^ (2**i)
+
+            if (vars_dict['su'] & mask) ^ (0 & mask):
+                gate.op('x', su[i])
+                vars_dict['su']=vars_dict['su'] ^ (2**i)
+
+            if (vars_dict['one'] & mask) ^ (1 & mask):
+                gate.op('x', o[i])
+                vars_dict['one']=vars_dict['one'] ^ (2**i)
+
+            if (vars_dict['num_init'] & mask) ^ (1 & mask):
+                gate.op('x', x[i])
+                vars_dict['num_init']=vars_dict['num_init'] ^ (2**i)
 
-        src.extend(obfuscate_code.replace('[','').replace(']','').replace('one','o').replace('scratch','sc').replace('num_init','x').replace('ancilla_adder0','ad').replace('ancilla_mult0','am').split('\n'))
+        #print("\nFixed variables")
+        #for k,v in vars_dict.items():
+        #    print(k,v)
+        #print("")
 
-    obfuscate_header='    obfuscate {a},{s},{n},{o},{x},{y},{sc},ancilla_adder[0],ancilla_mult[0];'.format(a=arg_vec('a',nb),
+        #print("Expected: a={} s=0 one=1 num_init=1".format(A_in))
+
+    obfuscate_header='    obfuscate {a},{s},{n},{o},{x},{y},{sc},ancilla_adder[0],ancilla_mult[0]{cla};'.format(a=arg_vec('a',nb),
                                                                                                        s=arg_vec('su',nb),
                                                                                                        n=arg_vec('n',nb),
                                                                                                        o=arg_vec('one',nb),
                                                                                                        x=arg_vec('num_init',nb),
                                                                                                        y=arg_vec('yv',nb),
                                                                                                        sc=arg_vec('scratch',nb+1),
+                                                                                                       cla=lookahead_args(nb),
                                                                                                        )
     return obfuscate_header
 
+hidden_registers = {
+    'ancilla_adder': 'aa',
+    'ancilla_mult': 'ab',
+    'one': 'ac',
+    'num_init': 'an',
+    'su': 'af',
+    'scratch': 'kk',
+}
+
+def lookahead_args(n):
+    """ Trailing arguments passing the lookahead register to a gate whose
+    adders are n bits wide (none with the cdkm adder) """
+    return ''.join(',lookahead[{}]'.format(i) for i in range(adder_scratch(n)))
+
+identifier = re.compile(r'([A-Za-z_][A-Za-z0-9_]*)')
+gate_name = re.compile(r'\n(?:gate|// alias) (\S+)')
+
 def hide_gates_names(code,hide_names):
-    gates_names = []
-    gates_table = {}
-    for l in code.split('\n'):
-        if l.startswith('gate '):
-            tok = l.split(' ')
-            gates_names.append(tok[1])
+    """ Renames gates (and main registers) in a single pass over the code
+
+    Only whole identifiers are renamed, so add5 is never touched inside
+    caddmod5.
+    """
+    # a literal newline rather than ^ with re.M, which is tried at every character
+    gates_names = gate_name.findall('\n'+code)
     gates_names.sort(key=len,reverse=True)
+    gates_table = {}
     for i,g in enumerate(gates_names):
         if hide_names:
             new_name = "sec_qgate_{}".format(i)
-            code = code.replace(g,new_name)
         else:
             new_name = g
         gates_table[g] = new_name
+    if hide_names:
+        renames = dict(hidden_registers)
+        renames.update(gates_table)
+        code = rename_identifiers(code,renames)
     return code,gates_table
 
 
-def synth(nb,A,N,obfuscate_setup):
+def rename_identifiers(code,renames):
+    rename = renames.get
+    # identifiers land on the odd positions
+    tokens = identifier.split(code)
+    tokens[1::2] = [rename(t, t) for t in tokens[1::2]]
+    return ''.join(tokens)
+
+
+class QasmStream:
+    """ Writes each gate to f as soon as its declaration closes
+
+    Only the gate being built (and the ones enclosing it) stay in memory.
+    With hide_names gates are numbered in declaration order, since the
+    full list of names is not known up front. Generators build their gates
+    as gate_class.
+    """
+    gate_class = Gate
+
+    def __init__(self, f, hide_names):
+        self.f = f
+        self.hide_names = hide_names
+        self.gates_table = {}
+        self.renames = dict(hidden_registers) if hide_names else {}
+
+    def write(self, code):
+        if self.hide_names:
+            code = rename_identifiers(code,self.renames)
+        self.f.write(code + '\n')
+
+    def write_gate(self, gate):
+        if self.hide_names:
+            new_name = "sec_qgate_{}".format(len(self.gates_table))
+            self.renames[gate.name] = new_name
+        else:
+            new_name = gate.name
+        self.gates_table[gate.name] = new_name
+        self.write('\n'.join(gate.qasm()))
+
+
+multipliers = ('doubling', 'montgomery')
+
+def main_program(nb,A,N,obfuscate_setup,window=1,multiplier='doubling',coset=0):
+    """ Declares every gate the main program needs and returns its code
+
+    With window > 1 the exponentiation goes through wmodularexp, which
+    needs 2**window more ancillas. With the montgomery multiplier it goes
+    through mmodularexp (or wmmodularexp), which needs 2*nb+3 more. With
+    coset = m > 0 su and num_init get m padding qubits and are put in coset
+    representation for cosetmodularexp, which needs 3*m more ancillas
+    (window and multiplier are then ignored) and m >= min_coset_padding(nb)
+    to be reliable. With the lookahead adder
+    every gate also takes the clean ancillas of its adders, the lookahead
+    register.
+    """
     multbchain(nb)
     modularmult(nb,A,N)
     cmodularmult(nb,A,N)
     modularexp(nb,A,N)
 
+    extra_qregs = ''
+    if window > 1:
+        wmodularexp(nb,window,A,N)
+        extra_qregs += '\n    qreg window[{}];'.format(2**window)
+    if multiplier == 'montgomery':
+        mmodularexp(nb,A,N)
+        extra_qregs += '\n    qreg montgomery[{}];'.format(2*nb+3)
+
+    if coset:
+        cosetinit(nb,coset)
+        cosetmodularexp(nb,coset,A,N)
+        extra_qregs = '\n    qreg coset[{}];'.format(3*coset)
+        q = arg_vec('coset',coset)
+        h = ','.join([arg_vec('scratch',nb+1)] +
+                     ['coset[{}]'.format(i) for i in range(coset,3*coset)])
+        modexp = '\n    '.join(['// coset representation of su = 0 and num_init = 1'] +
+                               ['h coset[{}];'.format(i) for i in range(coset)] +
+                               ['cosetinit{nb}_{m} {su},{n},'+q+','+h+'{cla};'] +
+                               ['h coset[{}];'.format(i) for i in range(coset)] +
+                               ['cosetinit{nb}_{m} {x},{n},'+q+','+h+'{cla};',
+                                'cosetmodularexp{nb}_{m}_{A}_{N} {su},{a},'+
+                                arg_vec('coset',coset+1)+',{x},{yv}{cla};'])
+    elif window > 1 and multiplier == 'montgomery':
+        wmmodularexp(nb,window,A,N)
+        modexp = 'wmmodularexp{nb}_{k}_{A}_{N} {su},{a},{n},{sc},ancilla_adder[0],ancilla_mult[0],{x},{yv},{e},{mont}{cla};'
+    elif window > 1:
+        modexp = 'wmodularexp{nb}_{k}_{A}_{N} {su},{a},{n},{sc},ancilla_adder[0],ancilla_mult[0],{x},{yv},{e}{cla};'
+    elif multiplier == 'montgomery':
+        modexp = 'mmodularexp{nb}_{A}_{N} {su},{a},{n},{sc},ancilla_adder[0],ancilla_mult[0],{x},{o},{yv},{mont}{cla};'
+    else:
+        modexp = 'modularexp{nb}_{A}_{N} {su},{a},{n},{sc},ancilla_adder[0],ancilla_mult[0],{x},{o},{yv}{cla};'
+
+    # the widest adder of the exponentiation, smaller ones reuse its ancillas
+    width = nb+coset if coset else nb+2 if multiplier == 'montgomery' else nb
+    if adder_scratch(width):
+        extra_qregs += '\n    qreg lookahead[{}];'.format(adder_scratch(width))
+
     crd=[]
     for i in range(nb):
         crd.append("    creg cr{i}[1];".format(i=i))
@@ -993,40 +1842,240 @@ def synth(nb,A,N,obfuscate_setup):
     iqft = '\n'.join(iqft)
 
 
-    qasm_code.append("""
-    qreg su[{nb}];
+    main_code = """
+    qreg su[{nbx}];
     qreg a[{nb}];
     qreg n[{nb}];
     qreg scratch[{nb1}];
     qreg ancilla_adder[1];
     qreg ancilla_mult[1];
-    qreg num_init[{nb}];
+    qreg num_init[{nbx}];
     qreg one[{nb}];
-    qreg yv[{nb}];
-    creg c[{nb}];
+    qreg yv[{nb}];{extra_qregs}
+    creg c[{nbx}];
 {crd}
 {set_n}
 {fg}
     h yv;
-    modularexp{nb}_{A}_{N} {su},{a},{n},{sc},ancilla_adder[0],ancilla_mult[0],{x},{o},{yv};
+    {modexp}
     measure num_init -> c;
 {iqft}
 
-    \n""".format(nb=nb,nb1=nb+1,A=A,N=N,
-               su=arg_vec('su',nb),
-               a=arg_vec('a',nb),
-               n=arg_vec('n',nb),
-               sc=arg_vec('scratch',nb+1),
-               x=arg_vec('num_init',nb),
-               o=arg_vec('one',nb),
-               yv=arg_vec('yv',nb),
+    \n""".format(nb=nb,nb1=nb+1,nbx=nb+coset,
+               extra_qregs=extra_qregs,
+               modexp=modexp.format(nb=nb,k=window,m=coset,A=A,N=N,
+                                    su=arg_vec('su',nb+coset),
+                                    a=arg_vec('a',nb),
+                                    n=arg_vec('n',nb),
+                                    sc=arg_vec('scratch',nb+1),
+                                    x=arg_vec('num_init',nb+coset),
+                                    o=arg_vec('one',nb),
+                                    yv=arg_vec('yv',nb),
+                                    e=arg_vec('window',2**window),
+                                    mont=arg_vec('montgomery',2*nb+3),
+                                    cla=lookahead_args(width)),
                fg=flip_gates,
                iqft=iqft,
                crd=crd,
                set_n=set_n,
-               ))
+               )
+
+    return main_code
+
+
+class Synthesizer:
+    """ Gate table and output of one circuit
+
+    Generators declare their gates into the synthesizer running synth()
+    in the current thread, so separate instances can be used concurrently
+    from different threads (or processes).
+
+    library is a list of gates (usually already rendered, see nb_library())
+    emitted first and never synthesized again. cache is an optional
+    GateCache serving the @cached generators, it needs the gates in
+    memory and so cannot be combined with a stream. With dedup identical
+    gates are emitted once, see dedup_gates(), and every dropped name is
+    recorded as an '// alias name kept' comment (which parser_qasm.py turns
+    into an alias of the kept function). With prune the gates the main
+    program does not use are dropped and kept in self.pruned. With
+    relabel uncontrolled swaps are absorbed first, see relabel_gates(), and
+    with optimize gate bodies then go through peephole_gates(), the number
+    of operations removed going to self.removed. Either way the gates as
+    synthesized are kept in self.unoptimized. adder picks the backend of
+    the adders and comparators, see adders.
+    """
+    def __init__(self, to_classical=False, stream=None, library=(), cache=None,
+                 dedup=False, prune=False, optimize=False, relabel=False, adder='cdkm'):
+        if stream is not None and (cache is not None or dedup or prune or optimize or relabel):
+            raise ValueError("gate cache, dedup, prune, optimize and relabel cannot be used while streaming")
+        self.to_classical = to_classical
+        self.stream = stream
+        self.gate_class = Gate if stream is None else stream.gate_class
+        self.cache = cache
+        self.dedup = dedup
+        self.prune = prune
+        self.optimize = optimize
+        self.relabel = relabel
+        self.adder = adder
+        self.unoptimized = []
+        self.removed = 0
+        self.aliases = {}
+        self.pruned = []
+        self.generated = set()
+        self.traces = []
+        self.gates_declared = {gate.name for gate in library}
+        self.gates = list(library)
+
+    def add_gate(self, gate):
+        if self.stream is not None:
+            self.stream.write_gate(gate)
+        else:
+            self.gates.append(gate)
+
+    @contextlib.contextmanager
+    def activated(self):
+        """ Makes generators called in this thread declare into self """
+        previous = getattr(active, 'synthesizer', None)
+        active.synthesizer = self
+        try:
+            yield self
+        finally:
+            active.synthesizer = previous
+
+    def synth(self, nb, A, N, obfuscate_setup, window=1, multiplier='doubling', coset=0):
+        """ Returns the QASM program (None when streaming) """
+        qasm_code = [qasm_header]
+        if self.to_classical:
+            # window, multiplier, coset and adder follow nb A N up to the
+            # last one that is not the default
+            options = [nb, A, N, window, multiplier, coset, self.adder]
+            while len(options) > 3 and options[-1] == (1, 'doubling', 0, 'cdkm')[len(options)-4]:
+                options.pop()
+            info = "//" + " ".join(str(o) for o in options)
+            qasm_code = [info]+qasm_code
+
+        with self.activated():
+            if self.stream is not None:
+                for code in qasm_code:
+                    self.stream.write(code)
+                for gate in self.gates:
+                    self.stream.write_gate(gate)
+                self.gates = []
+            main_code = main_program(nb,A,N,obfuscate_setup,window,multiplier,coset)
+
+        if self.stream is not None:
+            self.stream.f.write(rename_identifiers(main_code,self.stream.renames))
+            return None
+
+        if self.cache is not None:
+            self.cache.evict()
+
+        if self.relabel or self.optimize:
+            self.unoptimized = self.gates
+
+        if self.relabel:
+            self.gates = relabel_gates(self.gates)
+
+        if self.optimize:
+            self.gates, self.removed = peephole_gates(self.gates)
+
+        if self.dedup:
+            self.gates, self.aliases = dedup_gates(self.gates)
+            main_code = rename_identifiers(main_code, self.aliases)
+
+        if self.prune:
+            self.gates, self.pruned = prune_gates(self.gates, main_code)
+            kept = {gate.name for gate in self.gates}
+            self.aliases = {name: k for name, k in self.aliases.items() if k in kept}
+
+        gates_code = [line for gate in self.gates for line in gate.qasm()]
+        gates_code += ['// alias {} {}'.format(name, kept)
+                       for name, kept in self.aliases.items()]
+        return '\n'.join(qasm_code + gates_code + [main_code])
+
+
+default_synthesizer = Synthesizer()
+
+def current():
+    """ Synthesizer running in this thread (generators called on their own
+    declare into default_synthesizer) """
+    return getattr(active, 'synthesizer', None) or default_synthesizer
+
+
+def synth(nb,A,N,obfuscate_setup,window=1,multiplier='doubling',coset=0,adder='cdkm'):
+    return Synthesizer(adder=adder).synth(nb,A,N,obfuscate_setup,window,multiplier,coset)
+
+
+def nb_library(nb, adder='cdkm'):
+    """ Rendered gates depending only on nb, to seed Synthesizer(library=...)
+
+    These are the gates multbchain(nb) pulls in, which main_program()
+    declares first, so seeded circuits are identical to unseeded ones.
+    """
+    synthesizer = Synthesizer(adder=adder)
+    with synthesizer.activated():
+        multbchain(nb)
+    for gate in synthesizer.gates:
+        gate.qasm()
+    return synthesizer.gates
+
+
+def write_gates_table(gates_table, table_file):
+    with open(table_file, 'w') as f:
+        for k,v in gates_table.items():
+            f.write(k+": "+v+"\n")
+
+
+def write_circuit(code, gates_table, circuit_file, table_file):
+    write_gates_table(gates_table, table_file)
+    with open(circuit_file, 'w') as f:
+        f.write(code)
+
+
+batch_libraries = {}
+
+def batch_init(libraries):
+    batch_libraries.update(libraries)
+
+def batch_job(job):
+    """ Synthesizes one circuit of a batch in a worker process """
+    (nb, A, N, obfuscate_setup, to_classical, hide_names, outdir, cache, dedup, prune,
+     optimize, relabel, window, multiplier, coset, adder) = job
+    synthesizer = Synthesizer(to_classical, library=batch_libraries[nb], cache=cache,
+                              dedup=dedup, prune=prune, optimize=optimize, relabel=relabel,
+                              adder=adder)
+    code = synthesizer.synth(nb,A,N,obfuscate_setup,window,multiplier,coset)
+    code,gates_table = hide_gates_names(code,hide_names)
+    suffix = '{}_{}_{}'.format(nb,A,N)
+    circuit_file = os.path.join(outdir, 'circuit_{}.qasm'.format(suffix))
+    write_circuit(code, gates_table, circuit_file,
+                  os.path.join(outdir, 'gates_table_{}.txt'.format(suffix)))
+    return circuit_file
+
+
+def read_batch(f):
+    """ (nb, A, N) tuples, one per line, '#' starts a comment """
+    jobs = []
+    for line in f:
+        line = line.split('#')[0].split()
+        if line:
+            jobs.append(tuple(int(v) for v in line))
+    return jobs
+
+
+def synth_batch(jobs, obfuscate_setup, to_classical, hide_names, outdir,
+                workers=None, cache=None, dedup=False, prune=False, optimize=False,
+                relabel=False, window=1, multiplier='doubling', coset=0, adder='cdkm'):
+    """ Builds each nb library once and fans circuits out to a process pool """
+    libraries = {nb: nb_library(nb, adder) for nb in sorted({nb for nb, _, _ in jobs})}
+    jobs = [(nb, A, N, obfuscate_setup, to_classical, hide_names, outdir, cache, dedup, prune,
+             optimize, relabel, window, multiplier, coset, adder)
+            for nb, A, N in jobs]
+    with ProcessPoolExecutor(workers, initializer=batch_init,
+                             initargs=(libraries,)) as executor:
+        for circuit_file in executor.map(batch_job, jobs):
+            print(circuit_file)
 
-    return '\n'.join(qasm_code)
 
 def extended_euclides(a,b):
     s = 0
@@ -1059,6 +2108,22 @@ if __name__ == '__main__':
     parser.add_argument('--obfuscate_setup',default=False,const=True,action='store_const',help='Gates setup is scrambled')
     parser.add_argument('--to_classical',default=False,const=True,action='store_const',help='Extra info to use in testing')
     parser.add_argument('--hide_names',default=False,const=True,action='store_const',help='Hides gates names')
+    parser.add_argument('--stream',default=False,const=True,action='store_const',help='Writes each gate as soon as it is built (hidden names are numbered in declaration order)')
+    parser.add_argument('--gzip',default=False,const=True,action='store_const',help='Writes circuit.qasm.gz (implies --stream)')
+    parser.add_argument('--batch',default=None,help='File with one "nb A N" per line, writes circuit_nb_A_N.qasm for each')
+    parser.add_argument('--outdir',default='.',help='Output directory for --batch')
+    parser.add_argument('--jobs',type=int,default=None,help='Worker processes for --batch (default: one per CPU)')
+    parser.add_argument('--cache',default=False,const=True,action='store_const',help='Reuses gates synthesized by previous runs (not with --stream)')
+    parser.add_argument('--cache_dir',default=None,help='Gate cache directory (default: ~/.cache/bletchley_synth)')
+    parser.add_argument('--cache_size',type=int,default=1024,help='Gate cache size limit in MB')
+    parser.add_argument('--dedup',default=False,const=True,action='store_const',help='Emits structurally identical gates once (not with --stream)')
+    parser.add_argument('--optimize',default=False,const=True,action='store_const',help='Cancels inverse operations and negated controls in gate bodies (not with --stream)')
+    parser.add_argument('--relabel',default=False,const=True,action='store_const',help='Absorbs uncontrolled swaps into a relabeling of the wires (not with --stream)')
+    parser.add_argument('--window',type=int,default=1,help='Exponent bits per modular multiplication (needs 2**window more ancillas)')
+    parser.add_argument('--multiplier',default='doubling',choices=multipliers,help='Modular multiplier: doubling (doublemod/caddmod chain) or montgomery (N odd, needs 2*nb+3 more ancillas)')
+    parser.add_argument('--coset',type=int,default=0,help='Padding qubits of the coset representation, replaces the modular adders by plain ones (approximate, at least min_coset_padding(nb), not with --window or --multiplier)')
+    parser.add_argument('--adder',default='cdkm',choices=adders,help='Adder backend: cdkm (ripple carry, one ancilla) or lookahead (logarithmic depth, about 2n more ancillas)')
+    parser.add_argument('--prune',default=False,const=True,action='store_const',help='Drops the gates the main program does not use (not with --stream, test_code.py needs some of them)')
 
     args = parser.parse_args()
 
@@ -1069,21 +2134,92 @@ if __name__ == '__main__':
     to_classical = args.to_classical
     hide_names = args.hide_names
 
+    if args.coset and (args.window > 1 or args.multiplier != 'doubling'):
+        print("--coset cannot be combined with --window or --multiplier")
+        print("No output generated")
+        sys.exit(-1)
+
+    if (args.stream or args.gzip) and (args.cache or args.dedup or args.prune or args.optimize
+                                       or args.relabel):
+        print("--stream and --gzip cannot be combined with --cache, --dedup, --prune, "
+              "--optimize or --relabel")
+        print("No output generated")
+        sys.exit(-1)
+
+    def check_coset(nb):
+        if args.coset and args.coset < min_coset_padding(nb):
+            print("--coset {} is too small for nb={}: its {} coset additions need m >= {}".format(
+                        args.coset, nb, coset_additions(nb,args.coset), min_coset_padding(nb)))
+            print("No output generated")
+            sys.exit(-1)
+
+    cache = None
+    if args.cache:
+        cache = GateCache(args.cache_dir, args.cache_size*2**20)
+
+    if args.batch:
+        with open(args.batch) as f:
+            jobs = read_batch(f)
+        for nb, A, N in jobs:
+            check_coset(nb)
+            if gcd(A,N)!=1:
+                print("A={} and N={} must be coprime, but gcd(A,N)={}".format(A,N,gcd(A,N)))
+                print("No output generated")
+                sys.exit(-1)
+            if args.multiplier == 'montgomery' and N%2 == 0:
+                print("The montgomery multiplier needs N odd, but N={}".format(N))
+                print("No output generated")
+                sys.exit(-1)
+        os.makedirs(args.outdir, exist_ok=True)
+        synth_batch(jobs, obfuscate_setup, to_classical, hide_names,
+                    args.outdir, args.jobs, cache, args.dedup, args.prune,
+                    args.optimize, args.relabel, args.window, args.multiplier, args.coset,
+                    args.adder)
+        sys.exit(0)
+
+    check_coset(nb)
+
     if gcd(A,N)!=1:
         print("A={} and N={} must be coprime, but gcd(A,N)={}".format(A,N,gcd(A,N)))
         print("No output generated")
         sys.exit(-1)
 
-    if to_classical:
-        qasm_code = ["//{} {} {}".format(nb,A,N)]+qasm_code
-
-    final_code = synth(nb,A,N,obfuscate_setup)
-    final_code,gates_table = hide_gates_names(final_code,hide_names)
-    if hide_names:
-        final_code = final_code.replace('ancilla_adder','aa').replace('ancilla_mult','ab').replace('one[','ac[').replace('num_init','an').replace('su[','af[').replace('scratch','kk')
+    if args.multiplier == 'montgomery' and N%2 == 0:
+        print("The montgomery multiplier needs N odd, but N={}".format(N))
+        print("No output generated")
+        sys.exit(-1)
 
-    with open('gates_table.txt', 'w') as f:
-        for k,v in gates_table.items():
-            f.write(k+": "+v+"\n")
-    with open('circuit.qasm', 'w') as f:
-        f.write(final_code)
+    if args.stream or args.gzip:
+        if args.gzip:
+            f = gzip.open('circuit.qasm.gz', 'wt')
+        else:
+            f = open('circuit.qasm', 'w')
+        with f:
+            stream = QasmStream(f, hide_names)
+            Synthesizer(to_classical,stream,adder=args.adder).synth(nb,A,N,obfuscate_setup,args.window,
+                                                   args.multiplier,args.coset)
+        write_gates_table(stream.gates_table, 'gates_table.txt')
+    else:
+        synthesizer = Synthesizer(to_classical,cache=cache,dedup=args.dedup,
+                                  prune=args.prune,optimize=args.optimize,
+                                  relabel=args.relabel,adder=args.adder)
+        final_code = synthesizer.synth(nb,A,N,obfuscate_setup,args.window,args.multiplier,
+                                       args.coset)
+        if args.optimize:
+            print("optimize: {} operations removed from gate bodies".format(synthesizer.removed))
+        if args.optimize or args.relabel:
+            import estimate
+            counts = [estimate.count_program(final_code, estimate.count_gates(
+                            [(gate.name, [name for name, _ in gate.ops]) for gate in gates]))[0]
+                      for gates in (synthesizer.unoptimized, synthesizer.gates)]
+            print("program primitive counts:")
+            for name, before, after in zip(estimate.primitives, *counts):
+                print("  {:<6} {} -> {}".format(name, before, after))
+        if args.dedup:
+            print("dedup: {} gates merged into identical ones".format(len(synthesizer.aliases)))
+        if args.prune:
+            src = [line for gate in synthesizer.pruned for line in gate.qasm()]
+            print("prune: dropped {} unused gates, {} lines, {} bytes".format(
+                        len(synthesizer.pruned), len(src), sum(len(l)+1 for l in src)))
+        final_code,gates_table = hide_gates_names(final_code,hide_names)
+        write_circuit(final_code, gates_table, 'circuit.qasm', 'gates_table.txt')
@@ -1,8 +1,24 @@
+import io
 import sys
 import classical_code as cc
 import unittest as ut
 import numpy as np
 
+try:
+    import classical_buffer as cb
+except ImportError:
+    cb = None
+
+try:
+    import classical_flat as cf
+except ImportError:
+    cf = None
+
+try:
+    import classical_opcodes as co
+except ImportError:
+    co = None
+
 #Detect number of bits
 with open("classical_code.py") as f:
     line = f.readline()
@@ -12,9 +28,31 @@ with open("classical_code.py") as f:
         NUM_BITS = int(tok[0])
         CONST_A = int(tok[1])
         CONST_N = int(tok[2])
+        WINDOW = int(tok[3]) if len(tok) > 3 else 1
+        MULTIPLIER = tok[4].strip() if len(tok) > 4 else 'doubling'
+        COSET = int(tok[5]) if len(tok) > 5 else 0
+        ADDER = tok[6].strip() if len(tok) > 6 else 'cdkm'
     else:
         print("Expected nb A N in the first line. Re-run synth with option --to_classical and parse the output again")
 
+# Number of parameters of every gate. With the lookahead adder gates also
+# take its clean ancillas as trailing parameters, which the tests leave at 0.
+NUM_PARAMS = {name: func.__code__.co_argcount for name, func in vars(cc).items()
+              if callable(func) and hasattr(func, '__code__')}
+
+def with_zero_ancillas(func, num_params):
+    def padded(*wires):
+        return func(*(wires + (0,)*(num_params-len(wires))))
+    return padded
+
+if ADDER == 'lookahead':
+    for name, num_params in NUM_PARAMS.items():
+        setattr(cc, name, with_zero_ancillas(getattr(cc, name), num_params))
+
+def pad_input(name, bits):
+    """ bits followed by the zeroed lookahead ancillas of gate name """
+    return bits + [0]*(NUM_PARAMS[name]-len(bits))
+
 def convert_to_bits(num,nbits):
     return [ (num//2**i) % 2 for i in range(nbits)]
 
@@ -49,6 +87,52 @@ def modular_inverse(a,b):
         old_s,s = s,old_s-q*s
     return old_s%b
 
+
+_plain_circuits = {}
+
+def plain_circuit(nb=NUM_BITS, A=CONST_A, N=CONST_N, **options):
+    """ QASM of nb A N synthesized once per options (window, multiplier...)
+    with the same adder, without --obfuscate_setup or --hide_names whatever
+    circuit.qasm was built with """
+    key = (nb, A, N) + tuple(sorted(options.items()))
+    if key not in _plain_circuits:
+        import synth
+        _plain_circuits[key] = synth.synth(nb, A, N, False, adder=ADDER, **options)
+    return _plain_circuits[key]
+
+def gate_functions(code):
+    """ Namespace of the bit-sliced gate functions of QASM code """
+    import parser_qasm as pq
+    _, gates, _ = pq.read_gates(io.StringIO(code))
+    ns = {}
+    exec('\n'.join(pq.emit_tuple(gates)), ns)
+    return ns
+
+class SlicedTestCase(ut.TestCase):
+    """ Evaluates all input vectors of a test in a single bit-sliced call
+
+    The gate functions come from classical_code.py, or from ns, a namespace
+    of gate_functions(), whose trailing lookahead ancillas are left at 0.
+    """
+    def eval_sliced(self, func_name, cases, ns=None):
+        if not cases:
+            return []
+        inputs = [bits_from_nums(*list_of_nums) for list_of_nums in cases]
+        wires = [sum(bits[w] << k for k,bits in enumerate(inputs))
+                                for w in range(len(inputs[0]))]
+        if ns is None:
+            cc.set_lanes(len(inputs))
+            func_output = getattr(cc,func_name)(*wires)
+        else:
+            ns['set_lanes'](len(inputs))
+            func = ns[func_name]
+            func_output = func(*(wires + [0]*(func.__code__.co_argcount-len(wires))))
+        return [nums_from_bits([(o >> k) & 1 for o in func_output], list_of_nums)
+                                for k,list_of_nums in enumerate(cases)]
+
+    def tearDown(self):
+        cc.set_lanes(1)
+
 class TestAdd(ut.TestCase):
     def test_with_overflow(self):
         for i in range(2**(NUM_BITS-1)):
@@ -91,25 +175,19 @@ class TestIncrementDecrement(ut.TestCase):
             self.assertEqual(i-1,conv[0])
             self.assertEqual(0,conv[1])
 
-class TestCmb(ut.TestCase):
+class TestCmb(SlicedTestCase):
     def test_no(self):
-        for i,j in ((a,b) for a in range(2**NUM_BITS) for b in range(2**NUM_BITS)):
-            if i+j>=2**NUM_BITS:
-                continue
-            list_of_nums = [(0,1),(i,NUM_BITS),(0,1),(j,NUM_BITS)]
-            func_input = bits_from_nums(*list_of_nums)
-            func_output = getattr(cc,"cmb{}".format(NUM_BITS))(*func_input)
-            conv = nums_from_bits(func_output, list_of_nums)
+        cases = [[(0,1),(i,NUM_BITS),(0,1),(j,NUM_BITS)]
+                    for i in range(2**NUM_BITS) for j in range(2**NUM_BITS)
+                    if i+j<2**NUM_BITS]
+        for conv in self.eval_sliced("cmb{}".format(NUM_BITS), cases):
             self.assertEqual(0,conv[0])
 
     def test_yes(self):
-        for i,j in ((a,b) for a in range(2**NUM_BITS) for b in range(2**NUM_BITS)):
-            if i+j<2**NUM_BITS:
-                continue
-            list_of_nums = [(0,1),(i,NUM_BITS),(0,1),(j,NUM_BITS)]
-            func_input = bits_from_nums(*list_of_nums)
-            func_output = getattr(cc,"cmb{}".format(NUM_BITS))(*func_input)
-            conv = nums_from_bits(func_output, list_of_nums)
+        cases = [[(0,1),(i,NUM_BITS),(0,1),(j,NUM_BITS)]
+                    for i in range(2**NUM_BITS) for j in range(2**NUM_BITS)
+                    if i+j>=2**NUM_BITS]
+        for conv in self.eval_sliced("cmb{}".format(NUM_BITS), cases):
             self.assertEqual(1,conv[0])
 
 class TestCmpge(ut.TestCase):
@@ -207,80 +285,90 @@ class TestDoubleMod(ut.TestCase):
                 conv = nums_from_bits(func_output, list_of_nums)
                 self.assertEqual( (2*i) % n,conv[0])
 
-class TestCAddMod(ut.TestCase):
+class TestCAddMod(SlicedTestCase):
     def test_all_combs_enabled(self):
-        for n in range(3,2**(NUM_BITS-1)):
-            # b is anything
-            # a will never be zero, or we will have already found a factor of N
-            for i,j in [(b,a) for b in range(0,2**(NUM_BITS-1)-1) for a in range(1,2**(NUM_BITS-1)-1)]:
-                if i>=n or j>=n:
-                    continue
-                list_of_nums = [(i,NUM_BITS),(j,NUM_BITS),(n,NUM_BITS),(0,NUM_BITS+1),(0,1),(1,1)]
-                func_input = bits_from_nums(*list_of_nums)
-                func_output = getattr(cc,"caddmod{}".format(NUM_BITS))(*func_input)
-                conv = nums_from_bits(func_output, list_of_nums)
-                self.assertEqual( (i+j) % n,conv[0])
-                self.assertEqual(0,conv[4])
+        # b is anything
+        # a will never be zero, or we will have already found a factor of N
+        cases = [[(i,NUM_BITS),(j,NUM_BITS),(n,NUM_BITS),(0,NUM_BITS+1),(0,1),(1,1)]
+                    for n in range(3,2**(NUM_BITS-1))
+                    for i in range(0,2**(NUM_BITS-1)-1)
+                    for j in range(1,2**(NUM_BITS-1)-1)
+                    if i<n and j<n]
+        convs = self.eval_sliced("caddmod{}".format(NUM_BITS), cases)
+        for list_of_nums,conv in zip(cases,convs):
+            (i,_),(j,_),(n,_) = list_of_nums[:3]
+            self.assertEqual( (i+j) % n,conv[0])
+            self.assertEqual(0,conv[4])
     def test_all_combs_disabled(self):
-        for n in range(3,2**(NUM_BITS-1)):
-            # a will never be zero
-            for i,j in [(b,a) for b in range(0,2**(NUM_BITS-1)-1) for a in range(1,2**(NUM_BITS-1)-1)]:
-                if i>=n or j>=n:
-                    continue
-                list_of_nums = [(i,NUM_BITS),(j,NUM_BITS),(n,NUM_BITS),(0,NUM_BITS+1),(0,1),(0,1)]
-                func_input = bits_from_nums(*list_of_nums)
-                func_output = getattr(cc,"caddmod{}".format(NUM_BITS))(*func_input)
-                conv = nums_from_bits(func_output, list_of_nums)
-                self.assertEqual( i%n, conv[0])
-                self.assertEqual(0,conv[4])
+        # a will never be zero
+        cases = [[(i,NUM_BITS),(j,NUM_BITS),(n,NUM_BITS),(0,NUM_BITS+1),(0,1),(0,1)]
+                    for n in range(3,2**(NUM_BITS-1))
+                    for i in range(0,2**(NUM_BITS-1)-1)
+                    for j in range(1,2**(NUM_BITS-1)-1)
+                    if i<n and j<n]
+        convs = self.eval_sliced("caddmod{}".format(NUM_BITS), cases)
+        for list_of_nums,conv in zip(cases,convs):
+            (i,_),(j,_),(n,_) = list_of_nums[:3]
+            self.assertEqual( i%n, conv[0])
+            self.assertEqual(0,conv[4])
+    def test_zero(self):
+        # adding a = 0 must leave the comparison flag clean too
+        cases = [[(i,NUM_BITS),(0,NUM_BITS),(n,NUM_BITS),(0,NUM_BITS+1),(0,1),(x,1)]
+                    for n in range(3,2**(NUM_BITS-1))
+                    for i in range(n)
+                    for x in (0,1)]
+        convs = self.eval_sliced("caddmod{}".format(NUM_BITS), cases)
+        for list_of_nums,conv in zip(cases,convs):
+            self.assertEqual(list_of_nums[0][0],conv[0])
+            self.assertEqual(0,conv[3])
+            self.assertEqual(0,conv[4])
 
 
-class TestMultBStage(ut.TestCase):
+class TestMultBStage(SlicedTestCase):
     def test_all_pairs_enabled(self):
-        for n in range(3,2**(NUM_BITS-1)-1):
-            for i,j in [(b,a) for b in range(0,2**(NUM_BITS-1)-1) for a in range(1,2**(NUM_BITS-1)-1)]:
-                if i>=n or j>=n:
-                    continue
-                list_of_nums = [(i,NUM_BITS),(j,NUM_BITS),(n,NUM_BITS),(0,NUM_BITS+2),(0,1),(1,1)]
-                func_input = bits_from_nums(*list_of_nums)
-                func_output = getattr(cc,"multbstage{}".format(NUM_BITS))(*func_input)
-                conv = nums_from_bits(func_output, list_of_nums)
-                self.assertEqual( (i+j) % n,conv[0])
-                self.assertEqual( (2*j) % n,conv[1])
-                self.assertEqual( n, conv[2])
-                self.assertEqual( 0, conv[3])
-                self.assertEqual( 1, conv[5])
+        cases = [[(i,NUM_BITS),(j,NUM_BITS),(n,NUM_BITS),(0,NUM_BITS+2),(0,1),(1,1)]
+                    for n in range(3,2**(NUM_BITS-1)-1)
+                    for i in range(0,2**(NUM_BITS-1)-1)
+                    for j in range(1,2**(NUM_BITS-1)-1)
+                    if i<n and j<n]
+        convs = self.eval_sliced("multbstage{}".format(NUM_BITS), cases)
+        for list_of_nums,conv in zip(cases,convs):
+            (i,_),(j,_),(n,_) = list_of_nums[:3]
+            self.assertEqual( (i+j) % n,conv[0])
+            self.assertEqual( (2*j) % n,conv[1])
+            self.assertEqual( n, conv[2])
+            self.assertEqual( 0, conv[3])
+            self.assertEqual( 1, conv[5])
     def test_all_pairs_disabled(self):
-        for n in range(3,2**(NUM_BITS-1)-1):
-            for i,j in [(b,a) for b in range(0,2**(NUM_BITS-1)-1) for a in range(1,2**(NUM_BITS-1)-1)]:
-                if i>=n or j>=n:
-                    continue
-                list_of_nums = [(i,NUM_BITS),(j,NUM_BITS),(n,NUM_BITS),(0,NUM_BITS+2),(0,1),(0,1)]
-                func_input = bits_from_nums(*list_of_nums)
-                func_output = getattr(cc,"multbstage{}".format(NUM_BITS))(*func_input)
-                conv = nums_from_bits(func_output, list_of_nums)
-                self.assertEqual( (i) % n,conv[0])
-                self.assertEqual( (2*j) % n,conv[1])
-                self.assertEqual( n, conv[2])
-                self.assertEqual( 0, conv[3])
-                self.assertEqual( 0, conv[5])
+        cases = [[(i,NUM_BITS),(j,NUM_BITS),(n,NUM_BITS),(0,NUM_BITS+2),(0,1),(0,1)]
+                    for n in range(3,2**(NUM_BITS-1)-1)
+                    for i in range(0,2**(NUM_BITS-1)-1)
+                    for j in range(1,2**(NUM_BITS-1)-1)
+                    if i<n and j<n]
+        convs = self.eval_sliced("multbstage{}".format(NUM_BITS), cases)
+        for list_of_nums,conv in zip(cases,convs):
+            (i,_),(j,_),(n,_) = list_of_nums[:3]
+            self.assertEqual( (i) % n,conv[0])
+            self.assertEqual( (2*j) % n,conv[1])
+            self.assertEqual( n, conv[2])
+            self.assertEqual( 0, conv[3])
+            self.assertEqual( 0, conv[5])
 
 
-class TestMultBChain(ut.TestCase):
+class TestMultBChain(SlicedTestCase):
     def test_all_vals(self):
-        for n in range(3,2**(NUM_BITS-1)):
-            if n%2 == 0:
-                continue
-            for a,val in [(i,j) for i in range(1,n) for j in range(0,n)]:
-                list_of_nums = [(0,NUM_BITS),(a,NUM_BITS),(n,NUM_BITS),(0,NUM_BITS+2),(0,NUM_BITS),(val,NUM_BITS)]
-                func_input = bits_from_nums(*list_of_nums)
-                func_output = getattr(cc,"multbchain{}".format(NUM_BITS))(*func_input)
-                conv = nums_from_bits(func_output, list_of_nums)
-                self.assertEqual( (a*val) % n,conv[0])
-                self.assertEqual( (a*2**NUM_BITS) % n,conv[1])
-                self.assertEqual( n, conv[2])
-                self.assertEqual( 0, conv[3])
-                self.assertEqual( val, conv[5])
+        cases = [[(0,NUM_BITS),(a,NUM_BITS),(n,NUM_BITS),(0,NUM_BITS+2),(0,NUM_BITS),(val,NUM_BITS)]
+                    for n in range(3,2**(NUM_BITS-1)) if n%2 != 0
+                    for a in range(1,n) for val in range(0,n)]
+        convs = self.eval_sliced("multbchain{}".format(NUM_BITS), cases)
+        for list_of_nums,conv in zip(cases,convs):
+            (a,_),(n,_) = list_of_nums[1:3]
+            val = list_of_nums[5][0]
+            self.assertEqual( (a*val) % n,conv[0])
+            self.assertEqual( (a*2**NUM_BITS) % n,conv[1])
+            self.assertEqual( n, conv[2])
+            self.assertEqual( 0, conv[3])
+            self.assertEqual( val, conv[5])
 
 class TestSpecificMultBChain(ut.TestCase):
     def test_all_x(self):
@@ -445,19 +533,17 @@ class TestCModularMult(ut.TestCase):
             self.assertEqual(1,conv[5])
             self.assertEqual(0,conv[6])
 
-class TestModularExp(ut.TestCase):
+class TestModularExp(SlicedTestCase):
     def test_all_vals(self):
-        for y in range(2**(NUM_BITS)-1):
-            list_of_nums = [(0,NUM_BITS),
-                            (CONST_A,NUM_BITS),
-                            (CONST_N,NUM_BITS),
-                            (0,NUM_BITS+3),
-                            (1,NUM_BITS),
-                            (1,NUM_BITS),
-                            (y,NUM_BITS)]
-            func_input = bits_from_nums(*list_of_nums)
-            func_output = getattr(cc,'modularexp{nb}_{A}_{N}'.format(nb=NUM_BITS, A=CONST_A, N=CONST_N))(*func_input)
-            conv = nums_from_bits(func_output, list_of_nums)
+        cases = [[(0,NUM_BITS),
+                  (CONST_A,NUM_BITS),
+                  (CONST_N,NUM_BITS),
+                  (0,NUM_BITS+3),
+                  (1,NUM_BITS),
+                  (1,NUM_BITS),
+                  (y,NUM_BITS)] for y in range(2**(NUM_BITS)-1)]
+        convs = self.eval_sliced('modularexp{nb}_{A}_{N}'.format(nb=NUM_BITS, A=CONST_A, N=CONST_N), cases)
+        for y,conv in enumerate(convs):
             self.assertEqual(0,conv[0])
             self.assertEqual((CONST_A**(2**NUM_BITS))%CONST_N,conv[1])
             self.assertEqual(CONST_N,conv[2])
@@ -466,6 +552,162 @@ class TestModularExp(ut.TestCase):
             self.assertEqual(1,conv[5])
             self.assertEqual(y,conv[6])
 
+@ut.skipIf(WINDOW == 1, "run synth.py with --window k to generate the windowed gates")
+class TestDecode(ut.TestCase):
+    def test_all_vals(self):
+        for w in range(2**WINDOW):
+            list_of_nums=[(w,WINDOW),(0,2**WINDOW)]
+            func_input = bits_from_nums(*list_of_nums)
+            func_output = getattr(cc,"decode{}".format(WINDOW))(*func_input)
+            conv = nums_from_bits(func_output, list_of_nums)
+            self.assertEqual(w,conv[0])
+            self.assertEqual(2**w,conv[1])
+
+@ut.skipIf(WINDOW == 1, "run synth.py with --window k to generate the windowed gates")
+class TestWModularMult(ut.TestCase):
+    def test_all_vals(self):
+        for w in range(2**WINDOW):
+            for x in range(1,CONST_N):
+                list_of_nums=[(0,NUM_BITS),(CONST_A,NUM_BITS),(CONST_N,NUM_BITS),(0,NUM_BITS+3),
+                              (x,NUM_BITS),(w,WINDOW),(0,2**WINDOW)]
+                func_input = bits_from_nums(*list_of_nums)
+                func_output = getattr(cc,"wmodularmult{nb}_{k}_{A}_{N}".format(
+                                        nb=NUM_BITS,k=WINDOW,
+                                        A=CONST_A,N=CONST_N)
+                                        )(*func_input)
+                conv = nums_from_bits(func_output, list_of_nums)
+                self.assertEqual(0,conv[0])
+                self.assertEqual(CONST_A,conv[1])
+                self.assertEqual(CONST_N,conv[2])
+                self.assertEqual(0,conv[3])
+                self.assertEqual((CONST_A**w*x)%CONST_N,conv[4])
+                self.assertEqual(w,conv[5])
+                self.assertEqual(0,conv[6])
+
+@ut.skipIf(WINDOW == 1, "run synth.py with --window k to generate the windowed gates")
+class TestWModularExp(SlicedTestCase):
+    def test_all_vals(self):
+        cases = [[(0,NUM_BITS),
+                  (CONST_A,NUM_BITS),
+                  (CONST_N,NUM_BITS),
+                  (0,NUM_BITS+3),
+                  (1,NUM_BITS),
+                  (y,NUM_BITS),
+                  (0,2**WINDOW)] for y in range(2**(NUM_BITS))]
+        convs = self.eval_sliced('wmodularexp{nb}_{k}_{A}_{N}'.format(
+                                    nb=NUM_BITS, k=WINDOW, A=CONST_A, N=CONST_N), cases)
+        for y,conv in enumerate(convs):
+            self.assertEqual(0,conv[0])
+            self.assertEqual((CONST_A**(2**NUM_BITS))%CONST_N,conv[1])
+            self.assertEqual(CONST_N,conv[2])
+            self.assertEqual(0,conv[3])
+            self.assertEqual((CONST_A**y)%CONST_N,conv[4])
+            self.assertEqual(y,conv[5])
+            self.assertEqual(0,conv[6])
+
+class TestWindowedExp(SlicedTestCase):
+    """ wmodularexp of circuits synthesized with --window k, whatever
+    circuit.qasm was built with, nb being a multiple of k or not """
+    def test_all_vals(self):
+        for nb, A, N in ((4,3,7), (5,7,15), (6,5,21)):
+            for k in (2, 3):
+                ns = gate_functions(plain_circuit(nb, A, N, window=k))
+                cases = [[(0,nb),(A,nb),(N,nb),(0,nb+3),(1,nb),(y,nb),(0,2**k)]
+                         for y in range(2**nb)]
+                convs = self.eval_sliced('wmodularexp{nb}_{k}_{A}_{N}'.format(
+                                            nb=nb, k=k, A=A, N=N), cases, ns)
+                for y,conv in enumerate(convs):
+                    self.assertEqual([0,pow(A,2**nb,N),N,0,pow(A,y,N),y,0], conv,
+                                     (nb, k, y))
+
+@ut.skipIf(MULTIPLIER != 'montgomery', "run synth.py with --multiplier montgomery to generate the Montgomery gates")
+class TestMontMult(SlicedTestCase):
+    def test_all_vals(self):
+        R_inv = modular_inverse(2**NUM_BITS,CONST_N)
+        cases = [[(0,NUM_BITS),(a,NUM_BITS),(CONST_N,NUM_BITS),(x,NUM_BITS),(0,3*NUM_BITS+6)]
+                 for a in range(CONST_N) for x in range(CONST_N)]
+        convs = self.eval_sliced('montmult{}'.format(NUM_BITS), cases)
+        for case,conv in zip(cases,convs):
+            a, x = case[1][0], case[3][0]
+            self.assertEqual((a*x*R_inv)%CONST_N,conv[0])
+            self.assertEqual([a,CONST_N,x,0],conv[1:])
+
+@ut.skipIf(MULTIPLIER != 'montgomery', "run synth.py with --multiplier montgomery to generate the Montgomery gates")
+class TestCMModularMult(ut.TestCase):
+    def test_all_vals(self):
+        for y in range(2):
+            for x in range(1,CONST_N):
+                list_of_nums=[(0,NUM_BITS),(CONST_A,NUM_BITS),(CONST_N,NUM_BITS),(0,NUM_BITS+3),
+                              (x,NUM_BITS),(1,NUM_BITS),(y,1),(0,2*NUM_BITS+3)]
+                func_input = bits_from_nums(*list_of_nums)
+                func_output = getattr(cc,"cmmodularmult{nb}_{A}_{N}".format(
+                                        nb=NUM_BITS,
+                                        A=CONST_A,N=CONST_N)
+                                        )(*func_input)
+                conv = nums_from_bits(func_output, list_of_nums)
+                self.assertEqual(0,conv[0])
+                self.assertEqual(CONST_A,conv[1])
+                self.assertEqual(CONST_N,conv[2])
+                self.assertEqual(0,conv[3])
+                self.assertEqual((CONST_A**y*x)%CONST_N,conv[4])
+                self.assertEqual(1,conv[5])
+                self.assertEqual(y,conv[6])
+                self.assertEqual(0,conv[7])
+
+class TestMontgomeryExp(SlicedTestCase):
+    """ mmodularexp and wmmodularexp, the exponentiations --multiplier
+    montgomery puts in the main program, of circuits synthesized with it """
+    def test_all_vals(self):
+        for nb, A, N in ((4,3,7), (5,7,15), (6,5,21)):
+            ns = gate_functions(plain_circuit(nb, A, N, multiplier='montgomery'))
+            cases = [[(0,nb),(A,nb),(N,nb),(0,nb+3),(1,nb),(1,nb),(y,nb),(0,2*nb+3)]
+                     for y in range(2**nb)]
+            convs = self.eval_sliced('mmodularexp{nb}_{A}_{N}'.format(nb=nb, A=A, N=N),
+                                     cases, ns)
+            for y,conv in enumerate(convs):
+                self.assertEqual([0,pow(A,2**nb,N),N,0,pow(A,y,N),1,y,0], conv, (nb, y))
+
+    def test_windowed(self):
+        for nb, A, N in ((4,3,7), (5,7,15)):
+            ns = gate_functions(plain_circuit(nb, A, N, window=2, multiplier='montgomery'))
+            cases = [[(0,nb),(A,nb),(N,nb),(0,nb+3),(1,nb),(y,nb),(0,4),(0,2*nb+3)]
+                     for y in range(2**nb)]
+            convs = self.eval_sliced('wmmodularexp{nb}_2_{A}_{N}'.format(nb=nb, A=A, N=N),
+                                     cases, ns)
+            for y,conv in enumerate(convs):
+                self.assertEqual([0,pow(A,2**nb,N),N,0,pow(A,y,N),y,0,0], conv, (nb, y))
+
+@ut.skipIf(COSET == 0, "run synth.py with --coset m to generate the coset gates")
+class TestCosetInit(SlicedTestCase):
+    def test_all_vals(self):
+        cases = [[(r,NUM_BITS+COSET),(CONST_N,NUM_BITS),(k,COSET),(0,NUM_BITS+2*COSET+1)]
+                 for k in range(2**COSET) for r in range(CONST_N)]
+        convs = self.eval_sliced('cosetinit{}_{}'.format(NUM_BITS,COSET), cases)
+        for case,conv in zip(cases,convs):
+            r, k = case[0][0], case[2][0]
+            self.assertEqual([r+k*CONST_N,CONST_N,0,0],conv)
+
+# Classically each coset register holds a single representative, so the
+# results are only checked mod N. It only stays below 2**(nb+m) if there are
+# more cosets than additions (synth.py rejects smaller m).
+@ut.skipIf(COSET == 0, "run synth.py with --coset m to generate the coset gates")
+@ut.skipIf(0 < 2**COSET <= 2*NUM_BITS*(NUM_BITS+COSET), "coset padding too small, see synth.min_coset_padding")
+class TestCosetModularExp(SlicedTestCase):
+    def test_all_vals(self):
+        cases = [[(0,NUM_BITS+COSET),
+                  (CONST_A,NUM_BITS),
+                  (0,COSET+1),
+                  (1,NUM_BITS+COSET),
+                  (y,NUM_BITS)] for y in range(2**(NUM_BITS))]
+        convs = self.eval_sliced('cosetmodularexp{nb}_{m}_{A}_{N}'.format(
+                                    nb=NUM_BITS, m=COSET, A=CONST_A, N=CONST_N), cases)
+        for y,conv in enumerate(convs):
+            self.assertEqual(0,conv[0]%CONST_N)
+            self.assertEqual((CONST_A**(2**NUM_BITS))%CONST_N,conv[1])
+            self.assertEqual(0,conv[2])
+            self.assertEqual((CONST_A**y)%CONST_N,conv[3]%CONST_N)
+            self.assertEqual(y,conv[4])
+
 class TestObfuscateSetup(ut.TestCase):
     def test_init(self):
         list_of_nums = [(0,NUM_BITS),
@@ -489,6 +731,309 @@ class TestObfuscateSetup(ut.TestCase):
         self.assertEqual(0,conv[5])
         self.assertEqual(0,conv[6])
 
+@ut.skipIf(cb is None, "run parser_qasm.py --target buffer to generate classical_buffer.py")
+class TestBufferTarget(ut.TestCase):
+    def test_modular_exp(self):
+        name = 'modularexp{nb}_{A}_{N}'.format(nb=NUM_BITS, A=CONST_A, N=CONST_N)
+        for y in range(2**(NUM_BITS)-1):
+            list_of_nums = [(0,NUM_BITS),
+                            (CONST_A,NUM_BITS),
+                            (CONST_N,NUM_BITS),
+                            (0,NUM_BITS+3),
+                            (1,NUM_BITS),
+                            (1,NUM_BITS),
+                            (y,NUM_BITS)]
+            func_input = pad_input(name, bits_from_nums(*list_of_nums))
+            st = bytearray(func_input)
+            getattr(cb,name)(st,range(len(st)))
+            self.assertEqual(list(getattr(cc,name)(*func_input)),list(st))
+
+def modular_exp_inputs():
+    name = 'modularexp{nb}_{A}_{N}'.format(nb=NUM_BITS, A=CONST_A, N=CONST_N)
+    for y in range(2**(NUM_BITS)-1):
+        yield pad_input(name, bits_from_nums((0,NUM_BITS),
+                             (CONST_A,NUM_BITS),
+                             (CONST_N,NUM_BITS),
+                             (0,NUM_BITS+3),
+                             (1,NUM_BITS),
+                             (1,NUM_BITS),
+                             (y,NUM_BITS)))
+
+@ut.skipIf(cf is None, "run parser_qasm.py --target flat to generate classical_flat.py")
+class TestFlatTarget(ut.TestCase):
+    def test_modular_exp(self):
+        name = 'modularexp{nb}_{A}_{N}'.format(nb=NUM_BITS, A=CONST_A, N=CONST_N)
+        for func_input in modular_exp_inputs():
+            st = bytearray(func_input)
+            getattr(cf,name)(st)
+            self.assertEqual(list(getattr(cc,name)(*func_input)),list(st))
+
+@ut.skipIf(co is None, "run parser_qasm.py --target opcodes to generate classical_opcodes.py")
+class TestOpcodesTarget(ut.TestCase):
+    def test_modular_exp(self):
+        name = 'modularexp{nb}_{A}_{N}'.format(nb=NUM_BITS, A=CONST_A, N=CONST_N)
+        for func_input in modular_exp_inputs():
+            st = bytearray(func_input)
+            co.run(st,co.OPCODES[name])
+            self.assertEqual(list(getattr(cc,name)(*func_input)),list(st))
+
+class TestPeephole(ut.TestCase):
+    def test_random_circuits(self):
+        import random
+        import parser_qasm as pq
+        ns = {}
+        exec(pq.opcodes_base_code, ns)
+        arity = {'x': 1, 'cx': 2, 'ccx': 3, 'swap': 2, 'cswap': 3}
+        rng = random.Random(1)
+        for _ in range(3000):
+            ops = []
+            for _ in range(rng.randint(1, 8)):
+                func = rng.choice(['x', 'x', 'x'] + list(pq.primitives))
+                ops.append((func, tuple(rng.sample(range(4), arity[func]))))
+            optimized = pq.to_opcodes(pq.peephole_ops(ops))
+            for v in range(16):
+                expected, st = bytearray(convert_to_bits(v, 4)), bytearray(convert_to_bits(v, 4))
+                ns['run'](expected, pq.to_opcodes(ops))
+                ns['run'](st, optimized)
+                self.assertEqual(list(expected), list(st), ops)
+
+
+class TestSynthesizer(ut.TestCase):
+    circuits = [(4, 3, 7), (5, 7, 15), (6, 5, 21)]
+
+    def test_threads(self):
+        import synth
+        from concurrent.futures import ThreadPoolExecutor
+        # each circuit twice, so the same gates are declared concurrently too
+        with ThreadPoolExecutor(len(self.circuits)*2) as executor:
+            codes = list(executor.map(lambda c: synth.synth(*c, False, adder=ADDER),
+                                      self.circuits*2))
+        for circuit, code in zip(self.circuits*2, codes):
+            self.assertEqual(plain_circuit(*circuit), code)
+
+    def test_batch(self):
+        import os
+        import synth
+        import tempfile
+        import contextlib
+        with tempfile.TemporaryDirectory() as path:
+            with contextlib.redirect_stdout(io.StringIO()):
+                synth.synth_batch(self.circuits, False, False, False, path, workers=2, adder=ADDER)
+            for nb, A, N in self.circuits:
+                with open(os.path.join(path, 'circuit_{}_{}_{}.qasm'.format(nb, A, N))) as f:
+                    self.assertEqual(plain_circuit(nb, A, N), f.read())
+
+class TestGateCache(ut.TestCase):
+    def synth(self, cache, **options):
+        import synth
+        synthesizer = synth.Synthesizer(cache=cache, adder=ADDER, **options)
+        return synthesizer.synth(NUM_BITS, CONST_A, CONST_N, False)
+
+    def test_same_as_uncached(self):
+        import synth
+        import tempfile
+        with tempfile.TemporaryDirectory() as path:
+            self.assertEqual(plain_circuit(), self.synth(synth.GateCache(path)))
+            # a warm run only writes out the cached gates, declaring none
+            enter = synth.declare.__enter__
+            synth.declare.__enter__ = lambda declare: self.fail('generator run: ' + declare.name)
+            try:
+                self.assertEqual(plain_circuit(), self.synth(synth.GateCache(path)))
+                options = dict(dedup=True, prune=True, optimize=True, relabel=True)
+                warm = self.synth(synth.GateCache(path), **options)
+            finally:
+                synth.declare.__enter__ = enter
+            self.assertEqual(self.synth(None, **options), warm)
+
+class TestDedup(ut.TestCase):
+    def test_merged_gates(self):
+        import synth
+        import estimate
+        import parser_qasm as pq
+        synthesizer = synth.Synthesizer(dedup=True, adder=ADDER)
+        code = synthesizer.synth(NUM_BITS, CONST_A, CONST_N, False)
+        _, plain, _ = pq.read_gates(io.StringIO(plain_circuit()))
+        _, gates, aliases = pq.read_gates(io.StringIO(code))
+        self.assertEqual(synthesizer.aliases, aliases)
+        self.assertEqual(len(plain), len(gates) + len(aliases))
+        # every gate, merged or not, still expands to the same operations
+        for name, _, _ in plain:
+            self.assertEqual(pq.flatten(plain, name), pq.flatten(gates, aliases.get(name, name)))
+        self.assertEqual(estimate.estimate_qasm(plain_circuit())[2:],
+                         estimate.estimate_qasm(code)[2:])
+
+class TestPrune(ut.TestCase):
+    def test_dropped_gates(self):
+        import synth
+        import estimate
+        import parser_qasm as pq
+        synthesizer = synth.Synthesizer(prune=True, adder=ADDER)
+        code = synthesizer.synth(NUM_BITS, CONST_A, CONST_N, False)
+        _, plain, _ = pq.read_gates(io.StringIO(plain_circuit()))
+        _, gates, _ = pq.read_gates(io.StringIO(code))
+        dropped = {gate.name for gate in synthesizer.pruned}
+        self.assertIn('multbchain{}'.format(NUM_BITS), dropped)
+        self.assertEqual([g for g in plain if g[0] not in dropped], gates)
+        # nothing the main program runs was dropped
+        self.assertEqual(estimate.estimate_qasm(plain_circuit())[2:],
+                         estimate.estimate_qasm(code)[2:])
+        called = {func for _, _, body in gates for func, _ in body}
+        self.assertFalse(called & dropped)
+
+class TestRelabel(ut.TestCase):
+    def test_same_permutation(self):
+        import random
+        import synth
+        import parser_qasm as pq
+        code = synth.Synthesizer(relabel=True, adder=ADDER).synth(NUM_BITS, CONST_A, CONST_N, False)
+        _, plain, _ = pq.read_gates(io.StringIO(plain_circuit()))
+        _, gates, _ = pq.read_gates(io.StringIO(code))
+        name = 'modularexp{nb}_{A}_{N}'.format(nb=NUM_BITS, A=CONST_A, N=CONST_N)
+        self.assertLess(sum(func == 'swap' for func, _ in pq.flatten(gates, name)),
+                        sum(func == 'swap' for func, _ in pq.flatten(plain, name)))
+        ns = {}
+        exec(pq.opcodes_base_code, ns)
+        ns['set_lanes'](64)
+        rng = random.Random(1)
+        # 64 random inputs per gate, one per lane
+        for name, params, _ in plain:
+            inputs = [rng.getrandbits(64) for _ in params]
+            expected, st = list(inputs), list(inputs)
+            ns['run'](expected, pq.to_opcodes(pq.flatten(plain, name)))
+            ns['run'](st, pq.to_opcodes(pq.flatten(gates, name)))
+            self.assertEqual(expected, st, name)
+
+class TestEstimate(ut.TestCase):
+    def test_flattened_counts(self):
+        import estimate
+        import parser_qasm as pq
+        from collections import Counter
+        code = plain_circuit()
+        _, gates, _ = pq.read_gates(io.StringIO(code))
+        table, counts, program, qubits = estimate.estimate_qasm(code)
+        for name, _, _ in gates:
+            flat = Counter(func for func, _ in pq.flatten(gates, name))
+            self.assertEqual([flat[p] for p in estimate.primitives], counts[name], name)
+        (synth_table, *synthesized), _ = estimate.estimate_synth(NUM_BITS, CONST_A, CONST_N,
+                                                                 False, adder=ADDER)
+        self.assertEqual([counts, program, qubits], synthesized)
+        self.assertEqual([(name, len(params)) for name, params in table],
+                         [(name, len(params)) for name, params in synth_table])
+
+class TestPartialEval(ut.TestCase):
+    def test_modular_exp(self):
+        import parser_qasm as pq
+        name = 'modularexp{nb}_{A}_{N}'.format(nb=NUM_BITS, A=CONST_A, N=CONST_N)
+        _, gates, _ = pq.read_gates(io.StringIO(plain_circuit()))
+        params = next(params for g, params, _ in gates if g == name)
+        ops = pq.flatten(gates, name)
+        ns = {}
+        exec(pq.opcodes_base_code, ns)
+        inputs = [bits + [0]*(len(params)-len(bits)) for bits in
+                  (bits_from_nums((0,NUM_BITS), (CONST_A,NUM_BITS), (CONST_N,NUM_BITS),
+                                  (0,NUM_BITS+3), (1,NUM_BITS), (1,NUM_BITS), (y,NUM_BITS))
+                   for y in range(2**NUM_BITS))]
+        # only y differs between the inputs
+        known = {i: b for i, (p, b) in enumerate(zip(params, inputs[0])) if p[0] != 'y'}
+        residual = pq.to_opcodes(pq.partial_eval(ops, known))
+        self.assertLess(len(residual), len(pq.to_opcodes(ops)))
+        for func_input in inputs[::3]:
+            expected, st = bytearray(func_input), bytearray(func_input)
+            ns['run'](expected, pq.to_opcodes(ops))
+            ns['run'](st, residual)
+            self.assertEqual(list(expected), list(st))
+
+class TestSimulator(ut.TestCase):
+    def test_measured_power(self):
+        import simulate
+        counts, _ = simulate.simulate(plain_circuit(), shots=4, seed=1)
+        powers = {pow(CONST_A, y, CONST_N) for y in range(2**NUM_BITS)}
+        for key in counts:
+            self.assertIn(int(key.split(' ')[-1], 2) % CONST_N, powers)
+
+    def test_partial(self):
+        import simulate
+        code = plain_circuit()
+        self.assertEqual(simulate.simulate(code, 4, seed=3)[0],
+                         simulate.simulate(code, 4, seed=3, partial=True)[0])
+
+    def test_sample(self):
+        import simulate
+        code = plain_circuit()
+        counts, _ = simulate.sample(code, 40, seed=2, workers=2, chunk=8)
+        self.assertEqual(sum(counts.values()), 40)
+        self.assertEqual(counts, simulate.sample(code, 40, seed=2, workers=1, chunk=8)[0])
+
+    def test_angle(self):
+        import math
+        import simulate
+        self.assertAlmostEqual(simulate.angle('pi/2^3'), math.pi/8)
+        self.assertAlmostEqual(simulate.angle('-3*pi/4'), -3*math.pi/4)
+        self.assertRaises(ValueError, simulate.angle, '__import__("os").getcwd()')
+
+class TestDepth(ut.TestCase):
+    code = '\n'.join(['gate maj c,b,a', '{', '  cx a,b;', '  cx a,c;', '  ccx b,c,a;', '}',
+                      'gate twice c,b,a,d', '{', '  x d;', '  maj c,b,a;', '  cx d,a;', '}', ''])
+
+    def test_known_gate(self):
+        import depth
+        import parser_qasm as pq
+        _, gates, _ = pq.read_gates(io.StringIO(self.code))
+        ops = pq.flatten(gates, 'twice')
+        # both cx only read a, the ccx writes a, then cx d,a reads it
+        layers, pred, d = depth.asap(ops, 4)
+        self.assertEqual(([0, 0, 0, 1, 2], 3), (layers, d))
+        self.assertEqual([1, 0, 0, 1, 2], depth.alap(ops, 4, d))
+        self.assertEqual([1, 3, 4], depth.critical_path(layers, pred, d))
+        self.assertEqual({'maj': 2, 'twice': 3}, depth.gate_depths(gates, ['maj', 'twice']))
+
+    def test_layered(self):
+        import depth
+        import parser_qasm as pq
+        _, gates, _ = pq.read_gates(io.StringIO(self.code))
+        body = depth.layered_gate(gates, 'twice')
+        self.assertEqual(['  // layer 0', '  x d;', '  cx a,b;', '  cx a,c;',
+                          '  // layer 1', '  ccx b,c,a;', '  // layer 2', '  cx d,a;'], body)
+        _, layered, _ = pq.read_gates(io.StringIO(depth.replace_body(self.code, 'twice', body)))
+        self.assertEqual(sorted(pq.flatten(gates, 'twice')), sorted(pq.flatten(layered, 'twice')))
+
+class TestDenseSimulator(ut.TestCase):
+    def test_same_as_sparse(self):
+        import simulate
+        code = '\n'.join(['gate maj c,b,a', '{', '  cx a,b;', '  cx a,c;', '  ccx b,c,a;', '}',
+                          'qreg q[3];', 'qreg y[2];', 'creg c[3];', 'creg d[3];',
+                          'creg cr0[1];', 'creg cr1[1];',
+                          'h y;', 'x q[0];', 'cswap y[0],q[0],q[1];', 'maj q[2],q[1],y[1];',
+                          'swap q[0],q[2];', 'cx y[1],q[0];', 'ccx q[1],y[0],q[2];',
+                          'measure q -> c;', 'swap q[0],q[2];', 'x q[0];', 'cx q[2],q[1];',
+                          'measure q -> d;', 'h y[0];', 'measure y[0]->cr0[0];',
+                          'if(cr0==1) u1(pi/2) y[1];', 'h y[1];', 'measure y[1]->cr1[0];'])
+        for seed in range(3):
+            self.assertEqual(simulate.simulate(code, 16, seed)[0],
+                             simulate.simulate(code, 16, seed, 'dense')[0])
+
+class TestRunQasm(ut.TestCase):
+    def test_builtin(self):
+        import os
+        import tempfile
+        import run_qasm
+        import simulate
+        code = '\n'.join(['gate maj c,b,a', '{', '  cx a,b;', '  cx a,c;', '  ccx b,c,a;', '}',
+                          'qreg q[2];', 'qreg y[2];', 'creg c[2];', 'creg cr0[1];',
+                          'h y;', 'x q[0];', 'cswap y[0],q[0],q[1];', 'maj q[1],q[0],y[1];',
+                          'measure q -> c;', 'h y[0];', 'measure y[0]->cr0[0];'])
+        with tempfile.TemporaryDirectory() as path:
+            qasm = os.path.join(path, 'tiny.qasm')
+            missing = os.path.join(path, 'missing.qasm')
+            with open(qasm, 'w') as f:
+                f.write(code)
+            results = {r['file']: r for r in run_qasm.run_all([qasm, missing], shots=8,
+                                                             seed=1, builtin=True)}
+        self.assertEqual(results[qasm]['backend'], 'simulate')
+        self.assertEqual(results[qasm]['counts'], dict(simulate.simulate(code, 8, 1)[0]))
+        self.assertIn('error', results[missing])
+        self.assertNotIn('counts', results[missing])
+
 if __name__=='__main__':
     print("nb={} A={} N={}".format(NUM_BITS,CONST_A,CONST_N))
     ut.main()